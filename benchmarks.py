@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+'''Micro-benchmarks for depfinder's parsers and startup time.
+
+Run 'python3 benchmarks.py [name...]' to run all (or the named) benchmarks,
+and compare the numbers before and after changing the code under test.
+'''
+
+import io
+import os
+import subprocess
+import sys
+import time
+
+
+def best_of(func, *args, repeat=3):
+    '''Return the best wall-clock time (in seconds) of calling func(*args).'''
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - t)
+    return min(times)
+
+
+def report(name, seconds, count, unit):
+    print('{:<40} {:8.3f}s {:12.0f} {}/s'.format(
+        name, seconds, count / seconds, unit))
+
+
+def synthetic_make_database(num_targets=20000, num_vars=5000):
+    '''Return a large, synthetic 'make --print-data-base' dump, as bytes.'''
+    out = ['# GNU Make 4.3', '', '# Variables', '']
+    for i in range(num_vars):
+        out.append("# makefile (from 'Makefile', line {})".format(i))
+        out.append('VAR_{} = value of variable number {}'.format(i, i))
+    out.extend(['', '# Implicit Rules', '', '%.o: %.c'])
+    out.append("#  recipe to execute (from 'Makefile', line 1):")
+    out.extend(['\t$(CC) -c $< -o $@', '', '# Files', ''])
+    for i in range(num_targets):
+        out.append('obj/file_{0}.o: src/file_{0}.c include/common.h'.format(i))
+        out.append('#  Implicit rule search has not been done.')
+        out.append('#  File does not exist.')
+        out.append('#  File has not been updated.')
+        out.append("#  recipe to execute (from 'Makefile', line 4):")
+        out.append('\t$(CC) $(CFLAGS) -c $< -o $@')
+        out.append('')
+        out.append('# Not a target:')
+        out.append('src/file_{}.c:'.format(i))
+        out.append('#  Implicit rule search has been done.')
+        out.append('#  Last modified 2015-06-01 12:00:00.000000000')
+        out.append('#  File has been updated.')
+        out.append('#  Successfully updated.')
+        out.append('')
+    out.append('# Finished Make data base')
+    return '\n'.join(out).encode('ascii') + b'\n'
+
+
+def bench_makeparser():
+    from makeparser import Makefile, iter_byte_lines
+
+    dump = synthetic_make_database()
+    num_lines = dump.count(b'\n')
+
+    def text_lines():
+        for line in io.TextIOWrapper(io.BytesIO(dump)):
+            line.rstrip('\r\n')
+
+    def byte_lines():
+        for line in iter_byte_lines(io.BytesIO(dump)):
+            pass
+
+    def parse():
+        Makefile.parse_lines(iter_byte_lines(io.BytesIO(dump)))
+
+    report('makeparser: text line iteration', best_of(text_lines),
+           num_lines, 'lines')
+    report('makeparser: byte line iteration', best_of(byte_lines),
+           num_lines, 'lines')
+    report('makeparser: Makefile.parse_lines()', best_of(parse),
+           num_lines, 'lines')
+
+
+def synthetic_collapsed_trace(num_dirs=500, files_per_dir=400):
+    '''Return a large, synthetic collapsed ProcessTrace of a build.'''
+    from pathlib import Path
+    from process_trace import ProcessTrace
+
+    p = ProcessTrace(pid=1, cwd='/src', argv=['make'], exit_code=0)
+    for d in range(num_dirs):
+        for f in range(files_per_dir):
+            src = Path('/src/dir_{}/file_{}.c'.format(d, f))
+            obj = src.with_suffix('.o')
+            header = Path('/usr/include/header_{}.h'.format(f))
+            p.paths_read.add((str(src), src))
+            p.paths_read.add((str(header), header))
+            p.paths_written.add((str(obj), obj))
+            p.paths_checked.add((str(src), src, True))
+            p.paths_checked.add((str(obj), obj, False))
+            p.paths_checked.add((str(obj) + '.d', obj.with_suffix('.d'),
+                                 bool(f % 2)))
+    return p
+
+
+def bench_classify():
+    from depfinder import classify
+
+    p = synthetic_collapsed_trace()
+    num_paths = len(p.paths_read) + len(p.paths_written) + len(
+        p.paths_checked)
+    report('depfinder: classify()', best_of(classify, p), num_paths, 'paths')
+
+
+def synthetic_strace_log(num_processes=20000):
+    '''Return a large, synthetic strace log of a build, as a string.'''
+    out = ['1 execve("/usr/bin/make", ["make"], ["PATH=/usr/bin"]) = 0']
+    for pid in range(2, num_processes + 2):
+        out.extend([
+            '1 clone(child_stack=NULL, flags=CLONE_CHILD_CLEARTID|'
+            'CLONE_CHILD_SETTID|SIGCHLD, child_tidptr=0x7f00) = {}'.format(
+                pid),
+            '{} execve("/usr/bin/cc", ["cc", "-c", "file_{}.c"], '
+            '["PATH=/usr/bin"]) = 0'.format(pid, pid),
+            '{} access("/etc/ld.so.preload", R_OK) = -1 ENOENT '
+            '(No such file or directory)'.format(pid),
+            '{} openat(AT_FDCWD, "/etc/ld.so.cache", O_RDONLY|O_CLOEXEC) '
+            '= 3</etc/ld.so.cache>'.format(pid),
+            '{} openat(AT_FDCWD, "file_{}.c", O_RDONLY) '
+            '= 3</src/file_{}.c>'.format(pid, pid, pid),
+            '{} openat(AT_FDCWD, "file_{}.o", O_WRONLY|O_CREAT|O_TRUNC, 0666)'
+            ' = 4</src/file_{}.o>'.format(pid, pid, pid),
+            '{} +++ exited with 0 +++'.format(pid),
+            '1 --- SIGCHLD {{si_signo=SIGCHLD, si_code=CLD_EXITED, '
+            'si_pid={}, si_uid=1000, si_status=0}} ---'.format(pid),
+        ])
+    out.append('1 +++ exited with 0 +++')
+    return '\n'.join(out) + '\n'
+
+
+def bench_strace_log():
+    from tempfile import NamedTemporaryFile
+    from strace_helper import replay_trace
+
+    with NamedTemporaryFile('w', suffix='.log') as f:
+        f.write(synthetic_strace_log())
+        f.flush()
+        with open(f.name) as log:
+            num_lines = sum(1 for _ in log)
+
+        def text_lines():
+            with open(f.name) as log:
+                for line in log:
+                    pass
+
+        report('strace log: text line iteration', best_of(text_lines),
+               num_lines, 'lines')
+        report('strace log: parse text lines', best_of(
+            lambda: list(replay_trace(f.name))), num_lines, 'lines')
+
+
+def bench_exec_env(num_processes=5000, num_vars=60):
+    import tracemalloc
+    from process_trace import ProcessTrace
+    from strace_helper import StraceOutputParser
+
+    env = ', '.join('"VAR_{}=/some/fairly/long/value/{}"'.format(i, i)
+                    for i in range(num_vars))
+    lines = ['1 execve("/usr/bin/make", ["make"], [{}]) = 0\n'.format(env)]
+    for pid in range(2, num_processes + 2):
+        lines.extend([
+            '1 vfork() = {}\n'.format(pid),
+            '{} execve("/usr/bin/cc", ["cc", "file_{}.c"], [{}, '
+            '"MAKELEVEL=1", "SRC=file_{}.c"]) = 0\n'.format(
+                pid, pid, env, pid % 10),
+            '{} +++ exited with 0 +++\n'.format(pid),
+        ])
+    lines.append('1 +++ exited with 0 +++\n')
+
+    def parse(cache_size):
+        parser = StraceOutputParser()
+        parser.EnvCacheSize = cache_size
+        return list(parser(lines))
+
+    for cache_size in [0, StraceOutputParser.EnvCacheSize]:
+        name = 'exec env: parse, {} envs cached'.format(cache_size)
+        report(name, best_of(parse, cache_size), len(lines), 'lines')
+        tracemalloc.start()
+        root = ProcessTrace.from_events(iter(parse(cache_size)))
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('{:<40} {:8.1f} MB'.format(
+            'exec env: parse + tree, {} envs cached'.format(cache_size),
+            size / 1e6))
+        del root
+
+
+def bench_fifo():
+    import threading
+    from tempfile import NamedTemporaryFile
+    from process_trace import ProcessTrace
+    from strace_helper import (
+        drain_fifo, parse_in_process, StraceOutputParser, temp_fifo)
+
+    def parse_fifo(fifo, read_ahead):
+        with open(fifo) as f:
+            lines = drain_fifo(f) if read_ahead else f
+            yield from StraceOutputParser()(lines)
+
+    def run(log, events):
+        '''Return how long a writer was held up, and the total time.'''
+        with temp_fifo() as fifo:
+            t = time.perf_counter()
+            writer = subprocess.Popen(
+                'cat {} > {}'.format(log, fifo), shell=True)
+            writer_done = []
+
+            def wait():
+                writer.wait()
+                writer_done.append(time.perf_counter())
+
+            waiter = threading.Thread(target=wait)
+            waiter.start()
+            ProcessTrace.from_events(events(fifo), evict=True)
+            waiter.join()
+            return writer_done[0] - t, time.perf_counter() - t
+
+    with NamedTemporaryFile('w', suffix='.log') as f:
+        f.write(synthetic_strace_log())
+        f.flush()
+        for name, events in [
+            ('plain FIFO', lambda fifo: parse_fifo(fifo, False)),
+            ('drain_fifo()', lambda fifo: parse_fifo(fifo, True)),
+            ('parse_in_process()', lambda fifo: parse_in_process(fifo)),
+        ]:
+            writer, total = min(run(f.name, events) for _ in range(3))
+            print('{:<40} {:8.3f}s writer, {:.3f}s total'.format(
+                'fifo: ' + name, writer, total))
+
+
+def bench_startup():
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    def run(*args):
+        subprocess.run([sys.executable] + list(args), cwd=here, check=True,
+                       stdout=subprocess.DEVNULL)
+
+    for name, args in [
+        ('startup: python -c pass', ['-c', 'pass']),
+        ('startup: import depfinder', ['-c', 'import depfinder']),
+        ('startup: depfinder.py --help', ['depfinder.py', '--help']),
+    ]:
+        report(name, best_of(run, *args, repeat=10), 1, 'starts')
+
+
+Benchmarks = {
+    'classify': bench_classify,
+    'exec_env': bench_exec_env,
+    'fifo': bench_fifo,
+    'makeparser': bench_makeparser,
+    'startup': bench_startup,
+    'strace_log': bench_strace_log,
+}
+
+
+def main(*names):
+    for name in names or sorted(Benchmarks.keys()):
+        Benchmarks[name]()
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(*sys.argv[1:]))
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+'''Report where the wall time of a traced command (e.g. a build) goes.
+
+Usage: build_profile.py [--top N] [--record FILE] (--replay FILE | CMD...)
+
+Reports the processes with the longest wall time, and the critical path:
+the chain of processes, from the root down, that determined how long the
+whole command took.
+'''
+
+import argparse
+import shlex
+import sys
+
+from process_trace import ProcessTrace
+from strace_helper import recording_info, replay_trace, run_trace
+
+
+def wall_time(p):
+    '''Return the wall time of ProcessTrace p, or None if not known.'''
+    if p.started is None or p.exited is None:
+        return None
+    return p.exited - p.started
+
+
+def walk(p):
+    '''Generate p and all its descendants, depth first.'''
+    yield p
+    for c in p.children:
+        yield from walk(c)
+
+
+def slowest(root, n):
+    '''Return the n processes under root with the longest wall time.'''
+    timed = [p for p in walk(root) if wall_time(p) is not None]
+    return sorted(timed, key=wall_time, reverse=True)[:n]
+
+
+def waited_for(p):
+    '''Return the chain of p's children that p waited for, in order.
+
+    Built backwards: from the child that exited last, step to the sibling
+    that exited last before it started, and so on. Children without
+    timestamps are left out.
+    '''
+    chain = []
+    candidates = [c for c in p.children if wall_time(c) is not None]
+    while candidates:
+        c = max(candidates, key=lambda c: c.exited)
+        chain.append(c)
+        candidates = [
+            s for s in candidates if s is not c and s.exited <= c.started]
+    chain.reverse()
+    return chain
+
+
+def critical_path(root):
+    '''Return the critical path of the process tree under root.
+
+    That is root, then for each child in the chain that root waited for
+    (see waited_for()), that child's critical path.
+    '''
+    path = [root]
+    for c in waited_for(root):
+        path.extend(critical_path(c))
+    return path
+
+
+def describe(p, width=80):
+    argv = p.argv if p.argv is not None else [str(p.executable)]
+    s = ' '.join(shlex.quote(a) for a in argv)
+    return s if len(s) <= width else s[:width - 3] + '...'
+
+
+def write_report(f, root, top=10):
+    total = wall_time(root)
+    if total is None:
+        f.write('No timestamps in trace (record it with timestamps)\n')
+        return
+
+    f.write('Slowest processes (wall time, % of total, pid, command):\n')
+    for p in slowest(root, top):
+        f.write('{:10.3f}s {:5.1f}% {:>8} {}\n'.format(
+            wall_time(p), 100 * wall_time(p) / total, p.pid, describe(p)))
+
+    f.write('Critical path (wall time, self time, pid, command):\n')
+    for p in critical_path(root):
+        wall = wall_time(p)
+        if wall is None:
+            f.write('{:>11} {:>11} {:>8} {}\n'.format(
+                '?', '?', p.pid, describe(p)))
+            continue
+        self_time = wall - sum(wall_time(c) for c in waited_for(p))
+        f.write('{:10.3f}s {:10.3f}s {:>8} {}\n'.format(
+            wall, self_time, p.pid, describe(p)))
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description='Report where the wall time of a traced command goes.')
+    parser.add_argument(
+        '--top', metavar='N', type=int, default=10,
+        help='number of slowest processes to report (default: 10)')
+    parser.add_argument(
+        '--record', metavar='FILE',
+        help='also save the raw strace output to FILE (gzip-compressed)')
+    parser.add_argument(
+        '--replay', metavar='FILE',
+        help='analyze the strace output saved by --record')
+    parser.add_argument('command', nargs=argparse.REMAINDER)
+    opts = parser.parse_args(args)
+    if bool(opts.replay) == bool(opts.command):
+        parser.error('give either --replay or a command')
+
+    cwd = None
+    if opts.replay:
+        events = replay_trace(opts.replay)  # with timestamps, if recorded
+        cwd = recording_info(opts.replay).get('cwd')
+    else:
+        events = run_trace(opts.command, record=opts.record, timestamps=True)
+    write_report(
+        sys.stdout, ProcessTrace.from_events(events, cwd=cwd), opts.top)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
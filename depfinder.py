@@ -1,47 +1,452 @@
 #!/usr/bin/env python3
 
+import argparse
+from collections import namedtuple
 import logging
+import os
+from pathlib import Path
 import shlex
+import sys
+import threading
+import time
 
-from process_trace import ProcessTrace
-from strace_helper import run_trace
+from lazy_modules import lazy
+from path_trie import PathTrie
+from process_trace import ProcessTrace, RealpathCache
+from strace_helper import recording_info, replay_trace, run_trace
 
+logger = logging.getLogger('depfinder')
 
-logging.basicConfig(level=logging.WARNING)
 
+class LiveReport:
+    '''Report newly discovered paths while the traced command runs.
 
-def main(cmd_args):
-    p = ProcessTrace.from_events(run_trace(cmd_args))
+    Use as the on_event callback of ProcessTrace.from_events(). Each path is
+    written to f (as a tab-separated "kind path" line) the first time it is
+    read, written, found to exist, or found to be missing. Lines are buffered
+    and flushed at most once every 'interval' seconds, by the event handler
+    or, while no events arrive, by a timer thread. Call .close() at the end.
+
+    Pass the path_filter and resolver given to ProcessTrace.from_events(),
+    so that the same paths are reported, in the same form.
+    '''
+
+    def __init__(self, f, interval=0.2, path_filter=None, resolver=None):
+        self.f = f
+        self.interval = interval
+        self.path_filter = path_filter
+        self.resolver = resolver
+        self.seen = set()  # (kind, path) pairs already reported
+        self.lines = []  # lines not yet flushed
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()  # guards .lines and writes to f
+        self.closed = threading.Event()
+        self.timer = None
+        if interval > 0:
+            self.timer = threading.Thread(
+                target=self._flush_periodically, name='live report',
+                daemon=True)
+            self.timer.start()
+
+    def __call__(self, p, event, args):
+        if event == 'read' or event == 'write':
+            kind = event
+        elif event == 'check':
+            kind = 'exists' if args[1] else 'missing'
+        elif event == 'exec':
+            kind = 'read'
+        else:
+            return
+        path = p.cwd / args[0]
+        if self.resolver is not None:
+            path = self.resolver(path)
+        if self.path_filter is not None and not self.path_filter(path):
+            return
+        key = (kind, path)
+        if key in self.seen:
+            return
+        self.seen.add(key)
+        with self.lock:
+            self.lines.append('{}\t{}\n'.format(*key))
+        if time.monotonic() - self.last_flush >= self.interval:
+            self.flush()
+
+    def _flush_periodically(self):
+        while not self.closed.wait(self.interval):
+            if time.monotonic() - self.last_flush >= self.interval:
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.lines:
+                self.f.write(''.join(self.lines))
+                self.f.flush()
+                self.lines = []
+            self.last_flush = time.monotonic()
+
+    def close(self):
+        '''Stop the timer thread, and flush the remaining lines.'''
+        self.closed.set()
+        if self.timer is not None:
+            self.timer.join()
+        self.flush()
+
+
+def open_live_output(spec, stdout=None):
+    '''Open the output for --live: '-', a file, or a 'unix:' socket path.'''
+    if spec == '-':
+        return sys.stdout if stdout is None else stdout
+    elif spec.startswith('unix:'):
+        socket = lazy.socket
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect(spec[5:])
+        return s.makefile('w')
+    else:
+        return open(spec, 'w')
+
+
+def cached_trace(cmd_args, cache_path, jobs=None, tolerant=False,
+                 parse_process=False, **popen_args):
+    '''Return a ProcessTrace of cmd_args, reusing the trace in cache_path.
+
+    If cache_path holds a trace of the same command (in the same cwd and
+    environment) and none of its recorded inputs have changed since, return
+    that trace without running the command. Otherwise, trace the command and
+    store the result in cache_path.
+    '''
+    trace_cache = lazy.trace_cache
+
+    cwd = popen_args.get('cwd')
+    launch_cwd = Path(cwd or Path.cwd())
+    env = popen_args.get('env')
+    launch_env = dict(os.environ if env is None else env)
+    try:
+        with open(cache_path) as f:
+            p, stamps, checked, trace_cwd, trace_env = trace_cache.load(f)
+        if (p.argv == cmd_args and trace_cwd == launch_cwd
+                and trace_env == trace_cache.env_digest(launch_env)):
+            if trace_cache.is_up_to_date(stamps, checked, jobs):
+                logger.info('Reusing trace from {}'.format(cache_path))
+                return p
+    except (OSError, ValueError, KeyError) as e:
+        logger.info('Cannot reuse trace from {}: {}'.format(cache_path, e))
+
+    stamper = trace_cache.InputStamper(jobs)
+    p = ProcessTrace.from_events(
+        run_trace(cmd_args, tolerant=tolerant, parse_process=parse_process,
+                  **popen_args),
+        cwd=cwd, evict=True, on_event=stamper)
+    with open(cache_path, 'w') as f:
+        trace_cache.save(f, p, jobs, stamper, launch_cwd, launch_env)
+    return p
+
+
+Dependencies = namedtuple('Dependencies', 'written read present missing')
+
+# Flags recording how a path was accessed (see classify())
+Written, Read, Present, Missing = 1, 2, 4, 8
+
+
+def classify(p, new_trie=PathTrie):
+    '''Classify the paths accessed by collapsed ProcessTrace p.
+
+    Return a Dependencies tuple of path sets (as created by new_trie()):
+    paths written, paths read, and paths whose existence or non-existence
+    the command depends on (but that were not written or read).
+
+    All accesses to a path are first ORed into a single set of flags, and
+    each path is then added to its path set(s) in one pass over the flags.
+    '''
+    flags = {}  # path -> Written|Read|Present|Missing
+    get = flags.get
+    for _, path in p.paths_written:
+        flags[path] = get(path, 0) | Written
+    for _, path in p.paths_read:
+        flags[path] = get(path, 0) | Read
+    for _, path, exists in p.paths_checked:
+        flags[path] = get(path, 0) | (Present if exists else Missing)
+
+    deps = Dependencies(*(new_trie() for _ in range(4)))
+    for path, f in flags.items():
+        if f & Written:
+            deps.written.add(path)
+        if f & Read:
+            deps.read.add(path)
+        elif not f & Written:
+            if f & Present:
+                deps.present.add(path)
+            if f & Missing:
+                deps.missing.add(path)
+    return deps
+
+
+# Output writers: Write Dependencies to file f, one path at a time
+
+def write_text(f, argv, deps, summary=None):
+    '''Write human-readable text, optionally summarized per directory.'''
+    def write_paths(paths):
+        if summary is None:
+            for path in paths:
+                f.write('    {}\n'.format(path))
+        else:
+            for path, count in paths.summary(summary):
+                if count == 1:
+                    f.write('    {}\n'.format(path))
+                else:
+                    f.write('    {}/ ({} paths)\n'.format(path, count))
+
+    f.write('The command:\n    {}\n'.format(
+        ' '.join(shlex.quote(a) for a in argv)))
+    for header, paths in [
+        ('writes these paths:', deps.written),
+        ('reads these paths:', deps.read),
+        ('depends on the existence of these paths:', deps.present),
+        ('depends on the non-existence of these paths:', deps.missing),
+    ]:
+        if paths:
+            f.write(header + '\n')
+            write_paths(paths)
+
+
+def write_json(f, argv, deps):
+    '''Write a JSON object with the command and a list per category.'''
+    json = lazy.json
+
+    f.write('{{"command": {}'.format(json.dumps(argv)))
+    for category, paths in zip(deps._fields, deps):
+        f.write(', "{}": ['.format(category))
+        sep = ''
+        for path in paths:
+            f.write(sep)
+            f.write(json.dumps(str(path)))
+            sep = ', '
+        f.write(']')
+    f.write('}\n')
+
+
+def write_nul(f, deps):
+    '''Write the command's inputs (paths read or checked for existence).
+
+    Each path is terminated by a NUL byte, as expected by 'xargs -0'. f is
+    a binary file, as paths are written as the bytes the OS uses for them.
+    '''
+    for paths in [deps.read, deps.present]:
+        for path in paths:
+            f.write(os.fsencode(path))
+            f.write(b'\0')
+
+
+def _make_escape(path):
+    return str(path).replace('$', '$$').replace('#', '\\#').replace(
+        ' ', '\\ ')
+
+
+def write_make_deps(f, deps, targets=None):
+    '''Write a gcc-style .d file: a rule from the outputs to the inputs.
+
+    The outputs are the given targets, or else the paths written; raise
+    ValueError if there are none. Like 'gcc -MP', an empty rule is also
+    written for each input, so that make does not fail when an input is
+    removed.
+    '''
+    if targets is None:
+        targets = deps.written
+    if not targets:
+        raise ValueError('No targets for the .d rule: no paths were written')
+    f.write(' '.join(map(_make_escape, targets)))
+    f.write(':')
+    for paths in [deps.read, deps.present]:
+        for path in paths:
+            f.write(' \\\n  ')
+            f.write(_make_escape(path))
+    f.write('\n')
+    for paths in [deps.read, deps.present]:
+        for path in paths:
+            f.write('\n{}:\n'.format(_make_escape(path)))
+
+
+class ArgumentParser(argparse.ArgumentParser):
+    '''An ArgumentParser that prints help and errors to the given files.
+
+    The standard one uses sys.stdout and sys.stderr, which depfinder_server
+    shares between all of its clients.
+    '''
+
+    def __init__(self, *args, stdout=None, stderr=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stdout = stdout
+        self.stderr = stderr
+
+    def print_usage(self, file=None):
+        super().print_usage(self.stdout if file is None else file)
+
+    def print_help(self, file=None):
+        super().print_help(self.stdout if file is None else file)
+
+    def exit(self, status=0, message=None):
+        if message:
+            (self.stderr or sys.stderr).write(message)
+        sys.exit(status)
+
+    def error(self, message):
+        self.print_usage(self.stderr or sys.stderr)
+        self.exit(2, '{}: error: {}\n'.format(self.prog, message))
+
+
+def main(args, cwd=None, env=None, stdout=None, stderr=None):
+    '''Run depfinder with the given command-line arguments.
+
+    By default, the command runs in the current directory and environment,
+    and results are written to sys.stdout (and usage errors to sys.stderr).
+    Otherwise (e.g. when serving a client; see depfinder_server), the given
+    cwd, env, stdout and stderr are used, and relative paths in args are
+    relative to cwd.
+    '''
+    parser = ArgumentParser(
+        description='Find the files a command depends on, by tracing it.',
+        stdout=stdout, stderr=stderr)
+    parser.add_argument(
+        '--cache', metavar='FILE',
+        help='reuse the trace stored in FILE, unless its inputs changed')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=None,
+        help='number of threads checking inputs with --cache')
+    parser.add_argument(
+        '--live', metavar='OUTPUT',
+        help='report paths as they are discovered, to OUTPUT (a file, '
+             '"-" for stdout, or "unix:PATH" for a Unix socket)')
+    parser.add_argument(
+        '--include', metavar='PREFIX', action='append', default=[],
+        help='report paths under PREFIX (overrides shorter --exclude)')
+    parser.add_argument(
+        '--exclude', metavar='PREFIX', action='append', default=[],
+        help='do not report paths under PREFIX (e.g. /usr or /proc)')
+    parser.add_argument(
+        '--record', metavar='FILE',
+        help='also save the raw strace output to FILE (gzip-compressed)')
+    parser.add_argument(
+        '--replay', metavar='FILE',
+        help='analyze the strace output saved by --record, instead of '
+             'running a command')
+    parser.add_argument(
+        '--tolerant', action='store_true',
+        help='skip (and count) strace output that cannot be parsed, instead '
+             'of aborting')
+    parser.add_argument(
+        '--parse-process', action='store_true',
+        help='parse strace output in a separate process, in parallel with '
+             'analyzing it')
+    parser.add_argument(
+        '--realpath', action='store_true',
+        help='canonicalize paths, resolving ".." and symlinked directories')
+    parser.add_argument(
+        '--summary', metavar='DEPTH', type=int,
+        help='summarize paths per directory, DEPTH levels deep')
+    parser.add_argument(
+        '-f', '--format', choices=['text', 'json', 'nul', 'make'],
+        default='text',
+        help='output format: human-readable text (default), JSON, the '
+             'input paths separated by NUL bytes, or a Makefile .d rule')
+    parser.add_argument(
+        '-o', '--output', metavar='FILE', default='-',
+        help='write the dependencies to FILE instead of stdout')
+    parser.add_argument(
+        '--target', metavar='NAME', action='append',
+        help='target of the .d rule (default: the written paths)')
+    parser.add_argument('command', nargs=argparse.REMAINDER)
+    opts = parser.parse_args(args)
+    if opts.replay:
+        if opts.command or opts.cache or opts.record:
+            parser.error('--replay cannot be combined with a command, '
+                         '--cache or --record')
+    elif not opts.command:
+        parser.error('no command given')
+    if opts.cache and (opts.live or opts.record):
+        parser.error('--cache cannot be combined with --live or --record')
+    if cwd is not None:
+        for name in ['cache', 'record', 'replay', 'output', 'live']:
+            value = getattr(opts, name)
+            if value is not None and value != '-':
+                if value.startswith('unix:'):
+                    value = 'unix:' + os.path.join(cwd, value[5:])
+                else:
+                    value = os.path.join(cwd, value)
+                setattr(opts, name, value)
+    # --include/--exclude prefixes are relative to where we were started
+    base = os.getcwd() if cwd is None else cwd
+    opts.include = [os.path.join(base, prefix) for prefix in opts.include]
+    opts.exclude = [os.path.join(base, prefix) for prefix in opts.exclude]
+    if stdout is None:
+        stdout = sys.stdout
+
+    def new_trie():
+        return PathTrie(opts.include, opts.exclude)
+
+    # Paths that are filtered out are never recorded in the ProcessTrace
+    path_filter = new_trie().allows if opts.include or opts.exclude else None
+    resolver = RealpathCache() if opts.realpath else None  # per trace
+    if opts.cache:
+        events = None
+    elif opts.replay:
+        events = replay_trace(opts.replay, tolerant=opts.tolerant)
+        # Relative paths in the trace are relative to where it was recorded
+        cwd = recording_info(opts.replay).get('cwd', cwd)
+    else:
+        events = run_trace(
+            opts.command, tolerant=opts.tolerant, record=opts.record,
+            parse_process=opts.parse_process, cwd=cwd, env=env)
+
+    if opts.cache:
+        p = cached_trace(opts.command, opts.cache, opts.jobs, opts.tolerant,
+                         opts.parse_process, cwd=cwd, env=env)
+        # The cached trace is recorded unfiltered, so that its stamps cover
+        # all inputs, whatever the filter in later runs
+        p = p.collapsed(path_filter, resolver)
+    elif opts.live:
+        live = open_live_output(opts.live, stdout)
+        report = LiveReport(live, path_filter=path_filter, resolver=resolver)
+        try:
+            p = ProcessTrace.from_events(
+                events, cwd=cwd, evict=True, on_event=report,
+                path_filter=path_filter, resolver=resolver)
+        finally:
+            report.close()
+            if live is not stdout:
+                live.close()
+    else:
+        p = ProcessTrace.from_events(
+            events, cwd=cwd, evict=True, path_filter=path_filter,
+            resolver=resolver)
     p = p.collapsed()
+    deps = classify(p, new_trie)
 
-    written = set(t[1] for t in p.paths_written)
-    read = set(t[1] for t in p.paths_read)
-    present = set(t[1] for t in p.paths_checked if t[2])
-    missing = set(t[1] for t in p.paths_checked if not t[2])
-
-    present -= written | read
-    missing -= written | read
-
-    print('The command:\n    {}'.format(
-         ' '.join(shlex.quote(a) for a in p.argv)))
-    if written:
-        print('writes these paths:')
-        for path in sorted(written):
-            print('    {}'.format(path))
-    if written:
-        print('reads these paths:')
-        for path in sorted(read):
-            print('    {}'.format(path))
-    if present:
-        print('depends on the existence of these paths:')
-        for path in sorted(present):
-            print('    {}'.format(path))
-    if missing:
-        print('depends on the non-existence of these paths:')
-        for path in sorted(missing):
-            print('    {}'.format(path))
+    if opts.format == 'make' and not opts.target and not deps.written:
+        parser.error('no paths were written; use --target to name the '
+                     'target of the .d rule')
+    mode = 'wb' if opts.format == 'nul' else 'w'
+    if opts.output != '-':
+        f = open(opts.output, mode)
+    elif mode == 'wb':
+        stdout.flush()
+        f = stdout.buffer
+    else:
+        f = stdout
+    try:
+        if opts.format == 'text':
+            write_text(f, p.argv, deps, opts.summary)
+        elif opts.format == 'json':
+            write_json(f, p.argv, deps)
+        elif opts.format == 'nul':
+            write_nul(f, deps)
+        elif opts.format == 'make':
+            write_make_deps(f, deps, opts.target)
+    finally:
+        if opts.output != '-':
+            f.close()
+        else:
+            f.flush()
 
 
 if __name__ == '__main__':
-    import sys
+    logging.basicConfig(level=logging.WARNING)
     sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+'''Run depfinder in a long-lived server, and send it requests from clients.
+
+Starting Python and importing depfinder for every build step is
+expensive. Instead, start a server once:
+
+    depfinder_server.py --serve SOCKET [-j JOBS]
+
+and replace 'depfinder.py ARGS...' with the thin client:
+
+    depfinder_server.py SOCKET ARGS...
+
+The client passes its stdout and stderr (as file descriptors), cwd,
+environment and arguments over the Unix socket SOCKET. The server runs
+depfinder.main() on a pool of worker threads, so that Python starts and
+imports depfinder only once, and results (and usage errors) are written
+straight to the client's stdout (and stderr). Nothing else is shared: every
+request starts with fresh caches (e.g. the realpath cache used by
+--realpath), as the files may have changed since the previous one. The
+client exits with the status of depfinder.main().
+'''
+
+import argparse
+import errno
+import json
+import logging
+import os
+import socket
+import sys
+
+from lazy_modules import lazy
+
+
+logger = logging.getLogger('depfinder_server')
+
+
+def _read_all(sock):
+    chunks = []
+    for chunk in iter(lambda: sock.recv(1 << 16), b''):
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def request(path, args, cwd=None, env=None, stdout=None, stderr=None):
+    '''Ask the server listening on path to run depfinder with args.
+
+    The server runs in the given cwd and env (by default: ours), and writes
+    to the file descriptors stdout and stderr (by default: ours). Return the
+    exit status.
+    '''
+    req = {
+        'args': args,
+        'cwd': os.getcwd() if cwd is None else cwd,
+        'env': dict(os.environ) if env is None else env,
+    }
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        socket.send_fds(s, [b'F'], [
+            sys.stdout.fileno() if stdout is None else stdout,
+            sys.stderr.fileno() if stderr is None else stderr])
+        s.sendall(json.dumps(req).encode('utf-8'))
+        s.shutdown(socket.SHUT_WR)
+        return json.loads(_read_all(s).decode('utf-8'))['status']
+
+
+def _remove_stale_socket(path):
+    '''Remove the socket left at path by a server that is gone.
+
+    Raise OSError (EADDRINUSE) if a server still listens on it.
+    '''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(path)
+        except FileNotFoundError:
+            return
+        except ConnectionRefusedError:
+            os.unlink(path)  # nobody listens on it
+            return
+    raise OSError(errno.EADDRINUSE, 'A server already listens on', path)
+
+
+class Server:
+    '''Serve depfinder requests on a Unix socket, on a pool of threads.'''
+
+    def __init__(self, path, jobs=None):
+        self.path = path
+        _remove_stale_socket(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen()
+        self.pool = lazy.futures.ThreadPoolExecutor(max_workers=jobs)
+
+    def serve_one(self):
+        '''Accept a connection, and hand it over to the worker pool.'''
+        conn, _ = self.sock.accept()
+        self.pool.submit(self.handle, conn)
+
+    def serve_forever(self):
+        logger.info('Serving on {}'.format(self.path))
+        while True:
+            self.serve_one()
+
+    def close(self):
+        '''Stop listening, and wait for the requests being handled.'''
+        self.sock.close()
+        os.unlink(self.path)
+        self.pool.shutdown()
+
+    def handle(self, conn):
+        depfinder = lazy.depfinder  # not needed by the client
+
+        with conn:
+            _, fds, _, _ = socket.recv_fds(conn, 1, 2)
+            if not fds:  # not a client, e.g. _remove_stale_socket() probing
+                return
+            # Own the fds before anything else can fail
+            stdout, stderr = open(fds[0], 'w'), open(fds[1], 'w')
+            try:
+                req = json.loads(_read_all(conn).decode('utf-8'))
+                status = depfinder.main(
+                    req['args'], cwd=req['cwd'], env=req['env'],
+                    stdout=stdout, stderr=stderr)
+            except SystemExit as e:  # e.g. from argparse
+                status = e.code
+            except Exception:
+                logger.exception('Failed to handle request')
+                status = 1
+            finally:
+                stdout.close()
+                stderr.close()
+            if status is None:
+                status = 0
+            elif not isinstance(status, int):
+                status = 1
+            conn.sendall(json.dumps({'status': status}).encode('utf-8'))
+
+
+def main(args):
+    if args[:1] != ['--serve']:
+        if not args:
+            sys.exit('usage: {0} --serve SOCKET [-j JOBS]\n'
+                     '       {0} SOCKET [depfinder args...]'.format(
+                         sys.argv[0]))
+        return request(args[0], args[1:])
+
+    parser = argparse.ArgumentParser(
+        description='Serve depfinder requests on a Unix socket.')
+    parser.add_argument('--serve', metavar='SOCKET', required=True)
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=None,
+        help='number of requests handled concurrently')
+    opts = parser.parse_args(args)
+    server = Server(opts.serve, opts.jobs)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(main(sys.argv[1:]))
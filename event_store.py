@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+'''Columnar store of traced file accesses, for querying huge traces.
+
+Usage: event_store.py [--path PATH]... [--pid PID]... (--replay FILE | CMD...)
+'''
+
+import argparse
+from array import array
+from pathlib import Path
+import sys
+
+from process_trace import ProcessTrace
+from strace_helper import replay_trace, run_trace
+
+
+class EventStore:
+    '''Store file access events in columns, indexed by path and by process.
+
+    Use as the on_event callback of ProcessTrace.from_events(). Every read,
+    write, check and exec event is appended as a row of (seq, pid,
+    generation, kind, path ID, exists), where seq is the row number, paths
+    are interned as integer IDs, and kind indexes Kinds. A process is keyed
+    by (pid, generation), like in ProcessTable: the n-th process seen with
+    a given pid is its generation n (from 0), so that reused pids are told
+    apart.
+
+    The indexes map each path ID and each process to the numbers of its rows
+    (in order). They are updated as rows are added, so queries are dict
+    lookups, whenever they are made.
+    '''
+
+    Kinds = ('read', 'write', 'check', 'exec')
+
+    def __init__(self):
+        self.path_ids = {}  # path -> path ID
+        self.paths = []  # path ID -> path
+        self.pids = array('l')
+        self.generations = array('l')
+        self.kinds = array('b')
+        self.path_col = array('l')  # path IDs
+        self.exists = array('b')  # 1/0 for 'check' events, else -1
+        self.latest = {}  # pid -> generation of its latest process
+        self._running = {}  # pid -> its ProcessTrace, until it exits
+        self._by_path = {}  # path ID -> array of row numbers
+        self._by_process = {}  # (pid, generation) -> array of row numbers
+
+    def __len__(self):
+        return len(self.pids)
+
+    def __call__(self, p, event, args):
+        if self._running.get(p.pid) is not p:  # a new process
+            self._running[p.pid] = p
+            self.latest[p.pid] = self.latest.get(p.pid, -1) + 1
+        generation = self.latest[p.pid]
+        if event == 'check':
+            exists = int(args[1])
+        elif event in ('read', 'write', 'exec'):
+            exists = -1
+        else:
+            if event == 'exit':
+                del self._running[p.pid]
+            return
+        self.add(p.pid, event, p.cwd / args[0], exists, generation)
+
+    def add(self, pid, kind, path, exists=-1, generation=0):
+        path_id = self.path_ids.get(path)
+        if path_id is None:
+            path_id = self.path_ids[path] = len(self.paths)
+            self.paths.append(path)
+        if generation > self.latest.get(pid, -1):
+            self.latest[pid] = generation
+        seq = len(self.pids)
+        self.pids.append(pid)
+        self.generations.append(generation)
+        self.kinds.append(self.Kinds.index(kind))
+        self.path_col.append(path_id)
+        self.exists.append(exists)
+        self._by_path.setdefault(path_id, array('l')).append(seq)
+        self._by_process.setdefault(
+            (pid, generation), array('l')).append(seq)
+
+    def row(self, seq):
+        '''Return row number seq as a (seq, pid, kind, path, exists) tuple.
+
+        exists is None for events other than 'check'.
+        '''
+        exists = self.exists[seq]
+        return (seq, self.pids[seq], self.Kinds[self.kinds[seq]],
+                self.paths[self.path_col[seq]],
+                None if exists < 0 else bool(exists))
+
+    def by_path(self, path):
+        '''Return the rows (in order) of events accessing the given path.'''
+        path_id = self.path_ids.get(Path(path))
+        if path_id is None:
+            return []
+        return [self.row(seq) for seq in self._by_path[path_id]]
+
+    def by_pid(self, pid, generation=None):
+        '''Return the rows (in order) of events from the given pid.
+
+        With generation given, only those of that process with this pid.
+        '''
+        if generation is not None:
+            seqs = self._by_process.get((pid, generation), [])
+        else:
+            seqs = sorted(
+                seq for generation in range(self.latest.get(pid, -1) + 1)
+                for seq in self._by_process.get((pid, generation), []))
+        return [self.row(seq) for seq in seqs]
+
+    def pids_by_path(self, path, kind=None):
+        '''Return the sorted pids that accessed path (in the given way).'''
+        return sorted(set(
+            row[1] for row in self.by_path(path)
+            if kind is None or row[2] == kind))
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description='Query the file accesses of a traced command.')
+    parser.add_argument(
+        '--path', action='append', default=[],
+        help='show the events accessing PATH')
+    parser.add_argument(
+        '--pid', type=int, action='append', default=[],
+        help='show the events from the process(es) with pid PID')
+    parser.add_argument(
+        '--replay', metavar='FILE',
+        help='load the strace output saved by depfinder --record')
+    parser.add_argument('command', nargs=argparse.REMAINDER)
+    opts = parser.parse_args(args)
+    if bool(opts.replay) == bool(opts.command):
+        parser.error('give either --replay or a command')
+
+    store = EventStore()
+    events = replay_trace(opts.replay) if opts.replay else run_trace(
+        opts.command)
+    ProcessTrace.from_events(events, evict=True, on_event=store)
+    print('{} events, {} paths'.format(len(store), len(store.paths)))
+    for path in opts.path:
+        print('{}:'.format(path))
+        for seq, pid, kind, _, exists in store.by_path(Path.cwd() / path):
+            print('    #{} pid {} {}{}'.format(
+                seq, pid, kind, '' if exists is None else ' ' + str(exists)))
+    for pid in opts.pid:
+        for generation in range(store.latest.get(pid, -1) + 1):
+            print('pid {} (generation {}):'.format(pid, generation))
+            for seq, _, kind, path, exists in store.by_pid(pid, generation):
+                print('    #{} {} {}{}'.format(
+                    seq, kind, path,
+                    '' if exists is None else ' ' + str(exists)))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,34 @@
+'''Modules that are imported on first use.
+
+depfinder may be started once per build step, so importing it (and the
+modules it uses) must stay cheap. Modules that only some options need are
+therefore not imported at the top of a module, but used through 'lazy':
+
+    from lazy_modules import lazy
+
+    with lazy.gzip.open(path) as f:
+        ...
+
+The first access to lazy.gzip imports gzip; later ones are plain attribute
+lookups. test_depfinder checks which modules importing depfinder loads.
+'''
+import sys
+
+
+class LazyModules:
+    '''Import a module on first access to the attribute of the same name.'''
+
+    # attribute -> module, for modules whose name is not an identifier
+    Aliases = {'futures': 'concurrent.futures'}
+
+    def __getattr__(self, name):
+        if name.startswith('__'):  # e.g. __wrapped__, probed by inspect
+            raise AttributeError(name)
+        module_name = self.Aliases.get(name, name)
+        __import__(module_name)
+        module = sys.modules[module_name]
+        setattr(self, name, module)
+        return module
+
+
+lazy = LazyModules()
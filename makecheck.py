@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+import os
+from pathlib import Path
+import re
+import sys
+
+from makeparser import Makefile
+from process_trace import ProcessTrace
+from strace_helper import run_trace
+
+
+class TargetDeps:
+    '''Declared vs. observed dependencies of a single make target.'''
+
+    def __init__(self, rule, cwd, phony=()):
+        self.target = rule.target
+        self.path = cwd / rule.target
+        self.declared = set(cwd / dep for dep in rule.deps if dep not in phony)
+        self.read = set()  # Paths read by this target's recipe
+        self.written = set()  # Paths written by this target's recipe
+        self.checked = set()  # Paths whose (non-)existence was checked
+        self.processes = []  # Collapsed recipe ProcessTrace objects
+
+    def add(self, p):
+        '''Add the file activities of the given collapsed ProcessTrace.'''
+        self.processes.append(p)
+        self.read.update(t[1] for t in p.paths_read)
+        self.written.update(t[1] for t in p.paths_written)
+        self.checked.update(t[1] for t in p.paths_checked)
+
+    def undeclared(self, scope):
+        '''Return paths under 'scope' read by the recipe but not declared.'''
+        return set(
+            path for path in self.read - self.written - self.declared
+            if path != self.path and scope in path.parents)
+
+    def unused(self):
+        '''Return declared dependencies that the recipe never looked at.'''
+        return self.declared - self.read - self.checked
+
+
+class CrossCheck:
+    '''Attribute make's recipe subprocesses to targets in a Makefile.
+
+    Use as the on_event callback of ProcessTrace.from_events() on a trace of
+    make, to attribute the children of the root (make) process in a single
+    streaming pass: each child is collapsed and attributed as soon as it
+    exits. Alternatively, pass collapsed children to .add() directly.
+
+    A child's written paths are looked up in an index of the target paths
+    declared in the Makefile. A child that writes a target path is
+    attributed to that target. Children that write no target path (e.g. the
+    'mkdir -p' preceding the actual compile command) are attributed to the
+    next child that does; this assumes a serial (non -j) build.
+
+    .targets maps target names to TargetDeps objects, and .unattributed
+    lists the collapsed child processes not (yet) attributed to any target.
+    '''
+
+    def __init__(self, makefile, cwd):
+        self.cwd = Path(cwd)
+        self.phony = set()
+        if '.PHONY' in makefile.rules:
+            self.phony.update(makefile.rules['.PHONY'].deps)
+        self.index = dict(  # target path -> Rule object
+            (self.cwd / rule.target, rule)
+            for rule in makefile.rules.values()
+            if rule.is_target and rule.recipe)
+        self.targets = {}  # target name -> TargetDeps
+        self.unattributed = []
+        self.make_pid = None  # pid of the root process
+
+    def __call__(self, p, event, args):
+        if self.make_pid is None:
+            self.make_pid = p.pid
+        elif event == 'exit' and p.ppid == self.make_pid:
+            self.add(p.collapsed())
+
+    def add(self, c):
+        '''Attribute the collapsed child process c.'''
+        rule = None
+        for _, path in c.paths_written:
+            rule = self.index.get(path)
+            if rule is not None:
+                break
+        if rule is None:
+            self.unattributed.append(c)
+            return
+
+        deps = self.targets.get(rule.target)
+        if deps is None:
+            deps = self.targets[rule.target] = TargetDeps(
+                rule, self.cwd, self.phony)
+        for u in self.unattributed:
+            deps.add(u)
+        self.unattributed = []
+        deps.add(c)
+
+
+def cross_check(makefile, make_proc, cwd):
+    '''Attribute the children of an already traced make process.
+
+    See CrossCheck. Return a dict mapping target names to TargetDeps
+    objects, and a list of collapsed child processes that could not be
+    attributed to any target.
+    '''
+    check = CrossCheck(makefile, cwd)
+    for child in make_proc.children:
+        check.add(child.collapsed())
+    return check.targets, check.unattributed
+
+
+def parallel_jobs(make_args, makeflags=''):
+    '''Return True if make would run more than one job at a time.
+
+    Look for -j/--jobs in make_args, and in makeflags (the value of the
+    MAKEFLAGS environment variable, whose first word may be a cluster of
+    single-letter flags without the leading dash).
+    '''
+    words = makeflags.split()
+    if words and not words[0].startswith('-') and '=' not in words[0]:
+        words[0] = '-' + words[0]
+    args = list(make_args) + words
+    for i, arg in enumerate(args):
+        m = _JobsPattern.match(arg)
+        if m is None:
+            continue
+        jobs = m.group(1) or m.group(2) or ''
+        if not jobs and i + 1 < len(args) and args[i + 1].isdigit():
+            jobs = args[i + 1]
+        if jobs != '1':
+            return True
+    return False
+
+
+_JobsPattern = re.compile(r'-[a-zA-Z]*j(\d*)$|--jobs(?:=(\d*))?$')
+
+
+def describe(p):
+    '''Return the command line of ProcessTrace p, for messages.'''
+    if p.argv is not None:
+        return ' '.join(p.argv)
+    if p.executable is not None:
+        return str(p.executable)
+    return 'pid {} (no exec)'.format(p.pid)
+
+
+def main(*make_args):
+    if parallel_jobs(make_args, os.environ.get('MAKEFLAGS', '')):
+        sys.exit('makecheck: cannot attribute processes to targets in a '
+                 'parallel (-j) build; run a serial build instead')
+    cwd = Path.cwd()
+    m = Makefile.parse(*make_args)
+    check = CrossCheck(m, cwd)
+    ProcessTrace.from_events(
+        run_trace(['make'] + list(make_args)), evict=True, on_event=check)
+    targets, unattributed = check.targets, check.unattributed
+
+    def rel(path):
+        try:
+            return path.relative_to(cwd)
+        except ValueError:
+            return path
+
+    for name in sorted(targets.keys()):
+        deps = targets[name]
+        undeclared, unused = deps.undeclared(cwd), deps.unused()
+        if not undeclared and not unused:
+            continue
+        print('{}:'.format(name))
+        for path in sorted(undeclared):
+            print('    undeclared dependency: {}'.format(rel(path)))
+        for path in sorted(unused):
+            print('    unused dependency: {}'.format(rel(path)))
+    for c in unattributed:
+        print('Could not attribute process to any target: {}'.format(
+            describe(c)))
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv[1:]))
@@ -3,11 +3,59 @@
 from subprocess import Popen, PIPE, DEVNULL
 
 
-def call_output_lines(*args, **kwargs):
-    '''Like subprocess.check_output(), but yield output lines, lazily.'''
-    with Popen(*args, stdout=PIPE, universal_newlines=True, **kwargs) as p:
-        for line in p.stdout:
-            yield line.rstrip('\r\n')
+# First bytes of interesting lines in make's database output
+_COMMENT = ord('#')
+_TAB = ord('\t')
+
+# Assignment operators in make's database output
+_AssignOps = {'=', ':=', '::=', '+=', '?=', '!='}
+
+
+def iter_byte_lines(f, chunk_size=1 << 20):
+    '''Yield lines (as bytes, without line endings) from binary file f.
+
+    Read f in large chunks, and split each chunk into lines in one go.
+    Both '\n' and '\r\n' line endings are removed.
+    '''
+    tail = b''
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        chunk = tail + chunk
+        lines = chunk.split(b'\n')
+        tail = lines.pop()
+        if b'\r' in chunk:
+            lines = [line.rstrip(b'\r') for line in lines]
+        yield from lines
+    tail = tail.rstrip(b'\r')
+    if tail:
+        yield tail
+
+
+def call_output_byte_lines(*args, chunk_size=1 << 20, **kwargs):
+    '''Like subprocess.check_output(), but yield output lines, lazily.
+
+    Lines are yielded as undecoded bytes, without line endings.
+    '''
+    with Popen(*args, stdout=PIPE, bufsize=chunk_size, **kwargs) as p:
+        yield from iter_byte_lines(p.stdout, chunk_size)
+
+
+def _decode(b):
+    return b.decode('utf-8', 'surrogateescape')
+
+
+# Comment lines printed by make, and their effect on a Rule object:
+# line -> (attribute, value). Other lines are parsed by
+# Rule._parse_metadata().
+_Metadata = {
+    b'# Not a target:': ('is_target', False),
+    b'#  Phony target (prerequisite of .PHONY).': ('is_phony', True),
+    b'#  Builtin rule': ('is_builtin', True),
+    b'#  File does not exist.': ('exists', False),
+    b'#  recipe to execute (built-in):': (None, None),
+}
 
 
 class Makefile:
@@ -16,14 +64,29 @@ class Makefile:
         def __init__(self):
             self.target = None
             self.deps = []
+            self.order_only_deps = []  # deps following '|'
             self.recipe = []
+            self.recipe_origin = None  # (file, line), or None if built-in
+            self.variables = {}  # target-specific variables: name -> value
             self.is_target = True
+            self.is_phony = False
+            self.is_builtin = False
+            self.double_colon = False
+            self.exists = None  # None if make never checked the file
+            self.last_modified = None  # timestamp string, as printed by make
+            self.notes = []  # all other metadata printed by make
 
         def __str__(self):
             ret = []
             if not self.is_target:
                 ret.append('# Not a target:')
-            ret.append('{}: {}'.format(self.target, ' '.join(self.deps)))
+            deps = list(self.deps)
+            if self.order_only_deps:
+                deps.append('|')
+                deps.extend(self.order_only_deps)
+            ret.append('{}{} {}'.format(
+                self.target, '::' if self.double_colon else ':',
+                ' '.join(deps)))
             for line in self.recipe:
                 ret.append('\t' + line)
             return '\n'.join(ret)
@@ -31,40 +94,186 @@ class Makefile:
         def __lt__(self, other):
             return (self.target, self.deps) < (other.target, other.deps)
 
-    @staticmethod
-    def _parse_vars(lines, stop_at):
+        @property
+        def is_pattern(self):
+            return '%' in self.target
+
+        def _parse_line(self, line):
+            '''Parse a (decoded) target line, or target-specific variable.'''
+            target, _, rest = line.partition(':')
+            if rest.startswith(':'):
+                self.double_colon = True
+                rest = rest[1:]
+            words = rest.split()
+            if len(words) > 1 and words[1] in _AssignOps:
+                # Target-specific variable: "target: NAME := value"
+                op_end = rest.index(words[1]) + len(words[1])
+                self.variables[words[0]] = rest[op_end + 1:]
+            else:
+                self.target = target
+                if '|' in words:
+                    i = words.index('|')
+                    self.deps, self.order_only_deps = words[:i], words[i + 1:]
+                else:
+                    self.deps = words
+
+        def _parse_metadata(self, line):
+            '''Parse a (bytes) line of metadata not in _Metadata.
+
+            Return the decoded line if it was added to .notes, else None.
+            '''
+            if line.startswith(b'#  Last modified '):
+                self.exists = True
+                self.last_modified = _decode(line[17:])
+            elif line.startswith(b'#  recipe to execute (from '):
+                # recipe to execute (from 'Makefile', line 4):
+                origin, _, num = line[28:].rpartition(b"', line ")
+                self.recipe_origin = (_decode(origin), int(num[:-2]))
+            else:
+                note = _decode(line[3:])
+                self.notes.append(note)
+                return note
+            return None
+
+    # Section headers in make's database output -> section parser method
+    _Sections = {
+        b'# Variables': '_parse_vars',
+        b'# Pattern-specific Variable Values': '_parse_pattern_vars',
+        b'# Directories': '_parse_nothing',
+        b'# Implicit Rules': '_parse_implicit_rules',
+        b'# Files': '_parse_files',
+        b'# VPATH Search Paths': '_parse_vpaths',
+    }
+
+    # Section parsers: Consume lines until the next section header, and
+    # return that header (or None at the end of the database).
+
+    def _parse_vars(self, lines):
+        origin = None
         for line in lines:
-            if stop_at(line):
-                break
-            elif not line or line.startswith('#'):
+            if not line:
                 pass
+            elif line[0] == _COMMENT:
+                if line in self._Sections:
+                    return line
+                # "# makefile (from 'Makefile', line 1)" -> "makefile"
+                origin = _decode(line[2:]).split(' (', 1)[0]
+            elif line.startswith(b'define '):
+                k = _decode(line[7:])
+                v = []
+                for line in lines:
+                    if line == b'endef':
+                        break
+                    v.append(_decode(line))
+                self.variables[k] = '\n'.join(v)
+                self.variable_origins[k] = origin
             else:
-                k, _, v = line.partition('= ')
-                k = k.rstrip(':').rstrip(' ')
-                yield k, v
+                k, _, v = line.partition(b'= ')
+                k = _decode(k.rstrip(b':').rstrip(b' '))
+                self.variables[k] = _decode(v)
+                self.variable_origins[k] = origin
+        return None
 
-    @classmethod
-    def _parse_rules(cls, lines, stop_at):
-        cur = cls.Rule()
+    def _parse_pattern_vars(self, lines):
+        pattern = None
         for line in lines:
-            if stop_at(line):
-                break
-            elif not line:  # Empty line - between rules
-                if cur.target is not None:
-                    yield cur
-                    cur = cls.Rule()
-            elif line == '# Not a target:':
-                cur.is_target = False
-            elif line.startswith('#'):
+            if not line:
                 pass
-            elif line.startswith('\t'):
+            elif line[0] == _COMMENT:
+                if line in self._Sections:
+                    return line
+                # Variables are printed as comments: "# CFLAGS := -O2"
+                words = line.split(None, 3)
+                if pattern is not None and len(words) > 2:
+                    if _decode(words[2]) in _AssignOps:
+                        v = _decode(words[3]) if len(words) > 3 else ''
+                        self.pattern_variables[pattern][_decode(words[1])] = v
+            elif line.endswith(b' :'):
+                pattern = _decode(line[:-2])
+                self.pattern_variables.setdefault(pattern, {})
+        return None
+
+    def _parse_nothing(self, lines):
+        for line in lines:
+            if line in self._Sections:
+                return line
+        return None
+
+    def _parse_rules(self, lines, add):
+        notes = {}  # metadata line -> decoded note, as they repeat a lot
+        cur = self.Rule()
+        for line in lines:
+            if not line:  # Empty line - between rules
+                if cur.target is not None:
+                    add(cur)
+                    cur = self.Rule()
+            elif line[0] == _COMMENT:
+                meta = _Metadata.get(line)
+                if meta is not None:
+                    attr, value = meta
+                    if attr is not None:
+                        setattr(cur, attr, value)
+                elif line in notes:
+                    cur.notes.append(notes[line])
+                elif line.startswith(b'#  '):
+                    note = cur._parse_metadata(line)
+                    if note is not None:
+                        notes[line] = note
+                elif line in self._Sections:
+                    assert cur.target is None
+                    return line
+            elif line[0] == _TAB:
                 assert cur.target is not None
-                cur.recipe.append(line[1:])
+                cur.recipe.append(_decode(line[1:]))
             else:
-                cur.target, dep_s = line.split(':', 1)
-                cur.deps = dep_s.split()
+                cur._parse_line(_decode(line))
 
         assert cur.target is None
+        return None
+
+    def _parse_implicit_rules(self, lines):
+        return self._parse_rules(lines, self.implicit_rules.append)
+
+    def _parse_files(self, lines):
+        def add(rule):
+            if rule.double_colon:
+                self.double_colon_rules.setdefault(rule.target, []).append(
+                    rule)
+                self.rules.setdefault(rule.target, rule)
+            else:
+                self.rules[rule.target] = rule
+
+        return self._parse_rules(lines, add)
+
+    def _parse_vpaths(self, lines):
+        for line in lines:
+            if line in self._Sections:
+                return line
+            elif line.startswith(b'vpath '):
+                _, pattern, dirs = _decode(line).split(None, 2)
+                self.vpaths.append((pattern, dirs.split(':')))
+        return None
+
+    @classmethod
+    def parse_lines(cls, lines):
+        '''Create a Makefile object from lines of make's database output.
+
+        The given lines are bytes objects without line endings, as generated
+        by iter_byte_lines(). All sections of the database are parsed in a
+        single pass over the lines.
+        '''
+        ret = cls()
+        lines = iter(lines)
+        section = None
+        for line in lines:
+            if line in cls._Sections:
+                section = line
+                break
+
+        while section is not None:
+            section = getattr(ret, cls._Sections[section])(lines)
+
+        return ret
 
     @classmethod
     def parse(cls, *make_args):
@@ -75,24 +284,17 @@ class Makefile:
         new Makefile instance. Any arguments passed to this method are passed
         on to the make command line.
         '''
-        ret = cls()
         argv = ['make', '--print-data-base', '--question'] + list(make_args)
-        lines = call_output_lines(argv, stderr=DEVNULL)
-        for line in lines:
-            if line == '# Variables':
-                break
-
-        ret.variables = dict(cls._parse_vars(
-            lines, lambda l: l == '# Implicit Rules'))
-
-        rule_gen = cls._parse_rules(lines, lambda l: False)
-        ret.rules = dict((r.target, r) for r in rule_gen)
-
-        return ret
+        return cls.parse_lines(call_output_byte_lines(argv, stderr=DEVNULL))
 
     def __init__(self):
         self.variables = {}  # key -> value
-        self.rules = {}  # target name -> Rule object
+        self.variable_origins = {}  # key -> 'makefile', 'environment', etc.
+        self.pattern_variables = {}  # pattern -> {key -> value}
+        self.implicit_rules = []  # pattern rules, in make's order
+        self.rules = {}  # target name -> (first) Rule object
+        self.double_colon_rules = {}  # target name -> all its '::' Rules
+        self.vpaths = []  # (pattern, [directories]) from vpath directives
 
 
 def main(*make_args):
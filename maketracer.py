@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+from subprocess import DEVNULL
+import sys
+
+from makeparser import Makefile
+from process_trace import ProcessTrace
+from strace_helper import run_trace
+
+
+def trace_target(target, deps, make_args=()):
+    '''Trace the recipe for a single make target, in isolation.
+
+    Force make to rebuild 'target' while treating its direct dependencies
+    as up-to-date, so that only the recipe for 'target' itself is run.
+    Return the collapsed ProcessTrace of the make invocation.
+    '''
+    argv = ['make', '--always-make']
+    argv.extend('--assume-old={}'.format(dep) for dep in deps)
+    argv.extend(make_args)
+    argv.append(target)
+    p = ProcessTrace.from_events(
+        run_trace(argv, stdout=DEVNULL, stderr=DEVNULL))
+    return p.collapsed()
+
+
+def recipe_graph(makefile, targets=None):
+    '''Return the dependency graph between targets that have a recipe.
+
+    Return a dict mapping each target name (from 'targets', or all real
+    targets in 'makefile') to the set of targets with recipes that must be
+    built before it. Dependencies on targets without a recipe (e.g. 'all')
+    are followed transitively. Raise ValueError if any of the given targets
+    has no rule in 'makefile'.
+    '''
+    rules = makefile.rules
+
+    def has_recipe(name):
+        rule = rules.get(name)
+        return rule is not None and rule.is_target and bool(rule.recipe)
+
+    def recipe_deps(name, seen):
+        rule = rules.get(name)
+        deps = [] if rule is None else rule.deps + rule.order_only_deps
+        for dep in deps:
+            if dep in seen:
+                continue
+            seen.add(dep)
+            if has_recipe(dep):
+                yield dep
+            else:
+                yield from recipe_deps(dep, seen)
+
+    if targets is None:
+        targets = [
+            name for name in rules
+            if has_recipe(name) and not name.startswith('.')]
+    else:
+        unknown = [name for name in targets if name not in rules]
+        if unknown:
+            raise ValueError('No rule for target(s) {}'.format(
+                ', '.join(unknown)))
+
+    graph = {}
+    todo = list(targets)
+    while todo:
+        name = todo.pop()
+        if name in graph:
+            continue
+        graph[name] = set(recipe_deps(name, {name}))
+        todo.extend(graph[name])
+    return graph
+
+
+def trace_targets(makefile, make_args=(), targets=None, jobs=None,
+                  progress=None, pool=None, trace=trace_target):
+    '''Trace each target's recipe in isolation, in dependency order.
+
+    Walk the recipe_graph() of the given Makefile, and submit each target
+    to a pool of 'jobs' worker processes as soon as all the targets it
+    depends on have been traced. 'progress' is called as progress(done,
+    total, target, result) after each target finishes. Return a dict
+    mapping target names to collapsed ProcessTrace objects. Raise
+    ValueError for unknown targets, or circular dependencies.
+    '''
+    graph = recipe_graph(makefile, targets)
+    waiting = dict((name, set(deps)) for name, deps in graph.items())
+    dependents = {}  # target -> set of targets waiting for it
+    for name, deps in graph.items():
+        for dep in deps:
+            dependents.setdefault(dep, set()).add(name)
+
+    if pool is None:
+        pool = ProcessPoolExecutor(max_workers=jobs)
+    results = {}
+    running = {}  # future -> target
+    with pool:
+        while waiting or running:
+            for name in sorted(n for n, deps in waiting.items() if not deps):
+                del waiting[name]
+                rule = makefile.rules[name]
+                deps = rule.deps + rule.order_only_deps
+                future = pool.submit(trace, name, deps, make_args)
+                running[future] = name
+            if not running:
+                raise ValueError('Circular dependencies between {}'.format(
+                    ', '.join(sorted(waiting.keys()))))
+
+            finished, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                results[name] = future.result()
+                for dependent in dependents.get(name, ()):
+                    waiting[dependent].discard(name)
+                if progress is not None:
+                    progress(len(results), len(graph), name, results[name])
+
+    return results
+
+
+def main(*args):
+    parser = argparse.ArgumentParser(
+        description='Trace the recipe of each make target in isolation.')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=None,
+        help='number of targets to trace in parallel (default: #CPUs)')
+    parser.add_argument(
+        '-t', '--target', action='append', dest='targets', metavar='TARGET',
+        help='trace this target (and the targets it depends on); may be '
+             'repeated (default: all targets)')
+    parser.add_argument(
+        'make_args', nargs=argparse.REMAINDER,
+        help='arguments passed on to make')
+    opts = parser.parse_args(args)
+
+    def report_progress(done, total, target, p):
+        print('[{}/{}] {} (exit code {})'.format(
+            done, total, target, p.exit_code), file=sys.stderr)
+
+    cwd = Path.cwd()
+    m = Makefile.parse(*opts.make_args)
+    try:
+        results = trace_targets(
+            m, opts.make_args, opts.targets, jobs=opts.jobs,
+            progress=report_progress)
+    except ValueError as e:
+        parser.error(str(e))
+    for target in sorted(results.keys()):
+        p = results[target]
+        deps = set(
+            t[1].relative_to(cwd) for t in p.paths_read
+            if cwd in t[1].parents)
+        print('{} <- {}'.format(target, ', '.join(map(str, sorted(deps)))))
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv[1:]))
@@ -0,0 +1,136 @@
+from pathlib import PurePath
+
+
+def _parts(path):
+    # Avoid re-parsing paths that are already PurePath (or Path) instances
+    return path.parts if isinstance(path, PurePath) else PurePath(path).parts
+
+
+class PathTrie:
+    '''A set of absolute paths, stored as a tree of path components.
+
+    Paths can be filtered at insertion time by include/exclude prefix rules:
+    the rule with the longest prefix matching a path decides whether it is
+    stored. Paths matching no rule are stored, unless there are include
+    rules, but no exclude rules.
+
+    Iterating over a PathTrie yields its paths in sorted order.
+
+    >>> t = PathTrie(exclude=['/usr', '/proc'], include=['/usr/local'])
+    >>> for path in ['/usr/lib/libc.so', '/usr/local/lib/libfoo.so', '/a/b',
+    ...              '/proc/meminfo', '/a/c/d']:
+    ...     _ = t.add(path)
+    >>> [str(path) for path in t]
+    ['/a/b', '/a/c/d', '/usr/local/lib/libfoo.so']
+    >>> len(t), '/a/b' in t, '/usr/lib/libc.so' in t
+    (3, True, False)
+    '''
+
+    class Node:
+        __slots__ = ('children', 'end', 'count')
+
+        def __init__(self):
+            self.children = {}  # path component -> Node
+            self.end = False  # True iff a path ends at this node
+            self.count = 0  # number of paths ending at or below this node
+
+    def __init__(self, include=(), exclude=()):
+        self.root = self.Node()
+        self.rules = {}  # trie of rule prefixes; None key holds the verdict
+        self.default = bool(exclude) or not include
+        for prefix in include:
+            self._add_rule(prefix, True)
+        for prefix in exclude:
+            self._add_rule(prefix, False)
+
+    def _add_rule(self, prefix, verdict):
+        if not PurePath(prefix).is_absolute():
+            raise ValueError('Relative path prefix: {}'.format(prefix))
+        node = self.rules
+        for part in PurePath(prefix).parts:
+            node = node.setdefault(part, {})
+        node[None] = verdict
+
+    def _allows(self, parts):
+        verdict = self.default
+        node = self.rules
+        for part in parts:
+            node = node.get(part)
+            if node is None:
+                break
+            verdict = node.get(None, verdict)
+        return verdict
+
+    def allows(self, path):
+        '''Return True iff the include/exclude rules allow the given path.'''
+        return self._allows(_parts(path))
+
+    def add(self, path):
+        '''Add path, unless filtered. Return True iff path was added.'''
+        parts = _parts(path)
+        if self.rules and not self._allows(parts):
+            return False
+        nodes = [self.root]
+        for part in parts:
+            node = nodes[-1].children.get(part)
+            if node is None:
+                node = nodes[-1].children[part] = self.Node()
+            nodes.append(node)
+        if not nodes[-1].end:
+            nodes[-1].end = True
+            for node in nodes:
+                node.count += 1
+        return True
+
+    def _find(self, path):
+        node = self.root
+        for part in _parts(path):
+            node = node.children.get(part)
+            if node is None:
+                break
+        return node
+
+    def __contains__(self, path):
+        node = self._find(path)
+        return node is not None and node.end
+
+    def __len__(self):
+        return self.root.count
+
+    def __iter__(self):
+        def walk(node, parts):
+            if node.end:
+                yield PurePath(*parts)
+            for part in sorted(node.children.keys()):
+                yield from walk(node.children[part], parts + [part])
+
+        return walk(self.root, [])
+
+    def summary(self, depth):
+        '''Generate (path, count) pairs summarizing the paths in this trie.
+
+        Paths are grouped by their first 'depth' directory levels. Each group
+        is reported by its longest common prefix (a lone path is reported as
+        itself) and the number of paths in the group, in sorted order.
+
+        >>> t = PathTrie()
+        >>> for path in ['/usr/lib/libc.so', '/usr/lib/libm.so', '/etc/hosts',
+        ...              '/usr/include/sys/types.h']:
+        ...     _ = t.add(path)
+        >>> [(str(path), count) for path, count in t.summary(2)]
+        [('/etc/hosts', 1), ('/usr/include/sys/types.h', 1), ('/usr/lib', 2)]
+        '''
+        def walk(node, parts):
+            if len(parts) > depth:
+                # Compress chains of single-child directories
+                while not node.end and len(node.children) == 1:
+                    (part, node), = node.children.items()
+                    parts = parts + [part]
+                yield PurePath(*parts), node.count
+                return
+            if node.end:
+                yield PurePath(*parts), 1
+            for part in sorted(node.children.keys()):
+                yield from walk(node.children[part], parts + [part])
+
+        return walk(self.root, [])
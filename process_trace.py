@@ -1,68 +1,337 @@
-import json
+import logging
+import os
 from pathlib import Path, PurePath
+import stat
+
+from lazy_modules import lazy
+
+
+logger = logging.getLogger(__name__)
+
+
+class PendingEvents:
+    '''Buffer trace events from processes whose 'fork' is not yet seen.
+
+    A child may start generating trace events before its parent's 'fork'
+    has fully completed; on heavily parallel builds, strace may even report
+    a child's whole lifetime before that. Events are kept in memory up to
+    'max_events'; beyond that, the largest per-process queues are spilled
+    to a temporary file.
+
+    Events that follow an 'exit' from the same pid belong to a new process
+    that has reused that pid, and are kept in a separate queue.
+    '''
+
+    class Queue:
+        def __init__(self):
+            self.events = []  # in-memory (event, args) tuples
+            self.spilled = []  # offsets of pickled event lists in spill file
+            self.length = 0  # total number of events, incl. spilled ones
+            self.exited = False
+
+    def __init__(self, max_events=100000):
+        self.max_events = max_events
+        self.queues = {}  # pid -> [Queue, ...], oldest first
+        self.in_memory = 0  # number of events currently held in memory
+        self._spill_file = None
+
+        # Statistics
+        self.max_depth = 0  # max #events buffered for a single process
+        self.peak = 0  # max #events held in memory at any time
+        self.spilled = 0  # total #events spilled to disk
+
+    def __contains__(self, pid):
+        return pid in self.queues
+
+    def add(self, pid, event, args):
+        queues = self.queues.setdefault(pid, [])
+        if not queues or queues[-1].exited:
+            queues.append(self.Queue())
+        q = queues[-1]
+        q.events.append((event, args))
+        q.length += 1
+        q.exited = event == 'exit'
+        self.max_depth = max(self.max_depth, q.length)
+        self.in_memory += 1
+        self.peak = max(self.peak, self.in_memory)
+        if self.in_memory > self.max_events:
+            self._spill()
+
+    def _spill(self):
+        '''Spill in-memory queues to disk, largest first, until half full.'''
+        pickle = lazy.pickle
+
+        if self._spill_file is None:
+            self._spill_file = lazy.tempfile.TemporaryFile()
+        f = self._spill_file
+        f.seek(0, 2)
+        queues = sorted(
+            (q for qs in self.queues.values() for q in qs if q.events),
+            key=lambda q: len(q.events), reverse=True)
+        for q in queues:
+            if self.in_memory <= self.max_events // 2:
+                break
+            q.spilled.append(f.tell())
+            pickle.dump(q.events, f, pickle.HIGHEST_PROTOCOL)
+            self.in_memory -= len(q.events)
+            self.spilled += len(q.events)
+            q.events = []
+
+    def pop(self, pid):
+        '''Remove and generate the buffered events of the oldest 'pid'.'''
+        queues = self.queues.get(pid)
+        if not queues:
+            return
+        q = queues.pop(0)
+        if not queues:
+            del self.queues[pid]
+        self.in_memory -= len(q.events)
+        for offset in q.spilled:  # only then is pickle needed
+            self._spill_file.seek(offset)
+            yield from lazy.pickle.load(self._spill_file)
+        yield from q.events
+
+    def close(self):
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+
+
+class ProcessTable:
+    '''Track the processes in a trace by (pid, generation).
+
+    Every process started with a given pid gets the next generation number
+    for that pid, so that PID reuse on long traces is handled. A process
+    is kept in the table until it and all its descendants have exited.
+
+    With 'evict' set, such a finished process is folded into its parent
+    (see ProcessTrace.absorb()) and dropped, instead of being kept in its
+    parent's .children. Memory use then only depends on the number of
+    running processes and the number of unique paths accessed.
+    '''
+
+    def __init__(self, evict=False):
+        self.evict = evict
+        self.generations = {}  # pid -> latest generation
+        self.running = {}  # pid -> key of running process
+        self.processes = {}  # key -> ProcessTrace, until it has finished
+        self.parents = {}  # key -> key of parent process, or None
+        self.live_children = {}  # key -> number of unfinished children
+        self.exited = set()  # keys of exited, but unfinished processes
+
+    def __getitem__(self, pid):
+        '''Return key of the running process with the given pid.'''
+        return self.running[pid]
+
+    def __contains__(self, pid):
+        return pid in self.running
+
+    def start(self, p, parent=None):
+        '''Add ProcessTrace p, forked from the process keyed by 'parent'.'''
+        if p.pid in self.running:
+            logger.warning('pid {} reused before it exited'.format(p.pid))
+            self.exit(self.running[p.pid])
+        key = (p.pid, self.generations.get(p.pid, -1) + 1)
+        self.generations[p.pid] = key[1]
+        self.running[p.pid] = key
+        self.processes[key] = p
+        self.parents[key] = parent
+        self.live_children[key] = 0
+        if parent is not None:
+            self.live_children[parent] += 1
+            if not self.evict:
+                self.processes[parent].children.append(p)
+        return key
+
+    def exit(self, key):
+        if self.running.get(key[0]) == key:
+            del self.running[key[0]]
+        self.exited.add(key)
+        while key in self.exited and not self.live_children[key]:
+            # key and all its descendants have exited
+            p = self.processes.pop(key)
+            parent = self.parents.pop(key)
+            del self.live_children[key]
+            self.exited.remove(key)
+            if parent is None:
+                break
+            self.live_children[parent] -= 1
+            if self.evict:
+                self.processes[parent].absorb(p)
+            key = parent
+
+    def exit_all(self):
+        '''Treat all remaining processes as exited.'''
+        for key in list(self.processes.keys()):
+            if key in self.processes and key not in self.exited:
+                self.exit(key)
+
+
+class RealpathCache:
+    '''Canonicalize absolute paths, resolving each directory only once.
+
+    Calling an instance with an absolute Path returns the path with '..'
+    components and symlinked directories resolved, like os.path.realpath().
+    The final component is kept as is (a symlink there is a dependency in
+    its own right). Resolved directories are memoized per directory, so
+    all paths below an already seen directory cost a single dict lookup.
+
+    Directories that do not exist (yet) are not memoized, as the traced
+    command may still create them, possibly as symlinks. Symlinks that are
+    replaced while the cache is in use are not noticed, so use a new
+    instance for each trace.
+
+    Paths under /proc are returned unchanged, as resolving /proc/self and
+    friends here would describe this process, and not the traced one.
+    '''
+
+    def __init__(self):
+        self.dirs = {}  # directory Path -> canonical directory Path
+
+    def _resolve_dir(self, d):
+        '''Return (canonical d, whether that can be memoized).'''
+        ret = self.dirs.get(d)
+        if ret is not None:
+            return ret, True
+        if d.parent == d:  # root
+            ret, memoize = d, True
+        else:
+            parent, memoize = self._resolve_dir(d.parent)
+            if d.name == '..':
+                ret = parent.parent
+            else:
+                ret = parent / d.name
+                try:
+                    st = os.lstat(str(ret))
+                except OSError:
+                    memoize = False
+                else:
+                    if stat.S_ISLNK(st.st_mode):
+                        ret = Path(os.path.realpath(str(ret)))
+        if memoize:
+            self.dirs[d] = ret
+        return ret, memoize
+
+    def __call__(self, path):
+        if path.parts[1:2] == ('proc',):
+            return path
+        if path.name in ('', '..'):
+            return self._resolve_dir(path)[0]
+        return self._resolve_dir(path.parent)[0] / path.name
 
 
 class ProcessTrace:
     '''Summarize trace events from a process.'''
 
     @classmethod
-    def from_events(cls, events, cwd=None):
+    def from_events(cls, events, cwd=None, pending=None, evict=False,
+                    on_event=None, path_filter=None, resolver=None):
         '''Build a tree of ProcessTrace objecs from the given trace events.
 
         Return the first/root ProcessTrace instance; the others can be found by
-        traversing root.children.
+        traversing root.children. Events from processes whose 'fork' has not
+        been seen yet are buffered in 'pending' (a PendingEvents instance).
+
+        With 'evict' set, the file activities of each subtree of processes
+        are collapsed into its parent as soon as the whole subtree has exited
+        (see ProcessTable), and the returned root has no children.
+
+        If given, on_event(process, event, args) is called after each event
+        has been handled by its ProcessTrace instance.
+
+        If given, only paths (made absolute) for which path_filter(path)
+        returns True are recorded by the ProcessTrace instances.
+
+        If given, resolver(path) canonicalizes each (absolute) path before it
+        is filtered and recorded; see RealpathCache.
         '''
+        if pending is None:
+            pending = PendingEvents()
+        table = ProcessTable(evict)
+
         # Establish root process. Every other process hangs off this one.
         pid, event, args = next(events)
-        root = ProcessTrace(pid=pid, cwd=cwd)
-        getattr(root, event)(*args)  # handle first trace event
-
-        running = {pid: root}  # pid -> ProcessTrace for running processes
-        pending = {}  # pid -> [events...] for "not-yet-running" processes
+        root = ProcessTrace(pid=pid, cwd=cwd, path_filter=path_filter,
+                            resolver=resolver)
+        root_key = table.start(root)
 
-        for pid, event, args in events:
-            if pid not in running:
-                # A child may start generating trace events before its parent's
-                # 'fork' has fully completed.
-                pending.setdefault(pid, []).append((event, args))
-                continue
-            assert pid in running
-            p = running[pid]
+        def handle(key, event, args):
+            p = table.processes[key]
             getattr(p, event)(*args)  # handle trace event
+            if on_event is not None:
+                on_event(p, event, args)
 
             if event == 'fork':
                 cpid = args[0]
-                c = ProcessTrace(pid=cpid, ppid=pid, cwd=p.cwd)
-                assert cpid not in running
-                running[cpid] = c
-                p.children.append(c)
+                c = ProcessTrace(pid=cpid, ppid=p.pid, cwd=p.cwd,
+                                 path_filter=path_filter,
+                                 resolver=resolver,
+                                 started=args[1] if len(args) > 1 else None)
+                c._env_base = p._env_base  # see .env
+                ckey = table.start(c, key)
 
                 # Finally, handle any pending events that the child may posted
                 # in the meantime
-                if cpid in pending:
-                    for event, args in pending[cpid]:
-                        getattr(c, event)(*args)  # handle trace event
-                    del pending[cpid]
-            if event == 'exit':
-                del running[pid]
-
-        assert not running  # all processes have exited
-        assert not pending  # no pending events
+                for event, args in pending.pop(cpid):
+                    handle(ckey, event, args)
+            elif event == 'exit':
+                table.exit(key)
+
+        handle(root_key, event, args)  # handle first trace event
+        for pid, event, args in events:
+            if pid not in table:
+                pending.add(pid, event, args)
+            else:
+                handle(table[pid], event, args)
+
+        if table.running:
+            logger.warning('Processes never exited: {}'.format(
+                ', '.join(map(str, sorted(table.running.keys())))))
+        orphans = []
+        for pid in sorted(pending.queues.keys()):
+            # Degrade gracefully: attach orphaned events to the root process
+            logger.warning('Events from pid {} without a fork'.format(pid))
+            while pid in pending:
+                c = ProcessTrace(pid=pid, cwd=root.cwd,
+                                 path_filter=path_filter,
+                                 resolver=resolver)
+                orphans.append(c)
+                key = table.start(c)
+                for event, args in pending.pop(pid):
+                    handle(key, event, args)
+        table.exit_all()
+        for c in orphans:
+            if evict:
+                root.absorb(c)
+            else:
+                root.children.append(c)
+
+        pending.close()
+        logger.info(
+            'Reordered events: max depth {}, peak {} in memory, {} spilled to '
+            'disk'.format(pending.max_depth, pending.peak, pending.spilled))
         return root
 
     def __init__(self, pid=None, ppid=None, cwd=None, executable=None,
                  argv=None, env=None, paths_read=None, paths_written=None,
-                 paths_checked=None, exit_code=None):
+                 paths_checked=None, exit_code=None, path_filter=None,
+                 resolver=None, started=None, exited=None):
         self.pid = pid
         self.ppid = ppid
         self.cwd = Path.cwd() if cwd is None else Path(cwd)
         self.executable = None if executable is None else self.cwd / executable
         self.argv = argv
+        self._env_base = None  # environment shared with the parent process
+        self._env_delta = None  # changes to _env_base, None if no env
         self.env = env
         self.paths_read = set()  # Paths read by this process
         self.paths_written = set()  # Paths written by this process
         self.paths_checked = set()  # Paths whose (non-)existence was checked
         self.exit_code = exit_code
+        self.started = started  # time of fork (or first exec), if known
+        self.exited = exited  # time of exit, if known
+        self._path_filter = path_filter  # record only paths it accepts
+        self._resolver = resolver  # canonicalizes paths before recording
         self.children = []  # List of child processes forked from this one
 
         if paths_read is not None:
@@ -77,6 +346,62 @@ class ProcessTrace:
             for path, exists in paths_checked:
                 self.check(path, exists)
 
+    @property
+    def env(self):
+        '''The environment of the first exec(), or None.
+
+        To save memory, only the changes relative to a base environment are
+        stored. The base is inherited from the parent process, so a child
+        with the same (or a slightly modified) environment costs little.
+        '''
+        if self._env_delta is None:
+            return None
+        if not self._env_delta:
+            return self._env_base
+        env = dict(self._env_base)
+        for name, value in self._env_delta.items():
+            if value is None:
+                del env[name]
+            else:
+                env[name] = value
+        return env
+
+    @env.setter
+    def env(self, env):
+        base = self._env_base
+        if env is None:
+            self._env_delta = None
+            return
+        if base is None or env is base:
+            self._env_base, self._env_delta = env, {}
+            return
+        delta = {name: value for name, value in env.items()
+                 if base.get(name) != value}
+        delta.update((name, None) for name in base if name not in env)
+        if len(delta) > len(env) // 2:  # not worth it; use env as base
+            self._env_base, delta = env, {}
+        self._env_delta = delta
+
+    @classmethod
+    def from_json(cls, s):
+        '''Recreate a tree of ProcessTrace objects from the output of .json().
+        '''
+        def load(d):
+            p = cls(pid=d['pid'], ppid=d['ppid'], cwd=d['cwd'],
+                    executable=d['executable'], argv=d['argv'], env=d['env'],
+                    exit_code=d['exit_code'], started=d.get('started'),
+                    exited=d.get('exited'))
+            p.paths_read = set((s, Path(path)) for s, path in d['paths_read'])
+            p.paths_written = set(
+                (s, Path(path)) for s, path in d['paths_written'])
+            p.paths_checked = set(
+                (s, Path(path), exists)
+                for s, path, exists in d['paths_checked'])
+            p.children = [load(c) for c in d['children']]
+            return p
+
+        return load(lazy.json.loads(s))
+
     def json(self):
         def default(o):
             if isinstance(o, ProcessTrace):
@@ -84,6 +409,7 @@ class ProcessTrace:
                 for k in list(d.keys()):
                     if k.startswith('_'):
                         del d[k]
+                d['env'] = o.env
                 return d
             elif isinstance(o, PurePath):
                 return str(o)
@@ -91,13 +417,18 @@ class ProcessTrace:
                 return list(sorted(o))
             raise TypeError(o)
 
-        return json.dumps(self, indent=4, sort_keys=True, default=default)
+        return lazy.json.dumps(
+            self, indent=4, sort_keys=True, default=default)
 
-    def collapsed(self):
+    def collapsed(self, path_filter=None, resolver=None):
         '''Return a copy of self with all children's file activities collapsed.
 
         Create a copy of self with all its children's file reads/writes/checks
         collapsed into the copy, and with its .children emptied.
+
+        If path_filter and/or resolver are given (see from_events()), all
+        paths are recorded anew through them, e.g. to filter a trace that
+        was recorded unfiltered.
         '''
         ret = self.__class__(
             pid=self.pid,
@@ -106,23 +437,48 @@ class ProcessTrace:
             executable=self.executable,
             argv=self.argv,
             env=self.env,
-            exit_code=self.exit_code)
+            exit_code=self.exit_code,
+            path_filter=path_filter or self._path_filter,
+            resolver=resolver or self._resolver,
+            started=self.started,
+            exited=self.exited)
+        refilter = path_filter is not None or resolver is not None
 
         def copy_activities(p):
-            ret.paths_read |= p.paths_read
-            ret.paths_written |= p.paths_written
-            ret.paths_checked |= p.paths_checked
-            # Add child executable to read set, to not lose track of it
-            ret.read(p.executable)
+            if refilter:
+                for _, path in p.paths_read:
+                    ret.read(path)
+                for _, path in p.paths_written:
+                    ret.write(path)
+                for _, path, exists in p.paths_checked:
+                    ret.check(path, exists)
+                if p.executable is not None:
+                    ret.read(p.executable)
+            else:
+                ret.absorb(p)
             for c in p.children:
                 copy_activities(c)
 
         copy_activities(self)
         return ret
 
+    def absorb(self, other):
+        '''Add the file activities of ProcessTrace other to self.
+
+        other's executable is added to self's read set, to not lose track of
+        it. other's children are not considered.
+        '''
+        self.paths_read |= other.paths_read
+        self.paths_written |= other.paths_written
+        self.paths_checked |= other.paths_checked
+        if other.executable is not None:
+            self.read(other.executable)
+
     # Trace event handlers
 
-    def exec(self, executable, argv, env):
+    def exec(self, executable, argv, env, timestamp=None):
+        if self.started is None:
+            self.started = timestamp
         if self.executable is None:  # first exec(), typically following fork()
             assert self.argv is None
             assert self.env is None
@@ -132,20 +488,41 @@ class ProcessTrace:
         else:  # subsequent exec() does not replace the first exec's details
             self.read(executable)
 
+    def _abspath(self, path):
+        '''Return (path, absolute path) to record, or None if filtered.
+
+        With a resolver, the canonical path is recorded in place of the given
+        path, so that aliases of the same file are recorded only once.
+        '''
+        abspath = self.cwd / path
+        if self._resolver is not None:
+            abspath = self._resolver(abspath)
+            path = abspath
+        if self._path_filter is None or self._path_filter(abspath):
+            return str(path), abspath
+        return None
+
     def read(self, path):
-        self.paths_read.add((str(path), self.cwd / path))
+        t = self._abspath(path)
+        if t is not None:
+            self.paths_read.add(t)
 
     def write(self, path):
-        self.paths_written.add((str(path), self.cwd / path))
+        t = self._abspath(path)
+        if t is not None:
+            self.paths_written.add(t)
 
     def check(self, path, exists):
-        self.paths_checked.add((str(path), self.cwd / path, exists))
+        t = self._abspath(path)
+        if t is not None:
+            self.paths_checked.add(t + (exists,))
 
-    def exit(self, exit_code):
+    def exit(self, exit_code, timestamp=None):
         assert self.exit_code is None
         self.exit_code = exit_code
+        self.exited = timestamp
 
-    def fork(self, child_pid):
+    def fork(self, child_pid, timestamp=None):
         pass  # forks are tracked by from_events()
 
     def chdir(self, path):
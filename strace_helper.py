@@ -1,9 +1,15 @@
-from contextlib import contextmanager
+from collections import Counter, OrderedDict, deque
+from contextlib import closing, contextmanager
+import io
+from itertools import chain
 import logging
 import os
+import queue
 import re
-import subprocess
-from tempfile import TemporaryDirectory
+import threading
+import time
+
+from lazy_modules import lazy
 
 
 logger = logging.getLogger(__name__)
@@ -12,44 +18,101 @@ logger = logging.getLogger(__name__)
 @contextmanager
 def temp_fifo(mode=0o666, suffix='', prefix='tmp', dir=None):
     '''Return path to temporary FIFO that will be deleted at end of context.'''
-    with TemporaryDirectory(suffix, prefix, dir) as tempdir:
+    with lazy.tempfile.TemporaryDirectory(suffix, prefix, dir) as tempdir:
         fifo_path = os.path.join(tempdir, 'temp_fifo')
         os.mkfifo(fifo_path, mode)
         assert os.path.exists(fifo_path)
         yield fifo_path
 
 
-def start_trace(cmd_args, trace_output, **popen_args):
+def start_trace(cmd_args, trace_output, timestamps=False, **popen_args):
     assert len(cmd_args) > 0
 
     args = [
         'strace', '-f', '-q', '-v', '-s', '4096', '-y',
-        '-e', 'trace=file,process', '-e', 'verbose=!stat,lstat,newfstatat',
+        '-e', 'trace=file,process,fchdir,close',
+        '-e', 'verbose=!stat,lstat,newfstatat,statx',
         '-o', trace_output,
     ]
+    if timestamps:
+        args.append('-ttt')
     logger.debug('Running {!r} followed by {!r}'.format(args, cmd_args))
-    return subprocess.Popen(args + cmd_args, **popen_args)
+    return lazy.subprocess.Popen(args + cmd_args, **popen_args)
 
 
 class StraceParseError(NotImplementedError):
     pass
 
 
+class FrozenEnv(dict):
+    '''An immutable dict of environment variables.
+
+    StraceOutputParser hands out the same FrozenEnv for each exec with the
+    same environment, so it must not be modified.
+    '''
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('FrozenEnv is immutable')
+
+    __setitem__ = __delitem__ = __ior__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return self.__class__, (dict(self),)
+
+
 class StraceOutputParser:
     '''Parse strace output into (pid, event, (args...)) tuples.
 
     Possible events are (args in parentheses):
-        - 'exec' (executable, argv_list, env_dict)
+        - 'exec' (executable, argv_list, env_dict)  (env_dict is a FrozenEnv)
         - 'exit' (exit_code)
         - 'read' (path)
         - 'write' (path)
         - 'check' (path, exists)
         - 'fork' (child_pid)
         - 'chdir' (path)
+
+    By default, a line that cannot be parsed (e.g. an unknown syscall, or
+    one with unexpected arguments) raises StraceParseError. In tolerant
+    mode, such lines are instead counted per syscall in .unhandled, and
+    parsing continues. A summary is logged at the end.
+
+    Threads do not generate 'fork' and 'exit' events: their syscalls are
+    reported as coming from the process (thread group leader) owning them.
+
+    With 'timestamps' set, each line is expected to start with a '-ttt'
+    timestamp (after the pid), and the 'exec', 'fork' and 'exit' events get
+    that timestamp (in seconds since the epoch) as an extra last argument.
+    For a syscall that strace reports as unfinished and resumed later (e.g.
+    a fork() racing with its child), that is the time of the call.
     '''
 
-    def __init__(self):
+    def __init__(self, tolerant=False, timestamps=False):
+        self.tolerant = tolerant
+        self.timestamps = timestamps
+        self.timestamp = None  # timestamp of the current line
+        self.unhandled = Counter()  # syscall, signal or <kind> -> #lines
         self.pending = {}  # pid -> unfinished syscall name
+        self.thread_owner = {}  # tid -> pid of the process owning the thread
+        self.thread_clones = set()  # pids with an unfinished thread clone()
+        self.known = set()  # live pids that are not new threads
+        self.held = deque()  # (pid, line) held back until pid is known
+        self.exiting = {}  # exited leader pid -> exit code, threads remain
+        self.exited_early = set()  # pids that exited before clone() returned
+        self.fds = {}  # pid -> {fd: path} from annotated ('-y') return values
+        self.cloexec = {}  # pid -> set of fds in .fds opened with O_CLOEXEC
+        self.envs = OrderedDict()  # raw env array -> FrozenEnv, LRU first
+        # The class holds the patterns, compiled here rather than at import
+        # time to keep importing this module cheap (re caches the regexes)
+        self._fd_regex = re.compile(self._FdPattern)
+        self._timestamp_regex = re.compile(self._TimestampPattern)
+        self._line_regexes = [
+            (parser, re.compile(pattern))
+            for parser, pattern in self._LineParsers]
+        self._pid_regex = re.compile(self._PidPattern)
+
+    EnvCacheSize = 64  # distinct environments kept in .envs
 
     # Syscall argument parsers: Parse the tokens that make up a syscall
     # argument list (as presented by strace)
@@ -111,16 +174,33 @@ class StraceOutputParser:
                 s = s[2:]
         return ret, s[1:]
 
+    def _parse_env(self, s):
+        env = self.envs.get(s)
+        if env is None:
+            a, rest = self._parse_array(s)
+            assert rest == '', rest
+            env = self.envs[s] = FrozenEnv(item.split('=', 1) for item in a)
+            if len(self.envs) > self.EnvCacheSize:
+                self.envs.popitem(last=False)
+        else:
+            self.envs.move_to_end(s)
+        return env
+
     def _parse_args(self, spec, args):
         '''Parse the given args according to the given spec, yield parse items.
 
         Spec legend:
             - , - read a comma followed by a space, yield nothing
             - n - read an integer and yield it
-            - f - read a file descriptor and yield it as an integer
+            - f - read a file descriptor, and yield the path it refers to
+                  (from its '-y' annotation; '.' for AT_FDCWD), or yield the
+                  fd as an integer if it is not annotated
             - s - read a "c-style string" and yield a string
             - | - read a |-separated list of tokens, yield a list of strings
             - a - read an ["array", "of", "strings"], yield a list of strings
+            - e - read the rest of the args as an array of "NAME=value"
+                  strings, yield a FrozenEnv (shared with earlier identical
+                  arrays)
             - * - the rest of the args are optional. yield None unless present
         '''
         optional = False
@@ -139,12 +219,13 @@ class StraceOutputParser:
             elif token == 'f':
                 if args.startswith('AT_FDCWD'):
                     args = args[8:]
+                    if args.startswith('<'):  # cwd, tracked by ProcessTrace
+                        args = args[args.index('>') + 1:]
                     yield '.'
                 else:
-                    f, args = args.split('>', 1)
-                    n, f = f.split('<', 1)
-                    n, _ = self._parse_number(n)
-                    yield f
+                    m = self._fd_regex.match(args)
+                    args = args[m.end():]
+                    yield int(m.group(1)) if m.group(2) is None else m.group(2)
             elif token == 's':
                 s, args = self._parse_string(args)
                 yield s
@@ -154,14 +235,57 @@ class StraceOutputParser:
             elif token == 'a':
                 a, args = self._parse_array(args)
                 yield a
+            elif token == 'e':
+                yield self._parse_env(args)
+                args = ''
             else:
                 assert False, 'Unknown spec token {}'.format(token)
         assert args == ''
 
+    _FdPattern = r'(-?\d+)(?:<(.*?)>(?=, |$))?'  # paths may contain '>'
+
+    def _at_path(self, pid, base, path):
+        '''Return path, relative to the directory given by base.
+
+        base is a value yielded by the 'f' spec. Unannotated fds are looked up
+        in the fd table of the given pid. A NULL or empty path refers to base
+        itself.
+        '''
+        if isinstance(base, int):
+            try:
+                base = self.fds[pid][base]
+            except KeyError:
+                raise StraceParseError('Unknown fd {} in pid {}'.format(
+                    base, pid))
+        if not path:
+            return base
+        if base == '.' or path.startswith('/'):
+            return path
+        return os.path.join(base, path)
+
+    def _inherit_fds(self, pid, child_pid):
+        # The child may have run (and opened files) before clone() returned
+        own_fds = self.fds.get(child_pid, {})
+        if pid in self.fds:
+            self.fds[child_pid] = self.fds[pid].copy()
+            self.fds[child_pid].update(own_fds)
+        if pid in self.cloexec:
+            self.cloexec[child_pid] = (
+                self.cloexec[pid] - own_fds.keys()
+                | self.cloexec.get(child_pid, set()))
+
+    def _forget_fds(self, pid):
+        self.fds.pop(pid, None)
+        self.cloexec.pop(pid, None)
+
     # Syscall handlers: Generate zero or more trace events from a syscall
 
     def _handle_syscall_access(self, pid, func, args, ret, rest):
-        path, mode = self._parse_args('s,|', args)
+        if func == 'access':
+            path, mode = self._parse_args('s,|', args)
+        else:  # faccessat, faccessat2
+            base, path, mode, flags = self._parse_args('f,s,|*,|', args)
+            path = self._at_path(pid, base, path)
         assert set(mode) - {'F_OK', 'R_OK', 'W_OK', 'X_OK'} == set()
         if ret == 0:
             yield pid, 'check', (path, True)
@@ -170,30 +294,65 @@ class StraceOutputParser:
         else:
             raise NotImplementedError(rest)
 
+    _handle_syscall_faccessat = _handle_syscall_access
+    _handle_syscall_faccessat2 = _handle_syscall_access
+
     def _handle_syscall_chdir(self, pid, func, args, ret, rest):
         path, = self._parse_args('s', args)
         assert ret == 0 and not rest
         yield pid, 'chdir', (path,)
 
+    def _handle_syscall_fchdir(self, pid, func, args, ret, rest):
+        base, = self._parse_args('f', args)
+        assert ret == 0 and not rest
+        yield pid, 'chdir', (self._at_path(pid, base, None),)
+
     def _handle_syscall_chmod(self, pid, func, args, ret, rest):
-        path, mode = self._parse_args('s,n', args)
+        if func == 'chmod':
+            path, mode = self._parse_args('s,n', args)
+        else:  # fchmodat, fchmodat2
+            base, path, mode, flags = self._parse_args('f,s,n*,|', args)
+            path = self._at_path(pid, base, path)
         assert ret == 0 and not rest
         yield pid, 'write', (path,)
 
+    _handle_syscall_fchmodat = _handle_syscall_chmod
+    _handle_syscall_fchmodat2 = _handle_syscall_chmod
+
     def _handle_syscall_clone(self, pid, func, args, ret, rest):
         _, _, flags = args.partition('flags=')  # not interested in other args?
         flags = set(self._parse_bitwise_or(flags)[0])
-        assert flags == {
-            'CLONE_CHILD_CLEARTID', 'CLONE_CHILD_SETTID', 'SIGCHLD'}
         assert ret > 0 and not rest
+        if ret in self.exited_early:  # the child has come and gone
+            self.exited_early.discard(ret)
+            if 'CLONE_THREAD' not in flags:
+                yield pid, 'fork', (ret,)
+            return
+        self.known.add(ret)
+        if 'CLONE_THREAD' in flags:
+            self.thread_owner[ret] = pid
+            return
+        self._inherit_fds(pid, ret)
         yield pid, 'fork', (ret,)
 
+    _handle_syscall_clone3 = _handle_syscall_clone
+
+    def _handle_syscall_close(self, pid, func, args, ret, rest):
+        fd = int(self._fd_regex.match(args).group(1))
+        if ret == 0:
+            self.fds.get(pid, {}).pop(fd, None)
+            self.cloexec.get(pid, set()).discard(fd)
+        return
+        yield  # empty generator
+
     def _handle_syscall_execve(self, pid, func, args, ret, rest):
-        executable, argv, env_s = self._parse_args('s,a,a', args)
-        env = dict(s.split('=', 1) for s in env_s)
+        executable, argv, env = self._parse_args('s,a,e', args)
         assert func == 'execve'
         if ret == 0:
             assert not rest
+            fds = self.fds.get(pid, {})
+            for fd in self.cloexec.pop(pid, ()):
+                fds.pop(fd, None)
             yield pid, 'exec', (executable, argv, env)
         else:
             assert ret == -1
@@ -209,13 +368,30 @@ class StraceOutputParser:
         assert ret == -1 and rest.startswith('ENODATA ')
         yield pid, 'check', (path, True)
 
+    def _handle_syscall_mkdir(self, pid, func, args, ret, rest):
+        if func == 'mkdirat':
+            base, path, mode = self._parse_args('f,s,n', args)
+            path = self._at_path(pid, base, path)
+        else:
+            path, mode = self._parse_args('s,n', args)
+        if ret == 0:
+            assert not rest
+            yield pid, 'write', (path,)
+        else:
+            assert ret == -1 and rest.startswith('EEXIST '), rest
+            yield pid, 'check', (path, True)
+
+    _handle_syscall_mkdirat = _handle_syscall_mkdir
+
     def _handle_syscall_open(self, pid, func, args, ret, rest):
         if func == 'openat':
             base, path, oflag, mode = self._parse_args('f,s,|*,n', args)
-            assert base == '.', base
+            path = self._at_path(pid, base, path)
         else:
             path, oflag, mode = self._parse_args('s,|*,n', args)
         oflag = set(oflag)
+        if 'O_CLOEXEC' in oflag and ret >= 0 and ret in self.fds.get(pid, ()):
+            self.cloexec.setdefault(pid, set()).add(ret)
         if ret == -1:
             assert 'O_RDONLY' in oflag
             assert rest.startswith('ENOENT ')
@@ -232,12 +408,19 @@ class StraceOutputParser:
     _handle_syscall_openat = _handle_syscall_open
 
     def _handle_syscall_readlink(self, pid, func, args, ret, rest):
+        def parse_path(spec):
+            if func == 'readlinkat':
+                base, path, _, _ = self._parse_args('f,s,' + spec, args)
+                return self._at_path(pid, base, path)
+            path, _, _ = self._parse_args('s,' + spec, args)
+            return path
+
         try:
-            path, target, bufsize = self._parse_args('s,s,n', args)
+            path = parse_path('s,n')
             assert ret > 0 and not rest
             yield pid, 'read', (path,)
         except ValueError:
-            path, unknown, bufsize = self._parse_args('s,n,n', args)
+            path = parse_path('n,n')
             assert ret == -1
             if rest.startswith('ENOENT '):
                 yield pid, 'check', (path, False)
@@ -246,33 +429,55 @@ class StraceOutputParser:
             else:
                 raise NotImplementedError
 
+    _handle_syscall_readlinkat = _handle_syscall_readlink
+
     def _handle_syscall_rename(self, pid, func, args, ret, rest):
-        path_from, path_to = self._parse_args('s,s', args)
+        if func == 'rename':
+            path_from, path_to = self._parse_args('s,s', args)
+        else:  # renameat, renameat2
+            base_from, path_from, base_to, path_to, flags = self._parse_args(
+                'f,s,f,s*,|', args)
+            path_from = self._at_path(pid, base_from, path_from)
+            path_to = self._at_path(pid, base_to, path_to)
         assert ret == 0 and not rest
         yield pid, 'write', (path_from,)
         yield pid, 'write', (path_to,)
 
+    _handle_syscall_renameat = _handle_syscall_rename
+    _handle_syscall_renameat2 = _handle_syscall_rename
+
+    _StatAtFlags = {
+        'AT_SYMLINK_NOFOLLOW', 'AT_EMPTY_PATH', 'AT_NO_AUTOMOUNT',
+        'AT_STATX_SYNC_AS_STAT', 'AT_STATX_FORCE_SYNC',
+        'AT_STATX_DONT_SYNC', '0'}
+
     def _handle_syscall_stat(self, pid, func, args, ret, rest):
         if func == 'newfstatat':
             base, path, struct, flags = self._parse_args('f,s,n,|', args)
-            assert base == '.', base
-            assert flags == ['AT_SYMLINK_NOFOLLOW']
+            path = self._at_path(pid, base, path)
+        elif func == 'statx':
+            base, path, flags, mask, struct = self._parse_args(
+                'f,s,|,|,n', args)
+            path = self._at_path(pid, base, path)
         else:
             path, struct = self._parse_args('s,n', args)
+            flags = []
+        assert set(flags) <= self._StatAtFlags, flags
         if ret == 0:
             assert not rest
         else:
-            assert ret == -1 and rest.startswith('ENOENT ')
+            assert ret == -1 and rest.startswith(('ENOENT ', 'ENOTDIR '))
         yield pid, 'check', (path, ret == 0)
 
     _handle_syscall_lstat = _handle_syscall_stat
     _handle_syscall_newfstatat = _handle_syscall_stat
+    _handle_syscall_statx = _handle_syscall_stat
 
     def _handle_syscall_unlink(self, pid, func, args, ret, rest):
         if func == 'unlinkat':
-            base, path, flags = self._parse_args('f,s,n', args)
-            assert base == '.', base
-            assert flags == 0, flags
+            base, path, flags = self._parse_args('f,s,|', args)
+            path = self._at_path(pid, base, path)
+            assert set(flags) <= {'0', 'AT_REMOVEDIR'}, flags
         else:
             path, = self._parse_args('s', args)
         if ret == 0:
@@ -286,12 +491,17 @@ class StraceOutputParser:
 
     def _handle_syscall_utimensat(self, pid, func, args, ret, rest):
         base, path, times, flag = self._parse_args('f,s,n,n', args)
-        assert path is None and times == 0 and flag == 0
-        yield pid, 'write', (base,)
+        assert times == 0 and flag == 0
+        yield pid, 'write', (self._at_path(pid, base, path),)
 
     def _handle_syscall_vfork(self, pid, func, args, ret, rest):
         assert args == ''
         assert ret > 0 and not rest
+        if ret in self.exited_early:  # nothing left to track
+            self.exited_early.discard(ret)
+        else:
+            self.known.add(ret)
+            self._inherit_fds(pid, ret)
         yield pid, 'fork', (ret,)
 
     def _ignore_syscall(self, pid, func, args, ret, rest):
@@ -309,28 +519,37 @@ class StraceOutputParser:
     # Line parsers: Parse a line of strace output that matches the
     # corresponding regex in _LineParsers
 
-    def _parse_syscall_full(self, pid, func, args, ret, rest):
+    def _parse_syscall_full(self, pid, func, args, ret, ret_path, rest):
+        pid = int(pid)
+        pid = self.thread_owner.get(pid, pid)
         ret = None if ret == '?' else int(ret)
+        if ret_path is not None and ret >= 0:  # new fd annotated by '-y'
+            self.fds.setdefault(pid, {})[ret] = ret_path
+            self.cloexec.get(pid, set()).discard(ret)  # reused fd number
         handler = getattr(self, '_handle_syscall_' + func)
-        yield from handler(int(pid), func, args, ret, rest.strip())
+        yield from handler(pid, func, args, ret, rest.strip())
 
     def _parse_syscall_unfinished(self, pid, func, partial_args):
         pid = int(pid)
         assert pid not in self.pending
-        self.pending[pid] = (func, partial_args)
+        self.pending[pid] = (func, partial_args, self.timestamp)
+        if func.startswith('clone') and 'CLONE_THREAD' in partial_args:
+            self.thread_clones.add(pid)
+            self.known.add(pid)
         return
         yield  # empty generator
 
     def _parse_syscall_resumed(self, pid, func, rest):
         pid = int(pid)
-        stored_func, partial_args = self.pending[pid]
+        stored_func, partial_args, self.timestamp = self.pending[pid]
         assert func == stored_func
         del self.pending[pid]
+        self.thread_clones.discard(pid)
 
         # Reconstruct full syscall and parse it
         line = '{} {}({}{}'.format(pid, func, partial_args, rest)
         logger.debug('RESUMED {!r}'.format(line))
-        syscall_parser, syscall_pattern = self._LineParsers[0]
+        syscall_parser, syscall_pattern = self._line_regexes[0]
         m = syscall_pattern.match(line)
         assert m
         yield from syscall_parser(self, *m.groups())
@@ -341,55 +560,451 @@ class StraceOutputParser:
         yield  # empty generator
 
     def _parse_exit(self, pid, exit_code):
-        yield int(pid), 'exit', (int(exit_code),)
+        '''A process or thread exited.
+
+        If a leader exits while other threads of its process still run, the
+        process exits (and its 'exit' event is generated) with its last
+        thread.
+        '''
+        pid = int(pid)
+        if pid not in self.known and any(
+                func.startswith('clone') or func == 'vfork'
+                for func, _, _ in self.pending.values()):
+            self.exited_early.add(pid)  # its parent's clone() is unfinished
+        self.known.discard(pid)
+        owner = self.thread_owner.pop(pid, None)
+        if owner is None:
+            if pid in self.thread_owner.values():
+                self.exiting[pid] = int(exit_code)
+                return
+            owner, exit_code = pid, int(exit_code)
+        elif owner in self.exiting and owner not in self.thread_owner.values():
+            exit_code = self.exiting.pop(owner)
+        else:  # ignore thread exits
+            return
+        self._forget_fds(owner)
+        yield owner, 'exit', (exit_code,)
+
+    def _parse_superseded(self, pid, thread_pid):
+        '''A non-leader thread called execve() and took over the leader's pid.
+
+        The execve() started by that thread resumes as the leader's.
+        '''
+        pid, thread_pid = int(pid), int(thread_pid)
+        self.thread_owner.pop(thread_pid, None)
+        self.known.discard(thread_pid)
+        self.exiting.pop(pid, None)
+        if thread_pid in self.pending:
+            self.pending[pid] = self.pending.pop(thread_pid)
+        return
+        yield  # empty generator
 
     def _parse_error(self, line):
         logger.error('Unrecognized line: {!r}'.format(line))
+        self.unhandled['<unrecognized>'] += 1
         return
         yield  # empty generator
 
     _LineParsers = [
-        (_parse_syscall_full, re.compile(
-            r'^(\d+) +(\w+)\((.*)\) += (-?\d+|\?)(?:<.*?>)?(.*)$')),
-        (_parse_syscall_unfinished, re.compile(
-            r'^(\d+) +(\w+)\((.*) <unfinished \.\.\.>$')),
-        (_parse_syscall_resumed, re.compile(
-            r'^(\d+) +<\.\.\. (\w+) resumed> (.*)$')),
-        (_parse_signal, re.compile(r'^(\d+) +--- (\w+) {(.*)} ---$')),
-        (_parse_exit, re.compile(r'^(\d+) +\+\+\+ exited with (\d+) \+\+\+$')),
-        (_parse_error, re.compile(r'(.*)')),
-    ]
+        (_parse_syscall_full,
+            r'^(\d+) +(\w+)\((.*)\) += (-?\d+|\?)(?:<(.*?)>(?= |$))?(.*)$'),
+        (_parse_syscall_unfinished,
+            r'^(\d+) +(\w+)\((.*) <unfinished \.\.\.>$'),
+        (_parse_syscall_resumed, r'^(\d+) +<\.\.\. (\w+) resumed> ?(.*)$'),
+        (_parse_signal, r'^(\d+) +--- (\w+) {(.*)} ---$'),
+        (_parse_exit, r'^(\d+) +\+\+\+ exited with (\d+) \+\+\+$'),
+        (_parse_superseded,
+            r'^(\d+) +\+\+\+ superseded by execve in pid (\d+) \+\+\+$'),
+        (_parse_error, r'(.*)'),
+    ]  # regexes are compiled by __init__()
+
+    # .unhandled key for lines whose second group is not a syscall/signal name
+    _UnhandledNames = {
+        _parse_exit: '<exit>',
+        _parse_superseded: '<superseded>',
+    }
+
+    _TimestampPattern = r'^(\d+ +)(\d+\.\d+) '
+    _TimedEvents = {'exec', 'fork', 'exit'}
+
+    def _add_timestamps(self, events):
+        for pid, event, args in events:
+            if event in self._TimedEvents:
+                args += (self.timestamp,)
+            yield pid, event, args
+
+    def _parse_line(self, line):
+        logger.debug(line.rstrip())
+        if self.timestamps:
+            m = self._timestamp_regex.match(line)
+            if m:
+                self.timestamp = float(m.group(2))
+                line = m.group(1) + line[m.end():]
+        for parser, pattern in self._line_regexes:
+            m = pattern.match(line)
+            if m:
+                try:
+                    events = parser(self, *m.groups())
+                    if self.timestamps:
+                        events = self._add_timestamps(events)
+                    yield from events
+                except Exception:
+                    if not self.tolerant:
+                        raise StraceParseError(line)
+                    logger.debug('UNHANDLED {!r}'.format(line))
+                    name = self._UnhandledNames.get(parser) or m.group(2)
+                    self.unhandled[name] += 1
+                break
+
+    _PidPattern = r'^(\d+) '
+
+    def _hold_or_parse_line(self, line):
+        '''Parse line, unless it may come from a thread not yet known.
+
+        A new thread may run before the clone() creating it returns its tid.
+        While thread clones are unfinished, lines from unknown pids are held
+        back, and so are all lines following them, to keep their order. Only
+        the cloning threads go ahead, as their clone() returning is what
+        makes the new tids known. Held lines are then parsed in order, up to
+        the first one whose pid is still unknown.
+        '''
+        m = self._pid_regex.match(line)
+        pid = int(m.group(1)) if m else None
+        if pid in self.thread_clones:
+            yield from self._parse_line(line)
+        else:
+            self.held.append((pid, line))
+        while self.held:
+            pid, line = self.held[0]
+            if self.thread_clones and pid not in self.known:
+                break
+            self.held.popleft()
+            yield from self._parse_line(line)
+
+    def _parse_remaining(self):
+        '''Parse what is left pending when the trace ends.'''
+        for _, line in self.held:  # trace ended during a thread clone
+            yield from self._parse_line(line)
+        self.held.clear()
+        exiting, self.exiting = self.exiting, {}
+        events = ((pid, 'exit', (exit_code,))  # threads' exits never seen
+                  for pid, exit_code in exiting.items())
+        if self.timestamps:
+            events = self._add_timestamps(events)
+        yield from events
 
     def __call__(self, f):
         '''Generate trace events as documented in the class header.'''
         for line in f:
-            logger.debug(line.rstrip())
-            for parser, pattern in self._LineParsers:
-                m = pattern.match(line)
-                if m:
-                    try:
-                        yield from parser(self, *m.groups())
-                    except:
-                        raise StraceParseError(line)
-                    break
+            if self.thread_clones or self.held:
+                yield from self._hold_or_parse_line(line)
+            else:
+                yield from self._parse_line(line)
+        yield from self._parse_remaining()
+        if self.unhandled:
+            logger.warning(self.summary())
+
+    def summary(self):
+        '''Return a summary of the lines that could not be handled.'''
+        return 'Unhandled strace lines: {}'.format(', '.join(
+            '{} {}'.format(n, name)
+            for name, n in self.unhandled.most_common()))
+
+
+# A recording starts with this, followed by JSON metadata (e.g. the "cwd" of
+# the traced command) and a newline, and continues with the strace output
+_RecordingHeader = '#strace_helper '
+
 
+def _start_recorder(path, metadata):
+    '''Start a thread writing byte chunks into the gzip file path.
 
-def run_trace(cmd_args, log_events=False, **popen_args):
-    '''Execute the given command line and generate trace events.'''
+    Returns a function that hands over a chunk; handing over None completes
+    the file and waits for the thread to finish.
+    '''
+    chunks = queue.SimpleQueue()
+
+    def writer():
+        with lazy.gzip.open(path, 'wb', compresslevel=1) as f:
+            header = _RecordingHeader + lazy.json.dumps(metadata) + '\n'
+            f.write(header.encode())
+            for chunk in iter(chunks.get, None):
+                f.write(chunk)
+
+    t = threading.Thread(target=writer, name='strace recorder', daemon=True)
+    t.start()
+
+    def record(chunk):
+        chunks.put(chunk)
+        if chunk is None:
+            t.join()
+
+    return record
+
+
+def _set_pipe_size(fd, size):
+    F_SETPIPE_SZ = getattr(lazy.fcntl, 'F_SETPIPE_SZ', 1031)  # Python < 3.10
+    try:
+        return lazy.fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except OSError as e:  # e.g. EPERM above /proc/sys/fs/pipe-max-size
+        logger.debug('Cannot set pipe size to {}: {}'.format(size, e))
+        return None
+
+
+def drain_fifo(f, pipe_size=1 << 20, chunk_size=1 << 16, record=None,
+               metadata=None):
+    '''Generate the lines of the pipe or FIFO f, read ahead by a thread.
+
+    A reader thread drains f (enlarged to pipe_size, if possible) into an
+    unbounded in-memory queue as fast as data arrives, so that the writer
+    (strace, and with it every traced process) never blocks on a full pipe
+    while the consumer of these lines lags behind. How far it lagged is
+    logged once the writer has closed the pipe.
+
+    If the consumer stops early (e.g. on an exception), the reader stops
+    too, and is waited for when this generator is closed; the writer then
+    gets EPIPE once f is closed.
+
+    If record is given, the reader also saves the raw data (after a header
+    with the given metadata) to that gzip file, for replay_trace(). The
+    recording does not depend on the consumer: if it stops early, the
+    reader still drains f into the file until the writer closes the pipe,
+    and closing this generator waits for that.
+    '''
+    fd = os.dup(f.fileno())  # owned by the reader, which may outlive f
+    if pipe_size:
+        _set_pipe_size(fd, pipe_size)
+    stop_r, stop_w = os.pipe()  # tells the reader to stop, even when idle
+    chunks = queue.SimpleQueue()
+    stats = {'peak': 0, 'eof': None}
+    consumed = threading.Event()  # set when the consumer stops
+    recorder = None
+    if record is not None:
+        recorder = _start_recorder(record, metadata or {})
+
+    poller = lazy.select.poll()
+    poller.register(fd, lazy.select.POLLIN)
+    poller.register(stop_r, lazy.select.POLLIN)
+
+    def reader():
+        try:
+            while True:
+                if any(ready == stop_r for ready, _ in poller.poll()):
+                    break
+                chunk = os.read(fd, chunk_size)
+                if not chunk:
+                    break
+                if recorder is not None:
+                    recorder(chunk)
+                if not consumed.is_set():
+                    chunks.put(chunk)
+                    stats['peak'] = max(stats['peak'], chunks.qsize())
+        finally:
+            os.close(fd)
+            if recorder is not None:
+                recorder(None)
+            stats['eof'] = time.monotonic()
+            chunks.put(None)
+
+    t = threading.Thread(target=reader, name='strace reader', daemon=True)
+    t.start()
+    rest = b''
+    try:
+        for chunk in iter(chunks.get, None):
+            if rest:
+                chunk = rest + chunk
+            end = chunk.rfind(b'\n') + 1
+            rest = chunk[end:]
+            if end:
+                yield from io.StringIO(
+                    chunk[:end].decode('utf-8', 'surrogateescape'))
+        if rest:
+            yield rest.decode('utf-8', 'surrogateescape')
+    finally:
+        consumed.set()
+        if recorder is None:
+            os.write(stop_w, b'\0')  # the rest of the trace is not needed
+        t.join()  # if recording, only once the writer closes the pipe
+        os.close(stop_r)
+        os.close(stop_w)
+    logger.info(
+        'Finished reading trace {:.3f}s after it ended '
+        '(read ahead by up to {} chunks of {} bytes)'.format(
+            time.monotonic() - stats['eof'], stats['peak'], chunk_size))
+
+
+def _parse_events(f, log_events, tolerant, timestamps):
+    parser = StraceOutputParser(tolerant, timestamps)
+    if log_events:
+        for event_tuple in parser(f):
+            logger.debug('TRACE EVENT {!r}'.format(event_tuple))
+            yield event_tuple
+    else:
+        yield from parser(f)
+
+
+def _fifo_events(fifo, log_events=False, tolerant=False, record=None,
+                 timestamps=False, read_ahead=True, cwd=None):
+    with open(fifo) as f:
+        if record is not None:  # always read ahead, to record from the FIFO
+            lines = drain_fifo(f, record=record, metadata={
+                'cwd': cwd, 'timestamps': timestamps})
+        else:
+            lines = drain_fifo(f) if read_ahead else f
+        with closing(lines):
+            yield from _parse_events(lines, log_events, tolerant, timestamps)
+
+
+def _parse_worker(conn, batch_size, fifo, kwargs):
+    lock = threading.Lock()  # guards batch and conn
+    batch = []
+    done = threading.Event()
+
+    def send_batch():
+        nonlocal batch
+        if batch:
+            conn.send(batch)
+            batch = []
+
+    def flush_when_idle():
+        while not done.wait(0.1):
+            with lock:
+                try:
+                    send_batch()
+                except OSError:  # the consumer stopped early
+                    return
+
+    t = threading.Thread(target=flush_when_idle, name='batch flusher')
+    t.start()
+    events = _fifo_events(fifo, **kwargs)
+    try:
+        try:
+            for event in events:
+                with lock:
+                    batch.append(event)
+                    if len(batch) >= batch_size:
+                        send_batch()
+        finally:
+            done.set()
+            t.join()
+        send_batch()
+        conn.send(None)
+    except BrokenPipeError:
+        pass  # the consumer stopped early
+    except Exception as e:
+        conn.send(e)
+    finally:
+        events.close()  # waits for the recording (if any) to complete
+        conn.close()
+
+
+def parse_in_process(fifo, batch_size=1024, **kwargs):
+    '''Generate the events of _fifo_events(fifo, **kwargs) from a subprocess.
+
+    Reading and parsing the strace output then runs in parallel with (and
+    does not compete for the GIL with) the processing of the events. Events
+    are sent back over a pipe in lists of up to batch_size events (or those
+    parsed within 0.1s), pickled together. Exceptions (e.g. StraceParseError)
+    are re-raised here. If the strace output is recorded and the consumer
+    stops early, the worker still completes the recording.
+    '''
+    recv, send = lazy.multiprocessing.Pipe(duplex=False)
+    worker = lazy.multiprocessing.Process(
+        target=_parse_worker, args=(send, batch_size, fifo, kwargs),
+        name='strace parser', daemon=True)
+    worker.start()
+    send.close()
+    try:
+        for batch in iter(recv.recv, None):
+            if isinstance(batch, Exception):
+                raise batch
+            yield from batch
+    finally:
+        recv.close()  # if we stopped early, the worker's send() fails
+        if worker.is_alive() and kwargs.get('record') is None:
+            worker.terminate()  # do not wait for it to notice
+        worker.join()
+
+
+def run_trace(cmd_args, log_events=False, tolerant=False, record=None,
+              timestamps=False, read_ahead=True, parse_process=False,
+              **popen_args):
+    '''Execute the given command line and generate trace events.
+
+    See StraceOutputParser for the meaning of 'tolerant' and 'timestamps'.
+    If 'record' is given, the raw strace output is also saved to that (gzip)
+    file (along with the cwd of the command), to be analyzed again later with
+    replay_trace() and recording_info(). Unless read_ahead
+    is false, strace output is buffered by drain_fifo(), so that the traced
+    command does not have to wait for the events to be processed. If
+    parse_process is true, strace output is read and parsed in a separate
+    process (see parse_in_process()).
+    '''
+    kwargs = dict(
+        log_events=log_events, tolerant=tolerant, record=record,
+        timestamps=timestamps, read_ahead=read_ahead,
+        cwd=os.path.abspath(popen_args.get('cwd') or os.getcwd()))
     with temp_fifo() as fifo:
-        with start_trace(cmd_args, fifo, **popen_args):
-            with open(fifo) as f:
-                if log_events:
-                    for event_tuple in StraceOutputParser()(f):
-                        logger.debug('TRACE EVENT {!r}'.format(event_tuple))
-                        yield event_tuple
-                else:
-                    yield from StraceOutputParser()(f)
+        with start_trace(cmd_args, fifo, timestamps, **popen_args):
+            if parse_process:
+                yield from parse_in_process(fifo, **kwargs)
+            else:
+                yield from _fifo_events(fifo, **kwargs)
+
+
+def _open_recording(path):
+    '''Open a file of strace output, gzip-compressed or not, for reading.'''
+    with open(path, 'rb') as f:
+        compressed = f.read(2) == b'\x1f\x8b'
+    if compressed:
+        return lazy.gzip.open(path, 'rt', errors='surrogateescape')
+    return open(path, errors='surrogateescape')
+
+
+def recording_info(path):
+    '''Return the metadata of a recording made by run_trace(record=...).
+
+    This is a dict with (at least) the "cwd" of the traced command, or an
+    empty dict for plain strace output.
+    '''
+    with _open_recording(path) as f:
+        line = f.readline()
+    if line.startswith(_RecordingHeader):
+        return lazy.json.loads(line[len(_RecordingHeader):])
+    return {}
+
+
+def replay_trace(path, log_events=False, tolerant=False, timestamps=None):
+    '''Generate trace events from a file of strace output.
+
+    The file may be gzip-compressed, and start with the header of a
+    recording (as written by run_trace(record=...)). Unless 'timestamps' is
+    given, it is taken from that header or, failing that, from whether the
+    first line has a '-ttt' timestamp.
+    '''
+    with _open_recording(path) as f:
+        first = f.readline()
+        lines = f
+        if first.startswith(_RecordingHeader):
+            info = lazy.json.loads(first[len(_RecordingHeader):])
+            first = f.readline()
+            if timestamps is None:
+                timestamps = info.get('timestamps')
+        if timestamps is None:
+            timestamps = re.match(
+                StraceOutputParser._TimestampPattern, first) is not None
+        if first:
+            lines = chain([first], f)
+        yield from _parse_events(lines, log_events, tolerant, timestamps)
 
 
 if __name__ == '__main__':
     from pprint import pprint
     import sys
 
-    for e in StraceOutputParser()(sys.stdin):
+    if len(sys.argv) > 1:  # replay a recorded trace
+        events = replay_trace(sys.argv[1])
+    else:
+        events = StraceOutputParser()(sys.stdin)
+    for e in events:
         pprint(e, width=160)
@@ -0,0 +1,94 @@
+import io
+import unittest
+
+import build_profile
+from process_trace import ProcessTrace
+
+
+# make (1) runs two compilers in parallel (2 and 3), then a linker (4)
+Events = [
+    (1, 'exec', ('/bin/make', ['make'], {}, 100.0)),
+    (1, 'fork', (2, 100.5)),
+    (1, 'fork', (3, 100.5)),
+    (2, 'exec', ('/bin/cc', ['cc', '-c', 'a.c'], {}, 100.6)),
+    (3, 'exec', ('/bin/cc', ['cc', '-c', 'b.c'], {}, 100.6)),
+    (2, 'exit', (0, 102.0)),
+    (3, 'exit', (0, 105.0)),
+    (1, 'fork', (4, 105.5)),
+    (4, 'exec', ('/bin/ld', ['ld', 'a.o', 'b.o'], {}, 105.5)),
+    (4, 'exit', (0, 106.5)),
+    (1, 'exit', (0, 107.0)),
+]
+
+
+class TestBuildProfile(unittest.TestCase):
+
+    def setUp(self):
+        self.root = ProcessTrace.from_events(iter(Events), cwd='/src')
+
+    def test_timestamps(self):
+        self.assertEqual((self.root.started, self.root.exited), (100, 107))
+        self.assertEqual(
+            [(c.started, c.exited) for c in self.root.children],
+            [(100.5, 102.0), (100.5, 105.0), (105.5, 106.5)])
+
+    def test_slowest(self):
+        self.assertEqual(
+            [p.pid for p in build_profile.slowest(self.root, 3)], [1, 3, 2])
+
+    def test_critical_path(self):
+        self.assertEqual(
+            [p.pid for p in build_profile.critical_path(self.root)],
+            [1, 3, 4])
+        self.assertEqual(
+            [p.pid for p in build_profile.critical_path(
+                self.root.children[0])], [2])
+
+    def test_waited_for(self):
+        self.assertEqual(
+            [p.pid for p in build_profile.waited_for(self.root)], [3, 4])
+
+    def test_nested_critical_path(self):
+        # sh (1) runs make (2), which runs cc (3) then ld (4)
+        root = ProcessTrace.from_events(iter([
+            (1, 'exec', ('/bin/sh', ['sh'], {}, 100.0)),
+            (1, 'fork', (2, 100.0)),
+            (2, 'exec', ('/bin/make', ['make'], {}, 100.0)),
+            (2, 'fork', (3, 101.0)),
+            (3, 'exit', (0, 103.0)),
+            (2, 'fork', (4, 103.0)),
+            (4, 'exit', (0, 104.0)),
+            (2, 'exit', (0, 105.0)),
+            (1, 'exit', (0, 105.0)),
+        ]), cwd='/src')
+        self.assertEqual(
+            [p.pid for p in build_profile.critical_path(root)],
+            [1, 2, 3, 4])
+
+    def test_report(self):
+        f = io.StringIO()
+        build_profile.write_report(f, self.root, top=2)
+        self.assertEqual(f.getvalue().splitlines(), [
+            'Slowest processes (wall time, % of total, pid, command):',
+            '     7.000s 100.0%        1 make',
+            '     4.500s  64.3%        3 cc -c b.c',
+            'Critical path (wall time, self time, pid, command):',
+            '     7.000s      1.500s        1 make',
+            '     4.500s      4.500s        3 cc -c b.c',
+            '     1.000s      1.000s        4 ld a.o b.o',
+        ])
+
+    def test_report_without_timestamps(self):
+        f = io.StringIO()
+        build_profile.write_report(f, ProcessTrace(argv=['true']))
+        self.assertIn('No timestamps', f.getvalue())
+
+    def test_json_roundtrip(self):
+        p = ProcessTrace.from_json(self.root.json())
+        self.assertEqual(
+            [(c.started, c.exited) for c in p.children],
+            [(100.5, 102.0), (100.5, 105.0), (105.5, 106.5)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,299 @@
+import gzip
+import io
+import json
+import os
+from pathlib import Path
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+import time
+import unittest
+
+import depfinder
+from path_trie import PathTrie
+from process_trace import ProcessTrace
+import trace_cache
+
+
+Events = [
+    (1, 'exec', ('/bin/sh', ['sh', '-c', 'cat foo > bar'], {})),
+    (1, 'check', ('/etc/ld.so.preload', False)),
+    (1, 'read', ('/etc/ld.so.cache',)),
+    (1, 'fork', (2,)),
+    (2, 'exec', ('/bin/cat', ['cat', 'foo'], {})),
+    (2, 'check', ('/etc/ld.so.preload', False)),
+    (2, 'read', ('/etc/ld.so.cache',)),
+    (2, 'read', ('foo',)),
+    (2, 'write', ('bar',)),
+    (2, 'check', ('bar', True)),
+    (2, 'exit', (0,)),
+    (1, 'exit', (0,)),
+]
+
+
+class TestLiveReport(unittest.TestCase):
+
+    def test_dedup_and_flush(self):
+        f = io.StringIO()
+        report = depfinder.LiveReport(f, interval=3600)
+        p = ProcessTrace.from_events(iter(Events), cwd='/src', on_event=report)
+        self.assertEqual(f.getvalue(), '')  # nothing flushed yet
+        report.close()
+        self.assertEqual(f.getvalue().splitlines(), [
+            'read\t/bin/sh',
+            'missing\t/etc/ld.so.preload',
+            'read\t/etc/ld.so.cache',
+            'read\t/bin/cat',
+            'read\t/src/foo',
+            'write\t/src/bar',
+            'exists\t/src/bar',
+        ])
+        self.assertEqual(p.children[0].cwd, Path('/src'))
+
+    def test_path_filter_and_resolver(self):
+        f = io.StringIO()
+        trie = PathTrie(exclude=['/real/etc'])
+        report = depfinder.LiveReport(
+            f, interval=3600, path_filter=trie.allows,
+            resolver=lambda path: Path('/real') / path.relative_to('/'))
+        ProcessTrace.from_events(iter(Events), cwd='/src', on_event=report)
+        report.close()
+        self.assertEqual(f.getvalue().splitlines(), [
+            'read\t/real/bin/sh',
+            'read\t/real/bin/cat',
+            'read\t/real/src/foo',
+            'write\t/real/src/bar',
+            'exists\t/real/src/bar',
+        ])
+
+    def test_flush_interval(self):
+        f = io.StringIO()
+        report = depfinder.LiveReport(f, interval=0)
+        ProcessTrace.from_events(iter(Events), cwd='/src', on_event=report)
+        self.assertEqual(len(f.getvalue().splitlines()), 7)
+
+    def test_flush_when_idle(self):
+        f = io.StringIO()
+        report = depfinder.LiveReport(f, interval=0.01)
+        self.addCleanup(report.close)
+        report.last_flush += 3600  # the event handler will not flush
+        ProcessTrace.from_events(iter(Events), cwd='/src', on_event=report)
+        self.assertEqual(f.getvalue(), '')
+        report.last_flush -= 3600  # but the timer does, as no events come
+        for _ in range(500):
+            if f.getvalue():
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(f.getvalue().splitlines()), 7)
+
+
+class TestOutputFormats(unittest.TestCase):
+
+    def setUp(self):
+        p = ProcessTrace.from_events(iter(Events), cwd='/src').collapsed()
+        self.argv = p.argv
+        self.deps = depfinder.classify(p)
+
+    def write(self, writer, *args):
+        f = io.StringIO()
+        writer(f, *args)
+        return f.getvalue()
+
+    def test_classify(self):
+        self.assertEqual([list(map(str, paths)) for paths in self.deps], [
+            ['/src/bar'],
+            ['/bin/cat', '/bin/sh', '/etc/ld.so.cache', '/src/foo'],
+            [],
+            ['/etc/ld.so.preload'],
+        ])
+
+    def test_classify_combined_accesses(self):
+        p = ProcessTrace(
+            cwd='/src', paths_read=['r', 'rw'], paths_written=['w', 'rw'],
+            paths_checked=[
+                ('r', False), ('w', False), ('rw', True), ('p', True),
+                ('m', False), ('pm', True), ('pm', False)])
+        self.assertEqual(
+            [[path.name for path in paths] for paths in depfinder.classify(p)],
+            [['rw', 'w'], ['r', 'rw'], ['p', 'pm'], ['m', 'pm']])
+
+    def test_text(self):
+        self.assertEqual(
+            self.write(depfinder.write_text, self.argv, self.deps), """\
+The command:
+    sh -c 'cat foo > bar'
+writes these paths:
+    /src/bar
+reads these paths:
+    /bin/cat
+    /bin/sh
+    /etc/ld.so.cache
+    /src/foo
+depends on the non-existence of these paths:
+    /etc/ld.so.preload
+""")
+
+    def test_text_without_writes(self):
+        deps = self.deps._replace(written=PathTrie())
+        out = self.write(depfinder.write_text, self.argv, deps)
+        self.assertNotIn('writes these paths:', out)
+        self.assertIn('reads these paths:\n    /bin/cat\n', out)
+
+    def test_json(self):
+        out = self.write(depfinder.write_json, self.argv, self.deps)
+        self.assertEqual(json.loads(out), {
+            'command': ['sh', '-c', 'cat foo > bar'],
+            'written': ['/src/bar'],
+            'read': ['/bin/cat', '/bin/sh', '/etc/ld.so.cache', '/src/foo'],
+            'present': [],
+            'missing': ['/etc/ld.so.preload'],
+        })
+
+    def test_nul(self):
+        f = io.BytesIO()
+        depfinder.write_nul(f, self.deps)
+        self.assertEqual(
+            f.getvalue(), b'/bin/cat\0/bin/sh\0/etc/ld.so.cache\0/src/foo\0')
+
+    def test_nul_undecodable(self):
+        deps = depfinder.Dependencies(*(PathTrie() for _ in range(4)))
+        deps.read.add(os.fsdecode(b'/src/caf\xe9.c'))
+        f = io.BytesIO()
+        depfinder.write_nul(f, deps)
+        self.assertEqual(f.getvalue(), b'/src/caf\xe9.c\0')
+
+    def test_make_deps(self):
+        self.assertEqual(self.write(depfinder.write_make_deps, self.deps), """\
+/src/bar: \\
+  /bin/cat \\
+  /bin/sh \\
+  /etc/ld.so.cache \\
+  /src/foo
+
+/bin/cat:
+
+/bin/sh:
+
+/etc/ld.so.cache:
+
+/src/foo:
+""")
+
+    def test_make_deps_escaping(self):
+        deps = depfinder.Dependencies(*(PathTrie() for _ in range(4)))
+        deps.read.add('/src/my file$1#2.c')
+        self.assertEqual(
+            self.write(depfinder.write_make_deps, deps, ['a b.o']), """\
+a\\ b.o: \\
+  /src/my\\ file$$1\\#2.c
+
+/src/my\\ file$$1\\#2.c:
+""")
+
+    def test_make_deps_without_targets(self):
+        deps = depfinder.Dependencies(*(PathTrie() for _ in range(4)))
+        deps.read.add('/src/foo.c')
+        with self.assertRaises(ValueError):
+            self.write(depfinder.write_make_deps, deps)
+
+
+class Test_cached_trace(unittest.TestCase):
+
+    def test_reuse(self):
+        with TemporaryDirectory() as tmpdir:
+            cache = os.path.join(tmpdir, 'cache.json')
+            p = ProcessTrace(
+                pid=1, cwd=tmpdir, executable='/bin/true', argv=['true'],
+                exit_code=0)
+            with open(cache, 'w') as f:
+                trace_cache.save(f, p, cwd=tmpdir, env={'A': '1'})
+            reused = depfinder.cached_trace(
+                ['true'], cache, cwd=tmpdir, env={'A': '1'})
+            self.assertEqual(reused.json(), p.json())
+
+
+class Test_main(unittest.TestCase):
+
+    def test_import_is_cheap(self):
+        # Modules only needed by some options must not slow down startup
+        deferred = [
+            'concurrent.futures', 'gzip', 'json', 'mmap', 'multiprocessing',
+            'pickle', 'socket', 'subprocess', 'tempfile', 'trace_cache']
+        out = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, depfinder; print(*sorted(sys.modules))'],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(set(deferred) & set(out.decode().split()), set())
+
+    # How long importing depfinder may take, not counting interpreter startup
+    ImportBudget = 0.25  # seconds; it takes ~0.04s on a typical machine
+
+    def test_import_time(self):
+        def import_time():
+            out = subprocess.run(
+                [sys.executable, '-X', 'importtime', '-c', 'import depfinder'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.PIPE, check=True).stderr.decode()
+            for line in out.splitlines():  # import time: self | cumul | name
+                _, cumulative, name = line.split('|')
+                if name.strip() == 'depfinder':
+                    return int(cumulative) / 1e6
+            self.fail('depfinder not in -X importtime output')
+
+        self.assertLess(
+            min(import_time() for _ in range(3)), self.ImportBudget)
+
+    def test_replay(self):
+        with TemporaryDirectory() as tmpdir:
+            trace = os.path.join(tmpdir, 'trace.gz')
+            output = os.path.join(tmpdir, 'deps.json')
+            with gzip.open(trace, 'wt') as f:
+                f.write(
+                    '10 execve("/bin/cp", ["cp", "/src/a", "/src/b"], []) '
+                    '= 0\n'
+                    '10 openat(AT_FDCWD, "/src/a", O_RDONLY) = 3</src/a>\n'
+                    '10 openat(AT_FDCWD, "/src/b", O_WRONLY|O_CREAT, 0644) '
+                    '= 4</src/b>\n'
+                    '10 +++ exited with 0 +++\n')
+            depfinder.main(['--replay', trace, '-f', 'json', '-o', output])
+            with open(output) as f:
+                self.assertEqual(json.load(f), {
+                    'command': ['cp', '/src/a', '/src/b'],
+                    'written': ['/src/b'],
+                    'read': ['/bin/cp', '/src/a'],
+                    'present': [],
+                    'missing': [],
+                })
+
+    def test_replay_in_recorded_cwd(self):
+        with TemporaryDirectory() as tmpdir:
+            trace = os.path.join(tmpdir, 'trace.gz')
+            output = os.path.join(tmpdir, 'deps.json')
+            with gzip.open(trace, 'wt') as f:
+                f.write(
+                    '#strace_helper {"cwd": "/src"}\n'
+                    '10 execve("/bin/cat", ["cat", "a"], []) = 0\n'
+                    '10 openat(AT_FDCWD, "a", O_RDONLY) = 3</src/a>\n'
+                    '10 +++ exited with 0 +++\n')
+            depfinder.main(['--replay', trace, '-f', 'json', '-o', output])
+            with open(output) as f:
+                self.assertEqual(json.load(f)['read'], ['/bin/cat', '/src/a'])
+
+    def test_relative_exclude(self):
+        with TemporaryDirectory() as tmpdir:
+            trace = os.path.join(tmpdir, 'trace.gz')
+            output = os.path.join(tmpdir, 'deps.json')
+            with gzip.open(trace, 'wt') as f:
+                f.write(
+                    '10 execve("/bin/cat", ["cat", "a", "b/c"], []) = 0\n'
+                    '10 openat(AT_FDCWD, "a", O_RDONLY) = 3</src/a>\n'
+                    '10 openat(AT_FDCWD, "b/c", O_RDONLY) = 3</src/b/c>\n'
+                    '10 +++ exited with 0 +++\n')
+            depfinder.main(['--replay', trace, '-f', 'json', '-o', output,
+                            '--exclude', 'b'], cwd='/src')
+            with open(output) as f:
+                self.assertEqual(json.load(f)['read'], ['/bin/cat', '/src/a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
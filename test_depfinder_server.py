@@ -0,0 +1,110 @@
+import errno
+import gzip
+import json
+import os
+import socket
+from tempfile import TemporaryDirectory, TemporaryFile
+import threading
+import unittest
+
+import depfinder_server
+
+
+Trace = (
+    '10 execve("/bin/cp", ["cp", "a", "b"], []) = 0\n'
+    '10 openat(AT_FDCWD, "a", O_RDONLY) = 3</src/a>\n'
+    '10 openat(AT_FDCWD, "b", O_WRONLY|O_CREAT, 0644) = 4</src/b>\n'
+    '10 +++ exited with 0 +++\n'
+)
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = tmpdir.name
+        with gzip.open(os.path.join(self.tmpdir, 'trace.gz'), 'wt') as f:
+            f.write(Trace)
+        self.socket = os.path.join(self.tmpdir, 'socket')
+        self.server = depfinder_server.Server(self.socket, jobs=2)
+        self.addCleanup(self.server.close)
+
+    def request(self, args):
+        t = threading.Thread(target=self.server.serve_one)
+        t.start()
+        with TemporaryFile('w+') as out, TemporaryFile('w+') as err:
+            status = depfinder_server.request(
+                self.socket, args, cwd=self.tmpdir, env={},
+                stdout=out.fileno(), stderr=err.fileno())
+            t.join()
+            out.seek(0)
+            err.seek(0)
+            self.err = err.read()
+            return status, out.read()
+
+    def test_replay(self):
+        status, out = self.request(['--replay', 'trace.gz', '-f', 'json'])
+        self.assertEqual(status, 0)
+        self.assertEqual(json.loads(out), {
+            'command': ['cp', 'a', 'b'],
+            'written': [os.path.join(self.tmpdir, 'b')],
+            'read': ['/bin/cp', os.path.join(self.tmpdir, 'a')],
+            'present': [],
+            'missing': [],
+        })
+
+    def test_relative_output(self):
+        status, out = self.request(
+            ['--replay', 'trace.gz', '-f', 'nul', '-o', 'deps'])
+        self.assertEqual((status, out), (0, ''))
+        with open(os.path.join(self.tmpdir, 'deps')) as f:
+            self.assertEqual(
+                f.read(), '/bin/cp\0{}\0'.format(
+                    os.path.join(self.tmpdir, 'a')))
+
+    def test_usage_error(self):
+        status, out = self.request(['--no-such-option'])
+        self.assertEqual((status, out), (2, ''))
+        self.assertIn('error: unrecognized arguments: --no-such-option',
+                      self.err)
+
+    def test_help(self):
+        status, out = self.request(['--help'])
+        self.assertEqual((status, self.err), (0, ''))
+        self.assertIn('Find the files a command depends on', out)
+
+    def test_malformed_request(self):
+        r, w = os.pipe()
+        t = threading.Thread(target=self.server.serve_one)
+        t.start()
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(self.socket)
+            socket.send_fds(s, [b'F'], [w, w])
+            os.close(w)
+            s.sendall(b'not json')
+            s.shutdown(socket.SHUT_WR)
+            reply = depfinder_server._read_all(s)
+        t.join()
+        self.assertEqual(json.loads(reply.decode('utf-8')), {'status': 1})
+        with open(r) as f:
+            self.assertEqual(f.read(), '')  # EOF: the server closed its fds
+
+    def test_socket_in_use(self):
+        with self.assertRaises(OSError) as cm:
+            depfinder_server.Server(self.socket)
+        self.assertEqual(cm.exception.errno, errno.EADDRINUSE)
+        self.server.serve_one()  # the probe of the live server
+        self.assertEqual(self.request(['--help'])[0], 0)  # still served
+
+    def test_stale_socket(self):
+        path = os.path.join(self.tmpdir, 'stale')
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.bind(path)
+        s.close()  # leaves the socket file, with nobody listening
+        depfinder_server.Server(path).close()
+        self.assertFalse(os.path.exists(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
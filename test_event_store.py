@@ -0,0 +1,75 @@
+from pathlib import Path
+import unittest
+
+from event_store import EventStore
+from process_trace import ProcessTrace
+
+
+Events = [
+    (1, 'exec', ('/bin/sh', ['sh', '-c', 'cat foo > bar'], {})),
+    (1, 'check', ('foo', True)),
+    (1, 'write', ('bar',)),
+    (1, 'fork', (2,)),
+    (2, 'exec', ('/bin/cat', ['cat', 'foo'], {})),
+    (2, 'read', ('foo',)),
+    (2, 'chdir', ('/tmp',)),
+    (2, 'check', ('foo', False)),
+    (2, 'exit', (0,)),
+    (1, 'exit', (0,)),
+]
+
+
+class TestEventStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = EventStore()
+        ProcessTrace.from_events(
+            iter(Events), cwd='/src', evict=True, on_event=self.store)
+
+    def test_columns(self):
+        self.assertEqual(len(self.store), 6)
+        self.assertEqual(self.store.paths, [
+            Path('/bin/sh'), Path('/src/foo'), Path('/src/bar'),
+            Path('/bin/cat'), Path('/tmp/foo')])
+
+    def test_by_path(self):
+        self.assertEqual(self.store.by_path('/src/foo'), [
+            (1, 1, 'check', Path('/src/foo'), True),
+            (4, 2, 'read', Path('/src/foo'), None),
+        ])
+        self.assertEqual(self.store.by_path('/nonexistent'), [])
+        self.assertEqual(self.store.pids_by_path('/src/foo', 'read'), [2])
+
+    def test_by_pid(self):
+        self.assertEqual(self.store.by_pid(2), [
+            (3, 2, 'exec', Path('/bin/cat'), None),
+            (4, 2, 'read', Path('/src/foo'), None),
+            (5, 2, 'check', Path('/tmp/foo'), False),
+        ])
+        self.assertEqual(self.store.by_pid(3), [])
+
+    def test_index_is_updated_by_add(self):
+        self.assertEqual(self.store.pids_by_path('/src/foo'), [1, 2])
+        self.store.add(3, 'write', Path('/src/foo'))
+        self.assertEqual(self.store.pids_by_path('/src/foo'), [1, 2, 3])
+        self.assertEqual(self.store.by_pid(3), [
+            (6, 3, 'write', Path('/src/foo'), None)])
+
+    def test_reused_pid(self):
+        store = EventStore()
+        ProcessTrace.from_events(iter(Events[:-1] + [
+            (1, 'fork', (2,)),  # pid 2 is reused
+            (2, 'read', ('bar',)),
+            (2, 'exit', (0,)),
+            (1, 'exit', (0,)),
+        ]), cwd='/src', evict=True, on_event=store)
+        self.assertEqual(store.latest, {1: 0, 2: 1})
+        self.assertEqual(store.by_pid(2, 0), self.store.by_pid(2))
+        self.assertEqual(store.by_pid(2, 1), [
+            (6, 2, 'read', Path('/src/bar'), None)])
+        self.assertEqual(len(store.by_pid(2)), 4)
+        self.assertEqual(store.by_pid(2, 2), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+from pathlib import Path
+import unittest
+
+from makecheck import CrossCheck, cross_check, describe, parallel_jobs
+from makeparser import Makefile
+from process_trace import ProcessTrace
+from test_utils import make_rule
+
+
+class TestCrossCheck(unittest.TestCase):
+
+    cwd = Path('/src')
+
+    def setUp(self):
+        self.m = Makefile()
+        for rule in [
+            make_rule('hello', ['hello.o'], ['cc -o $@ $^']),
+            make_rule('hello.o', ['hello.c', 'FORCE'], ['cc -c $<']),
+            make_rule('FORCE', [], []),
+            make_rule('.PHONY', ['FORCE'], []),
+        ]:
+            self.m.rules[rule.target] = rule
+
+        self.make = ProcessTrace(pid=1, cwd=self.cwd, executable='/bin/make')
+
+    def fork(self, argv, reads=(), writes=()):
+        c = ProcessTrace(
+            pid=len(self.make.children) + 2, ppid=1, cwd=self.cwd,
+            executable=argv[0], argv=argv, paths_read=reads,
+            paths_written=writes)
+        self.make.children.append(c)
+        return c
+
+    def test_declared_deps(self):
+        self.fork(['/bin/cc', '-c', 'hello.c'], ['hello.c'], ['hello.o'])
+        self.fork(['/bin/cc', '-o', 'hello'], ['hello.o'], ['hello'])
+        targets, unattributed = cross_check(self.m, self.make, self.cwd)
+        self.assertEqual(set(targets.keys()), {'hello', 'hello.o'})
+        self.assertEqual(unattributed, [])
+        for deps in targets.values():
+            self.assertEqual(deps.undeclared(self.cwd), set())
+            self.assertEqual(deps.unused(), set())
+
+    def test_undeclared_and_unused_deps(self):
+        self.fork(
+            ['/bin/cc', '-c', 'hello.c'],
+            ['hello.c', 'hello.h', '/usr/include/stdio.h'], ['hello.o'])
+        self.fork(['/bin/cc', '-o', 'hello'], [], ['hello'])
+        targets, _ = cross_check(self.m, self.make, self.cwd)
+        self.assertEqual(
+            targets['hello.o'].undeclared(self.cwd), {self.cwd / 'hello.h'})
+        self.assertEqual(targets['hello.o'].unused(), set())
+        self.assertEqual(targets['hello'].undeclared(self.cwd), set())
+        self.assertEqual(targets['hello'].unused(), {self.cwd / 'hello.o'})
+
+    def test_non_writing_children_go_to_next_target(self):
+        self.fork(['/bin/echo', 'compiling'], ['hello.h'])
+        self.fork(['/bin/cc', '-c', 'hello.c'], ['hello.c'], ['hello.o'])
+        self.fork(['/bin/echo', 'done'])
+        targets, unattributed = cross_check(self.m, self.make, self.cwd)
+        self.assertEqual(len(targets['hello.o'].processes), 2)
+        self.assertEqual(
+            targets['hello.o'].undeclared(self.cwd), {self.cwd / 'hello.h'})
+        self.assertEqual(
+            [c.argv for c in unattributed], [['/bin/echo', 'done']])
+
+    def test_streaming(self):
+        check = CrossCheck(self.m, self.cwd)
+        ProcessTrace.from_events(iter([
+            (1, 'exec', ('/bin/make', ['make'], {})),
+            (1, 'fork', (2,)),
+            (2, 'exec', ('/bin/cc', ['cc', '-c', 'hello.c'], {})),
+            (2, 'read', ('hello.c',)),
+            (2, 'fork', (3,)),
+            (3, 'exec', ('/bin/as', ['as'], {})),
+            (3, 'write', ('hello.o',)),
+            (3, 'exit', (0,)),
+            (2, 'exit', (0,)),
+            (1, 'fork', (4,)),
+            (4, 'exit', (0,)),
+            (1, 'exit', (0,)),
+        ]), cwd=self.cwd, evict=True, on_event=check)
+        self.assertEqual(set(check.targets.keys()), {'hello.o'})
+        self.assertEqual(
+            check.targets['hello.o'].read,
+            {Path('/bin/cc'), Path('/bin/as'), self.cwd / 'hello.c'})
+        self.assertEqual(
+            [describe(c) for c in check.unattributed], ['pid 4 (no exec)'])
+
+
+class Test_parallel_jobs(unittest.TestCase):
+
+    def test_args(self):
+        self.assertFalse(parallel_jobs(['-k', 'all']))
+        self.assertFalse(parallel_jobs(['-j1']))
+        self.assertFalse(parallel_jobs(['--jobs', '1']))
+        self.assertTrue(parallel_jobs(['-j']))
+        self.assertTrue(parallel_jobs(['-kj4']))
+        self.assertTrue(parallel_jobs(['-j', '8']))
+        self.assertTrue(parallel_jobs(['--jobs=8']))
+
+    def test_makeflags(self):
+        self.assertFalse(parallel_jobs([], 'k -- CC=gcc'))
+        self.assertTrue(parallel_jobs([], 'kj'))
+        self.assertTrue(parallel_jobs([], ' -j4 --jobserver-auth=3,4'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,11 @@
+import io
 import logging
 import os
 from pathlib import Path
 from tempfile import TemporaryDirectory
 import unittest
 
-from makeparser import Makefile
+from makeparser import Makefile, iter_byte_lines
 import test_utils
 
 
@@ -76,5 +77,158 @@ clean:
         self.assertEqual(rule.recipe, ['cp $^ $@'])
 
 
+class TestMakefile_parse_lines(unittest.TestCase):
+
+    database = b'''\
+# GNU Make 4.1
+
+# Variables
+
+# makefile (from 'Makefile', line 1)
+PROGRAM = hello
+# automatic
+@F = $(notdir $@)
+# makefile (from 'Makefile', line 2)
+define GREETING
+Hello,
+World!
+endef
+# environment
+EMPTY = 
+# Load=4/1024=0%, Rehash=0, Collisions=0/4=0%
+
+# Pattern-specific Variable Values
+
+%.o :
+# makefile (from 'Makefile', line 3)
+# CFLAGS := -O2
+
+# 1 pattern-specific variable values
+
+# Directories
+
+# . (device 65024, inode 13533185): 4 files, 41 impossibilities.
+
+# Implicit Rules
+
+%.o: %.c
+#  recipe to execute (built-in):
+\t$(COMPILE.c) $(OUTPUT_OPTION) $<
+
+%.c:
+
+# 2 implicit rules, 0 (0.0%) terminal.
+
+# Files
+
+# Not a target:
+hello.source:
+#  Implicit rule search has been done.
+#  Last modified 2015-06-01 12:00:00.000000000
+#  File has been updated.
+
+hello: LDFLAGS := -lm
+hello: hello.source | dir
+#  Implicit rule search has not been done.
+#  File does not exist.
+# variable set hash-table stats:
+# Load=1/32=3%, Rehash=0, Collisions=0/2=0%
+#  recipe to execute (from 'Makefile', line 4):
+\tcp $^ $@
+
+clean:
+#  Phony target (prerequisite of .PHONY).
+#  recipe to execute (from 'Makefile', line 7):
+\trm -f $(PROGRAM)
+
+log:: clean
+#  Modification time never checked.
+
+# files hash-table stats:
+# Load=4/1024=0%, Rehash=0, Collisions=0/4=0%
+# VPATH Search Paths
+
+vpath %.h include:../include
+
+# Finished Make data base on Mon Jun  1 12:00:00 2015
+'''
+
+    def test_iter_byte_lines(self):
+        expect = self.database.split(b'\n')[:-1]
+        for chunk_size in [1, 7, 4096]:
+            actual = iter_byte_lines(io.BytesIO(self.database), chunk_size)
+            self.assertEqual(list(actual), expect)
+
+    def test_iter_byte_lines_crlf(self):
+        data = b'a: b\r\n\r\n\tcmd\r\nlast\r'
+        for chunk_size in [1, 5, 4096]:
+            self.assertEqual(
+                list(iter_byte_lines(io.BytesIO(data), chunk_size)),
+                [b'a: b', b'', b'\tcmd', b'last'])
+
+    def test_parse_lines(self):
+        m = Makefile.parse_lines(iter_byte_lines(io.BytesIO(self.database)))
+        self.assertEqual(m.variables, {
+            'PROGRAM': 'hello',
+            '@F': '$(notdir $@)',
+            'GREETING': 'Hello,\nWorld!',
+            'EMPTY': '',
+        })
+        self.assertEqual(m.variable_origins, {
+            'PROGRAM': 'makefile',
+            '@F': 'automatic',
+            'GREETING': 'makefile',
+            'EMPTY': 'environment',
+        })
+        self.assertEqual(m.pattern_variables, {'%.o': {'CFLAGS': '-O2'}})
+        self.assertEqual(m.vpaths, [('%.h', ['include', '../include'])])
+
+        self.assertEqual(
+            [(r.target, r.deps) for r in m.implicit_rules],
+            [('%.o', ['%.c']), ('%.c', [])])
+        self.assertTrue(all(r.is_pattern for r in m.implicit_rules))
+        self.assertEqual(
+            m.implicit_rules[0].recipe, ['$(COMPILE.c) $(OUTPUT_OPTION) $<'])
+        self.assertIsNone(m.implicit_rules[0].recipe_origin)
+
+        self.assertEqual(
+            sorted(m.rules.keys()), ['clean', 'hello', 'hello.source', 'log'])
+
+        hello = m.rules['hello']
+        self.assertEqual(hello.deps, ['hello.source'])
+        self.assertEqual(hello.order_only_deps, ['dir'])
+        self.assertEqual(hello.variables, {'LDFLAGS': '-lm'})
+        self.assertEqual(hello.recipe, ['cp $^ $@'])
+        self.assertEqual(hello.recipe_origin, ('Makefile', 4))
+        self.assertTrue(hello.is_target)
+        self.assertFalse(hello.is_phony)
+        self.assertIs(hello.exists, False)
+        self.assertEqual(str(hello), 'hello: hello.source | dir\n\tcp $^ $@')
+
+        source = m.rules['hello.source']
+        self.assertFalse(source.is_target)
+        self.assertIs(source.exists, True)
+        self.assertEqual(
+            source.last_modified, '2015-06-01 12:00:00.000000000')
+
+        self.assertTrue(m.rules['clean'].is_phony)
+        self.assertTrue(m.rules['log'].double_colon)
+        self.assertEqual(m.rules['log'].deps, ['clean'])
+        self.assertIsNone(m.rules['log'].exists)
+        self.assertEqual(m.double_colon_rules, {'log': [m.rules['log']]})
+
+    def test_double_colon_rules(self):
+        m = Makefile.parse_lines([
+            b'# Files', b'',
+            b'log:: a', b'#  Some note.', b'\techo a >> $@', b'',
+            b'log:: b', b'#  Some note.', b'\techo b >> $@', b'',
+        ])
+        self.assertEqual(
+            [(r.deps, r.recipe, r.notes) for r in m.double_colon_rules['log']],
+            [(['a'], ['echo a >> $@'], ['Some note.']),
+             (['b'], ['echo b >> $@'], ['Some note.'])])
+        self.assertIs(m.rules['log'], m.double_colon_rules['log'][0])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,80 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import unittest
+
+from makeparser import Makefile
+from maketracer import recipe_graph, trace_targets
+from test_utils import make_rule
+
+
+class TestTraceTargets(unittest.TestCase):
+
+    def setUp(self):
+        self.m = Makefile()
+        for rule in [
+            make_rule('all', ['hello', 'world'], []),
+            make_rule('hello', ['hello.o', 'common.o'], ['cc -o $@ $^']),
+            make_rule('world', ['world.o', 'common.o'], ['cc -o $@ $^']),
+            make_rule('hello.o', ['hello.c'], ['cc -c $<']),
+            make_rule('world.o', ['world.c'], ['cc -c $<']),
+            make_rule('common.o', ['common.c'], ['cc -c $<']),
+            make_rule('hello.c', [], [], is_target=False),
+        ]:
+            self.m.rules[rule.target] = rule
+
+        self.lock = threading.Lock()
+        self.traced = []
+
+    def fake_trace(self, target, deps, make_args):
+        with self.lock:
+            self.traced.append(target)
+        return (target, tuple(deps), tuple(make_args))
+
+    def test_recipe_graph(self):
+        self.assertEqual(recipe_graph(self.m), {
+            'hello': {'hello.o', 'common.o'},
+            'world': {'world.o', 'common.o'},
+            'hello.o': set(),
+            'world.o': set(),
+            'common.o': set(),
+        })
+        self.assertEqual(recipe_graph(self.m, ['all']), {
+            'all': {'hello', 'world'},
+            'hello': {'hello.o', 'common.o'},
+            'world': {'world.o', 'common.o'},
+            'hello.o': set(),
+            'world.o': set(),
+            'common.o': set(),
+        })
+
+    def test_dependency_order(self):
+        progress = []
+        results = trace_targets(
+            self.m, ['-k'], pool=ThreadPoolExecutor(4), trace=self.fake_trace,
+            progress=lambda *args: progress.append(args[:3]))
+        self.assertEqual(len(results), 5)
+        self.assertEqual(
+            results['hello'], ('hello', ('hello.o', 'common.o'), ('-k',)))
+        self.assertEqual(
+            [p[:2] for p in progress], [(i, 5) for i in range(1, 6)])
+        for target, deps in recipe_graph(self.m).items():
+            for dep in deps:
+                self.assertLess(
+                    self.traced.index(dep), self.traced.index(target))
+
+    def test_unknown_target(self):
+        with self.assertRaisesRegex(ValueError, 'no-such-target'):
+            trace_targets(
+                self.m, targets=['hello', 'no-such-target'],
+                pool=ThreadPoolExecutor(2), trace=self.fake_trace)
+        self.assertEqual(self.traced, [])
+
+    def test_circular_dependencies(self):
+        self.m.rules['hello.c'] = make_rule('hello.c', ['hello'], ['touch $@'])
+        with self.assertRaises(ValueError):
+            trace_targets(
+                self.m, pool=ThreadPoolExecutor(2), trace=self.fake_trace)
+
+
+if __name__ == '__main__':
+    unittest.main()
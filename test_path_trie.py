@@ -0,0 +1,77 @@
+import doctest
+from pathlib import PurePath
+import unittest
+
+import path_trie
+from path_trie import PathTrie
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(path_trie))
+    return tests
+
+
+class TestPathTrie(unittest.TestCase):
+
+    paths = [
+        '/usr/lib/libc.so.6',
+        '/usr/lib/libm.so.6',
+        '/usr/local/lib/libfoo.so',
+        '/etc/ld.so.cache',
+        '/proc/meminfo',
+        '/home/user/src/foo.c',
+        '/home/user/src',
+    ]
+
+    def test_sorted_iteration(self):
+        t = PathTrie()
+        for path in self.paths + self.paths:
+            self.assertTrue(t.add(path))
+        self.assertEqual(len(t), len(self.paths))
+        self.assertEqual(list(t), sorted(PurePath(p) for p in self.paths))
+
+    def test_filters(self):
+        t = PathTrie(
+            exclude=['/usr', '/proc', '/etc/ld.so.cache'],
+            include=['/usr/local'])
+        added = [path for path in self.paths if t.add(path)]
+        self.assertEqual(added, [
+            '/usr/local/lib/libfoo.so',
+            '/home/user/src/foo.c',
+            '/home/user/src',
+        ])
+        self.assertEqual(len(t), 3)
+        self.assertNotIn('/usr/lib/libc.so.6', t)
+        self.assertNotIn('/usr/local', t)  # only a prefix of a stored path
+
+    def test_relative_rule(self):
+        with self.assertRaises(ValueError):
+            PathTrie(exclude=['usr'])
+
+    def test_only_include_rules(self):
+        t = PathTrie(include=['/home'])
+        self.assertEqual(
+            [path for path in self.paths if t.add(path)],
+            ['/home/user/src/foo.c', '/home/user/src'])
+
+    def test_summary(self):
+        t = PathTrie()
+        for path in self.paths:
+            t.add(path)
+        self.assertEqual([(str(p), n) for p, n in t.summary(1)], [
+            ('/etc/ld.so.cache', 1),
+            ('/home/user/src', 2),
+            ('/proc/meminfo', 1),
+            ('/usr', 3),
+        ])
+        self.assertEqual([(str(p), n) for p, n in t.summary(2)], [
+            ('/etc/ld.so.cache', 1),
+            ('/home/user/src', 2),
+            ('/proc/meminfo', 1),
+            ('/usr/lib', 2),
+            ('/usr/local/lib/libfoo.so', 1),
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
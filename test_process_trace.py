@@ -6,7 +6,7 @@ from subprocess import check_output, DEVNULL
 from tempfile import TemporaryDirectory
 import unittest
 
-from process_trace import ProcessTrace
+from process_trace import PendingEvents, ProcessTrace, RealpathCache
 import strace_helper
 import test_utils
 
@@ -486,5 +486,233 @@ int main()
             self.assertFalse(hello.exists())
 
 
+class TestProcessTrace_from_events(unittest.TestCase):
+    '''Build ProcessTrace trees from synthetic (reordered) trace events.'''
+
+    def build(self, events, **kwargs):
+        return ProcessTrace.from_events(iter(events), cwd='/', **kwargs)
+
+    def summary(self, p):
+        return (p.pid, p.ppid, sorted(t[0] for t in p.paths_read),
+                p.exit_code, [self.summary(c) for c in p.children])
+
+    def test_in_order(self):
+        root = self.build([
+            (1, 'exec', ('/bin/sh', ['sh'], {})),
+            (1, 'fork', (2,)),
+            (2, 'exec', ('/bin/cat', ['cat', 'foo'], {})),
+            (2, 'read', ('foo',)),
+            (2, 'exit', (0,)),
+            (1, 'exit', (0,)),
+        ])
+        self.assertEqual(self.summary(root), (
+            1, None, [], 0, [(2, 1, ['foo'], 0, [])]))
+        self.assertEqual(root.children[0].executable, Path('/bin/cat'))
+
+    def test_child_events_before_fork(self):
+        pending = PendingEvents()
+        root = self.build([
+            (1, 'exec', ('/bin/sh', ['sh'], {})),
+            (2, 'exec', ('/bin/sh', ['sh'], {})),
+            (2, 'fork', (3,)),
+            (3, 'read', ('bar',)),
+            (3, 'exit', (0,)),
+            (2, 'read', ('foo',)),
+            (2, 'exit', (0,)),
+            (1, 'fork', (2,)),
+            (1, 'exit', (0,)),
+        ], pending=pending)
+        self.assertEqual(self.summary(root), (
+            1, None, [], 0, [(2, 1, ['foo'], 0, [(3, 2, ['bar'], 0, [])])]))
+        self.assertEqual(pending.max_depth, 4)
+        self.assertEqual(pending.peak, 6)
+        self.assertEqual(pending.spilled, 0)
+        self.assertFalse(pending.queues)
+
+    def test_spill_to_disk(self):
+        events = [(1, 'exec', ('/bin/sh', ['sh'], {}))]
+        for pid in range(2, 12):
+            events.extend((pid, 'read', (str(i),)) for i in range(pid))
+            events.append((pid, 'exit', (pid,)))
+        events.extend((1, 'fork', (pid,)) for pid in range(2, 12))
+        events.append((1, 'exit', (0,)))
+
+        pending = PendingEvents(max_events=10)
+        root = self.build(events, pending=pending)
+        self.assertEqual(self.summary(root), (1, None, [], 0, [
+            (pid, 1, sorted(str(i) for i in range(pid)), pid, [])
+            for pid in range(2, 12)]))
+        self.assertEqual(pending.max_depth, 12)
+        self.assertLessEqual(pending.peak, 11)
+        self.assertGreater(pending.spilled, 0)
+
+    def test_pid_reuse_before_fork(self):
+        root = self.build([
+            (1, 'exec', ('/bin/sh', ['sh'], {})),
+            (2, 'read', ('first',)),
+            (2, 'exit', (1,)),
+            (2, 'read', ('second',)),
+            (2, 'exit', (2,)),
+            (1, 'fork', (2,)),
+            (1, 'fork', (2,)),
+            (1, 'exit', (0,)),
+        ])
+        self.assertEqual(self.summary(root), (1, None, [], 0, [
+            (2, 1, ['first'], 1, []),
+            (2, 1, ['second'], 2, []),
+        ]))
+
+    def test_events_without_fork(self):
+        root = self.build([
+            (1, 'exec', ('/bin/sh', ['sh'], {})),
+            (1, 'exit', (0,)),
+            (5, 'read', ('orphan',)),
+            (5, 'exit', (0,)),
+        ])
+        self.assertEqual(self.summary(root), (
+            1, None, [], 0, [(5, None, ['orphan'], 0, [])]))
+
+    nested_events = [
+        (1, 'exec', ('/bin/make', ['make'], {})),
+        (1, 'read', ('Makefile',)),
+        (1, 'fork', (2,)),
+        (2, 'exec', ('/bin/sh', ['sh', '-c', 'cc -c foo.c'], {})),
+        (2, 'fork', (3,)),
+        (3, 'exec', ('/bin/cc', ['cc', '-c', 'foo.c'], {})),
+        (3, 'read', ('foo.c',)),
+        (3, 'write', ('foo.o',)),
+        (2, 'exit', (0,)),  # parent exits before its child
+        (3, 'exit', (0,)),
+        (1, 'fork', (4,)),
+        (4, 'exec', ('/bin/ld', ['ld', '-o', 'foo', 'foo.o'], {})),
+        (4, 'read', ('foo.o',)),
+        (4, 'write', ('foo',)),
+        (4, 'exit', (0,)),
+        (1, 'exit', (0,)),
+    ]
+
+    def test_evict(self):
+        tree = self.build(self.nested_events)
+        evicted = self.build(self.nested_events, evict=True)
+        self.assertEqual(len(tree.children), 2)
+        self.assertEqual(evicted.children, [])
+        self.assertEqual(evicted.collapsed().json(), tree.collapsed().json())
+
+    def test_pid_reused_without_exit(self):
+        root = self.build([
+            (1, 'exec', ('/bin/sh', ['sh'], {})),
+            (1, 'fork', (2,)),
+            (2, 'read', ('first',)),  # exit of pid 2 is missing
+            (1, 'fork', (2,)),
+            (2, 'read', ('second',)),
+            (2, 'exit', (0,)),
+            (1, 'exit', (0,)),
+        ])
+        self.assertEqual(self.summary(root), (1, None, [], 0, [
+            (2, 1, ['first'], None, []),
+            (2, 1, ['second'], 0, []),
+        ]))
+
+    def test_env_delta(self):
+        env = {'PATH': '/bin', 'HOME': '/root', 'USER': 'root', 'LANG': 'C'}
+        child_env = dict(env, MAKELEVEL='1')
+        del child_env['LANG']
+        root = self.build([
+            (1, 'exec', ('/bin/make', ['make'], env)),
+            (1, 'fork', (2,)),
+            (2, 'exec', ('/bin/make', ['make'], child_env)),
+            (2, 'fork', (3,)),
+            (3, 'exec', ('/bin/cc', ['cc'], child_env)),
+            (3, 'exit', (0,)),
+            (2, 'exit', (0,)),
+            (1, 'fork', (4,)),
+            (4, 'exit', (0,)),
+            (1, 'exit', (0,)),
+        ])
+        child, no_exec = root.children
+        self.assertIs(root.env, env)
+        self.assertEqual(child.env, child_env)
+        self.assertEqual(child.children[0].env, child_env)
+        self.assertEqual(
+            child.children[0]._env_delta, {'MAKELEVEL': '1', 'LANG': None})
+        self.assertIsNone(no_exec.env)
+        self.assertEqual(
+            ProcessTrace.from_json(root.json()).children[0].env, child_env)
+
+    def test_path_filter(self):
+        root = self.build(
+            self.nested_events, evict=True,
+            path_filter=lambda path: path.suffix != '.o')
+        self.assertEqual(
+            sorted(t[0] for t in root.paths_read),
+            ['/bin/cc', '/bin/ld', '/bin/sh', 'Makefile', 'foo.c'])
+        self.assertEqual(sorted(t[0] for t in root.paths_written), ['foo'])
+
+    def test_path_filter_collapsed(self):
+        tree = self.build(self.nested_events)
+        collapsed = tree.collapsed(
+            path_filter=lambda path: path.suffix != '.o')
+        self.assertEqual(
+            sorted(t[1] for t in collapsed.paths_read),
+            sorted(t[1] for t in tree.collapsed().paths_read
+                   if t[1].suffix != '.o'))
+        self.assertEqual(
+            [t[1] for t in collapsed.paths_written], [Path('/foo')])
+
+    def test_resolver(self):
+        with TemporaryDirectory() as tmpdir:
+            tmpdir = Path(tmpdir).resolve()
+            (tmpdir / 'src').mkdir()
+            (tmpdir / 'link').symlink_to('src')
+            root = ProcessTrace.from_events(iter([
+                (1, 'exec', ('/bin/cat', ['cat'], {})),
+                (1, 'read', ('src/foo',)),
+                (1, 'read', ('link/foo',)),
+                (1, 'read', ('link/../src/./foo',)),
+                (1, 'check', ('link', True)),
+                (1, 'exit', (0,)),
+            ]), cwd=tmpdir, resolver=RealpathCache())
+            self.assertEqual(root.paths_read, {
+                (str(tmpdir / 'src/foo'), tmpdir / 'src/foo')})
+            self.assertEqual(root.paths_checked, {
+                (str(tmpdir / 'link'), tmpdir / 'link', True)})
+
+
+class TestRealpathCache(unittest.TestCase):
+
+    def test_resolve(self):
+        with TemporaryDirectory() as tmpdir:
+            tmpdir = Path(tmpdir).resolve()
+            (tmpdir / 'a/b').mkdir(parents=True)
+            (tmpdir / 'c').symlink_to('a/b')
+            resolve = RealpathCache()
+            for path, expect in [
+                ('a/b/file', 'a/b/file'),
+                ('c/file', 'a/b/file'),
+                ('c/../file', 'a/file'),
+                ('c/..', 'a'),
+                ('c', 'c'),  # final component is not resolved
+                ('missing/../file', 'file'),
+            ]:
+                self.assertEqual(resolve(tmpdir / path), tmpdir / expect)
+            self.assertEqual(resolve.dirs[tmpdir / 'c'], tmpdir / 'a/b')
+
+    def test_missing_dirs_are_not_memoized(self):
+        with TemporaryDirectory() as tmpdir:
+            tmpdir = Path(tmpdir).resolve()
+            resolve = RealpathCache()
+            self.assertEqual(resolve(tmpdir / 'c/file'), tmpdir / 'c/file')
+            self.assertNotIn(tmpdir / 'c', resolve.dirs)
+            (tmpdir / 'a').mkdir()
+            (tmpdir / 'c').symlink_to('a')  # created later, by the build
+            self.assertEqual(resolve(tmpdir / 'c/file'), tmpdir / 'a/file')
+
+    def test_proc_is_not_resolved(self):
+        resolve = RealpathCache()
+        path = Path('/proc/self/fd/3')
+        self.assertEqual(resolve(path), path)
+        self.assertEqual(resolve.dirs, {})
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,9 +1,12 @@
+import gzip
 import logging
 import os
 from pathlib import Path
+import pickle
 import shutil
 from subprocess import DEVNULL
 from tempfile import TemporaryDirectory
+import threading
 import unittest
 
 import strace_helper
@@ -388,5 +391,502 @@ output_file:
             self.assertTrue(Path(tmpdir, 'output_file').exists())
 
 
+class TestStraceOutputParser(unittest.TestCase):
+    '''Parse synthetic strace output lines.'''
+
+    def parse(self, lines, parser=None):
+        if parser is None:
+            parser = strace_helper.StraceOutputParser()
+        return list(parser(line + '\n' for line in lines))
+
+    def test_openat_relative_to_dirfd(self):
+        self.assertEqual(self.parse([
+            '10 openat(AT_FDCWD, "src", O_RDONLY|O_DIRECTORY) = 3</tmp/src>',
+            '10 openat(3</tmp/src>, "foo.c", O_RDONLY) = 4</tmp/src/foo.c>',
+            '10 openat(3</tmp/src>, "/etc/passwd", O_RDONLY) = 5</etc/passwd>',
+            '10 openat(3</tmp/src>, "foo.o", O_WRONLY|O_CREAT, 0644) '
+            '= 6</tmp/src/foo.o>',
+            '10 openat(3</tmp/src>, "bar.c", O_RDONLY) '
+            '= -1 ENOENT (No such file or directory)',
+        ]), [
+            (10, 'read', ('src',)),
+            (10, 'read', ('/tmp/src/foo.c',)),
+            (10, 'read', ('/etc/passwd',)),
+            (10, 'write', ('/tmp/src/foo.o',)),
+            (10, 'check', ('/tmp/src/bar.c', False)),
+        ])
+
+    def test_unannotated_fd_uses_fd_table(self):
+        self.assertEqual(self.parse([
+            '10 openat(AT_FDCWD, "/tmp/src", O_RDONLY|O_DIRECTORY) '
+            '= 3</tmp/src>',
+            '10 clone(child_stack=NULL, flags=CLONE_CHILD_CLEARTID|'
+            'CLONE_CHILD_SETTID|SIGCHLD, child_tidptr=0x7f0) = 11',
+            '11 newfstatat(3, "foo.h", 0x7ffc, 0) = 0',
+            '11 fchdir(3) = 0',
+        ]), [
+            (10, 'read', ('/tmp/src',)),
+            (10, 'fork', (11,)),
+            (11, 'check', ('/tmp/src/foo.h', True)),
+            (11, 'chdir', ('/tmp/src',)),
+        ])
+
+    def test_fd_table_pruning(self):
+        parser = strace_helper.StraceOutputParser()
+        self.assertEqual(self.parse([
+            '10 openat(AT_FDCWD, "/a", O_RDONLY|O_DIRECTORY) = 3</a>',
+            '10 openat(AT_FDCWD, "/b", O_RDONLY|O_DIRECTORY|O_CLOEXEC) '
+            '= 4</b>',
+            '10 openat(AT_FDCWD, "/c", O_RDONLY|O_DIRECTORY) = 5</c>',
+            '10 close(5</c>) = 0',
+            '10 execve("/bin/sh", ["sh"], []) = 0',
+            '10 newfstatat(3, "x", 0x7ffc, 0) = 0',
+        ], parser), [
+            (10, 'read', ('/a',)),
+            (10, 'read', ('/b',)),
+            (10, 'read', ('/c',)),
+            (10, 'exec', ('/bin/sh', ['sh'], {})),
+            (10, 'check', ('/a/x', True)),
+        ])
+        self.assertEqual(parser.fds, {10: {3: '/a'}})  # 4 closed on exec
+        for line in ['10 newfstatat(4, "x", 0x7ffc, 0) = 0',
+                     '10 newfstatat(5, "x", 0x7ffc, 0) = 0']:
+            with self.assertRaises(strace_helper.StraceParseError):
+                self.parse([line], parser)
+        self.parse(['10 +++ exited with 0 +++'], parser)
+        self.assertEqual((parser.fds, parser.cloexec), ({}, {}))
+
+    def test_fd_path_with_angle_brackets(self):
+        self.assertEqual(self.parse([
+            '10 openat(AT_FDCWD, "a>b", O_RDONLY|O_DIRECTORY) = 3</t/a>b>',
+            '10 openat(3</t/a>b>, "c", O_RDONLY) = 4</t/a>b/c>',
+        ]), [
+            (10, 'read', ('a>b',)),
+            (10, 'read', ('/t/a>b/c',)),
+        ])
+
+    def test_unknown_fd(self):
+        with self.assertRaises(strace_helper.StraceParseError):
+            self.parse(['10 fchdir(7) = 0'])
+
+    def test_fchdir(self):
+        self.assertEqual(self.parse([
+            '10 fchdir(3</tmp/build dir>) = 0',
+        ]), [(10, 'chdir', ('/tmp/build dir',))])
+
+    def test_at_variants(self):
+        self.assertEqual(self.parse([
+            '10 faccessat(3</d>, "x", R_OK) = 0',
+            '10 faccessat2(AT_FDCWD</cwd>, "y", X_OK, AT_EACCESS) '
+            '= -1 ENOENT (No such file or directory)',
+            '10 readlinkat(3</d>, "link", "target", 4096) = 6',
+            '10 readlinkat(AT_FDCWD, "file", 0x7ffc, 4096) '
+            '= -1 EINVAL (Invalid argument)',
+            '10 renameat2(3</d>, "a.tmp", 4</e>, "a", RENAME_NOREPLACE) = 0',
+            '10 renameat(AT_FDCWD, "b.tmp", AT_FDCWD, "b") = 0',
+            '10 fchmodat(3</d>, "script", 0755) = 0',
+            '10 statx(3</d>, "z", AT_STATX_SYNC_AS_STAT|AT_SYMLINK_NOFOLLOW, '
+            'STATX_ALL, 0x7ffc) = 0',
+            '10 newfstatat(3</d/f.c>, "", 0x7ffc, AT_EMPTY_PATH) = 0',
+            '10 mkdirat(3</d>, "out", 0777) = 0',
+            '10 mkdir("out", 0777) = -1 EEXIST (File exists)',
+            '10 unlinkat(3</d>, "out", AT_REMOVEDIR) = 0',
+            '10 utimensat(3</d>, "stamp", NULL, 0) = 0',
+        ]), [
+            (10, 'check', ('/d/x', True)),
+            (10, 'check', ('y', False)),
+            (10, 'read', ('/d/link',)),
+            (10, 'check', ('file', True)),
+            (10, 'write', ('/d/a.tmp',)),
+            (10, 'write', ('/e/a',)),
+            (10, 'write', ('b.tmp',)),
+            (10, 'write', ('b',)),
+            (10, 'write', ('/d/script',)),
+            (10, 'check', ('/d/z', True)),
+            (10, 'check', ('/d/f.c', True)),
+            (10, 'write', ('/d/out',)),
+            (10, 'check', ('out', True)),
+            (10, 'write', ('/d/out',)),
+            (10, 'write', ('/d/stamp',)),
+        ])
+
+    def test_posix_spawn(self):
+        self.assertEqual(self.parse([
+            '10 clone(child_stack=0x7f00, flags=CLONE_VM|CLONE_VFORK|SIGCHLD) '
+            '= 11',
+            '11 execve("/bin/true", ["true"], []) = 0',
+            '11 +++ exited with 0 +++',
+            '10 clone3({flags=CLONE_VM|CLONE_VFORK, exit_signal=SIGCHLD, '
+            'stack=0x7f00, stack_size=0x9000}, 88) = 12',
+            '12 +++ exited with 0 +++',
+        ]), [
+            (10, 'fork', (11,)),
+            (11, 'exec', ('/bin/true', ['true'], {})),
+            (11, 'exit', (0,)),
+            (10, 'fork', (12,)),
+            (12, 'exit', (0,)),
+        ])
+
+    def test_threads(self):
+        self.assertEqual(self.parse([
+            '10 openat(AT_FDCWD, "/src", O_RDONLY|O_DIRECTORY) = 3</src>',
+            '10 clone3({flags=CLONE_VM|CLONE_FS|CLONE_FILES|CLONE_SIGHAND|'
+            'CLONE_THREAD|CLONE_SYSVSEM|CLONE_SETTLS|CLONE_PARENT_SETTID|'
+            'CLONE_CHILD_CLEARTID, child_tid=0x7f00, parent_tid=0x7f00, '
+            'exit_signal=0, stack=0x7e00, stack_size=0x7ff000, '
+            'tls=0x7f00} <unfinished ...>',
+            # The new thread runs before clone3() returns its tid
+            '11 openat(3, "a.c", O_RDONLY) = 4</src/a.c>',
+            '10 <... clone3 resumed> => {parent_tid=[11]}, 88) = 11',
+            '11 openat(AT_FDCWD, "a.o", O_WRONLY|O_CREAT, 0644) = 5</a.o>',
+            '11 +++ exited with 0 +++',
+            '10 +++ exited with 0 +++',
+        ]), [
+            (10, 'read', ('/src',)),
+            (10, 'read', ('/src/a.c',)),
+            (10, 'write', ('a.o',)),
+            (10, 'exit', (0,)),
+        ])
+
+    def test_child_runs_before_clone_returns(self):
+        parser = strace_helper.StraceOutputParser()
+        self.assertEqual(self.parse([
+            '10 openat(AT_FDCWD, "/a", O_RDONLY) = 3</a>',
+            '10 clone(child_stack=NULL, flags=CLONE_CHILD_CLEARTID|'
+            'CLONE_CHILD_SETTID|SIGCHLD <unfinished ...>',
+            '11 openat(AT_FDCWD, "/b", O_RDONLY|O_CLOEXEC) = 4</b>',
+            '10 <... clone resumed>, child_tidptr=0x7f00) = 11',
+        ], parser), [
+            (10, 'read', ('/a',)),
+            (11, 'read', ('/b',)),
+            (10, 'fork', (11,)),
+        ])
+        self.assertEqual(parser.fds, {10: {3: '/a'}, 11: {3: '/a', 4: '/b'}})
+        self.assertEqual(parser.cloexec, {11: {4}})
+
+    def test_child_exits_before_clone_returns(self):
+        parser = strace_helper.StraceOutputParser()
+        self.assertEqual(self.parse([
+            '10 openat(AT_FDCWD, "/a", O_RDONLY) = 3</a>',
+            '10 clone(child_stack=NULL, flags=CLONE_CHILD_CLEARTID|'
+            'CLONE_CHILD_SETTID|SIGCHLD <unfinished ...>',
+            '11 openat(AT_FDCWD, "/b", O_RDONLY) = 4</b>',
+            '11 +++ exited with 0 +++',
+            '10 <... clone resumed>, child_tidptr=0x7f00) = 11',
+            '10 +++ exited with 0 +++',
+        ], parser), [
+            (10, 'read', ('/a',)),
+            (11, 'read', ('/b',)),
+            (11, 'exit', (0,)),
+            (10, 'fork', (11,)),
+            (10, 'exit', (0,)),
+        ])
+        self.assertEqual(parser.fds, {})
+        self.assertEqual(parser.exited_early, set())
+        self.assertEqual(parser.known, set())
+
+    def test_leader_exits_before_thread(self):
+        self.assertEqual(self.parse([
+            '10 clone(child_stack=0x7f00, flags=CLONE_VM|CLONE_FS|CLONE_FILES|'
+            'CLONE_SIGHAND|CLONE_THREAD|CLONE_SYSVSEM) = 11',
+            '10 +++ exited with 0 +++',
+            '11 openat(AT_FDCWD, "a.o", O_WRONLY|O_CREAT, 0644) = 5</a.o>',
+            '11 +++ exited with 2 +++',
+        ]), [
+            (10, 'write', ('a.o',)),
+            (10, 'exit', (0,)),
+        ])
+
+    def test_held_lines_keep_their_order(self):
+        parser = strace_helper.StraceOutputParser()
+        self.assertEqual(self.parse([
+            '10 vfork() = 12',
+            '10 clone(child_stack=0x7f00, flags=CLONE_VM|CLONE_FS|CLONE_FILES|'
+            'CLONE_SIGHAND|CLONE_THREAD|CLONE_SYSVSEM <unfinished ...>',
+            '11 openat(AT_FDCWD, "a", O_RDONLY) = 3</a>',
+            '12 openat(AT_FDCWD, "b", O_RDONLY) = 3</b>',
+            '10 <... clone resumed>) = 11',
+            '12 openat(AT_FDCWD, "c", O_RDONLY) = 4</c>',
+            '12 +++ exited with 0 +++',
+            '11 +++ exited with 0 +++',
+        ], parser), [
+            (10, 'fork', (12,)),
+            (10, 'read', ('a',)),
+            (12, 'read', ('b',)),
+            (12, 'read', ('c',)),
+            (12, 'exit', (0,)),
+        ])
+        self.assertEqual(parser.known, {10})
+        self.assertFalse(parser.held)
+
+    def test_execve_from_thread(self):
+        self.assertEqual(self.parse([
+            '10 clone(child_stack=0x7f00, flags=CLONE_VM|CLONE_FS|CLONE_FILES|'
+            'CLONE_SIGHAND|CLONE_THREAD|CLONE_SYSVSEM) = 11',
+            '11 execve("/bin/true", ["true"], [] <unfinished ...>',
+            '10 +++ superseded by execve in pid 11 +++',
+            '10 <... execve resumed>) = 0',
+            '10 +++ exited with 0 +++',
+        ]), [
+            (10, 'exec', ('/bin/true', ['true'], {})),
+            (10, 'exit', (0,)),
+        ])
+
+    def test_timestamps(self):
+        parser = strace_helper.StraceOutputParser(timestamps=True)
+        self.assertEqual(self.parse([
+            '10    1700000000.100000 execve("/bin/sh", ["sh"], []) = 0',
+            '10    1700000000.200000 clone(child_stack=NULL, '
+            'flags=CLONE_CHILD_CLEARTID|CLONE_CHILD_SETTID|SIGCHLD, '
+            'child_tidptr=0x7f0) = 11',
+            '11    1700000000.300000 openat(AT_FDCWD, "a", O_RDONLY) = 3</a>',
+            '11    1700000000.400000 +++ exited with 0 +++',
+        ], parser), [
+            (10, 'exec', ('/bin/sh', ['sh'], {}, 1700000000.1)),
+            (10, 'fork', (11, 1700000000.2)),
+            (11, 'read', ('a',)),
+            (11, 'exit', (0, 1700000000.4)),
+        ])
+
+    def test_timestamp_of_resumed_fork(self):
+        parser = strace_helper.StraceOutputParser(timestamps=True)
+        self.assertEqual(self.parse([
+            '10    1700000000.100000 vfork( <unfinished ...>',
+            '11    1700000000.200000 execve("/bin/true", ["true"], []) = 0',
+            '10    1700000000.300000 <... vfork resumed>) = 11',
+        ], parser), [
+            (11, 'exec', ('/bin/true', ['true'], {}, 1700000000.2)),
+            (10, 'fork', (11, 1700000000.1)),
+        ])
+
+    def test_shared_env(self):
+        parser = strace_helper.StraceOutputParser()
+        parser.EnvCacheSize = 1
+        events = self.parse([
+            '10 execve("/bin/sh", ["sh"], ["A=1", "B=x=y"]) = 0',
+            '11 execve("/bin/sh", ["sh"], ["A=1", "B=x=y"]) = 0',
+            '12 execve("/bin/sh", ["sh"], ["A=2"]) = 0',
+            '13 execve("/bin/sh", ["sh"], ["A=1", "B=x=y"]) = 0',
+        ], parser)
+        envs = [args[2] for _, _, args in events]
+        self.assertEqual(envs[0], {'A': '1', 'B': 'x=y'})
+        self.assertIs(envs[1], envs[0])
+        self.assertEqual(envs[2], {'A': '2'})
+        self.assertIsNot(envs[3], envs[0])  # evicted from cache by envs[2]
+        self.assertEqual(envs[3], envs[0])
+        with self.assertRaises(TypeError):
+            envs[0]['A'] = '2'
+        self.assertEqual(pickle.loads(pickle.dumps(envs[0])), envs[0])
+
+    tolerant_lines = [
+        '10 openat(AT_FDCWD, "a", O_RDONLY) = 3</a>',
+        '10 frobnicate("a", 42) = 0',
+        '10 chdir("/nonexistent") = -1 ENOENT (No such file or directory)',
+        '10 frobnicate("b", 42) = 0',
+        '10 --- SIGSEGV {si_signo=SIGSEGV} ---',
+        '10 openat(AT_FDCWD, "b", O_WRONLY) = 4</b>',
+    ]
+
+    def test_strict(self):
+        with self.assertRaises(strace_helper.StraceParseError):
+            self.parse(self.tolerant_lines)
+
+    def test_tolerant(self):
+        parser = strace_helper.StraceOutputParser(tolerant=True)
+        with self.assertLogs(strace_helper.logger, logging.WARNING) as cm:
+            self.assertEqual(self.parse(self.tolerant_lines, parser), [
+                (10, 'read', ('a',)),
+                (10, 'write', ('b',)),
+            ])
+        self.assertEqual(parser.unhandled, {
+            'frobnicate': 2, 'chdir': 1, 'SIGSEGV': 1})
+        self.assertEqual(cm.output, [
+            'WARNING:strace_helper:Unhandled strace lines: 2 frobnicate, '
+            '1 chdir, 1 SIGSEGV'])
+
+    def test_tolerant_exit(self):
+        parser = strace_helper.StraceOutputParser(tolerant=True)
+
+        def fail(pid):
+            raise KeyError(pid)
+        parser._forget_fds = fail
+        self.assertEqual(self.parse([
+            '10 +++ exited with 3 +++',
+        ], parser), [])
+        self.assertEqual(parser.unhandled, {'<exit>': 1})
+
+
+class Test_record_and_replay(unittest.TestCase):
+
+    lines = [
+        '10 execve("/bin/cat", ["cat", "foo"], ["A=1"]) = 0\n',
+        '10 openat(AT_FDCWD, "foo", O_RDONLY) = 3</src/foo>\n',
+        '10 +++ exited with 0 +++\n',
+    ]
+    events = [
+        (10, 'exec', ('/bin/cat', ['cat', 'foo'], {'A': '1'})),
+        (10, 'read', ('foo',)),
+        (10, 'exit', (0,)),
+    ]
+
+    def test_drain_fifo(self):
+        lines = [
+            '{} line {}\n'.format(i, 'x' * (i % 300)) for i in range(5000)]
+        with strace_helper.temp_fifo() as fifo:
+            def writer():
+                with open(fifo, 'w') as f:
+                    f.writelines(lines)
+                    f.write('no newline')
+
+            t = threading.Thread(target=writer)
+            t.start()
+            with open(fifo) as f:
+                self.assertEqual(
+                    list(strace_helper.drain_fifo(f, chunk_size=1000)),
+                    lines + ['no newline'])
+            t.join()
+
+    def parse_in_process(self, lines, **kwargs):
+        with strace_helper.temp_fifo() as fifo:
+            def writer():
+                with open(fifo, 'w') as f:
+                    f.writelines(lines)
+
+            t = threading.Thread(target=writer)
+            t.start()
+            try:
+                return list(strace_helper.parse_in_process(fifo, **kwargs))
+            finally:
+                t.join()
+
+    def test_parse_in_process(self):
+        self.assertEqual(
+            self.parse_in_process(self.lines * 3, batch_size=2),
+            self.events * 3)
+
+    def test_parse_in_process_flushes_when_idle(self):
+        with strace_helper.temp_fifo() as fifo:
+            received = threading.Event()
+            flushed = []
+
+            def writer():
+                with open(fifo, 'w') as f:
+                    f.writelines(self.lines[:2])
+                    f.flush()
+                    flushed.append(received.wait(10))
+                    f.writelines(self.lines[2:])
+
+            t = threading.Thread(target=writer)
+            t.start()
+            events = strace_helper.parse_in_process(fifo, batch_size=1000)
+            self.assertEqual([next(events), next(events)], self.events[:2])
+            received.set()
+            self.assertEqual(list(events), self.events[2:])
+            t.join()
+            self.assertEqual(flushed, [True])
+
+    def test_parse_in_process_error(self):
+        with self.assertRaises(strace_helper.StraceParseError):
+            self.parse_in_process(
+                self.lines[:1] + ['10 frobnicate("foo") = 0\n'])
+
+    def test_drain_fifo_stopped_early(self):
+        with strace_helper.temp_fifo() as fifo:
+            stopped = threading.Event()
+            errors = []
+
+            def writer():
+                fd = os.open(fifo, os.O_WRONLY)
+                try:
+                    os.write(fd, self.lines[0].encode())
+                    stopped.wait()
+                    os.write(fd, ''.join(self.lines[1:]).encode())
+                except BrokenPipeError as e:
+                    errors.append(e)
+                finally:
+                    os.close(fd)
+
+            t = threading.Thread(target=writer)
+            t.start()
+            with open(fifo) as f:
+                lines = strace_helper.drain_fifo(f)
+                self.assertEqual(next(lines), self.lines[0])
+                lines.close()  # does not wait for the (idle) writer
+            stopped.set()
+            t.join()
+            self.assertEqual(len(errors), 1)
+
+    def test_drain_fifo_record(self):
+        with TemporaryDirectory() as tmpdir, \
+                strace_helper.temp_fifo() as fifo:
+            path = os.path.join(tmpdir, 'trace.gz')
+
+            def writer():
+                with open(fifo, 'w') as f:
+                    f.writelines(self.lines)
+
+            t = threading.Thread(target=writer)
+            t.start()
+            with open(fifo) as f:
+                self.assertEqual(list(strace_helper.drain_fifo(
+                    f, record=path, metadata={'cwd': '/src'})), self.lines)
+            t.join()
+            self.assertEqual(
+                strace_helper.recording_info(path), {'cwd': '/src'})
+            self.assertEqual(
+                list(strace_helper.replay_trace(path)), self.events)
+
+    def test_record_after_consumer_stops(self):
+        with TemporaryDirectory() as tmpdir, \
+                strace_helper.temp_fifo() as fifo:
+            path = os.path.join(tmpdir, 'trace.gz')
+            stopped = threading.Event()
+
+            def writer():
+                with open(fifo, 'w') as f:
+                    f.write(self.lines[0])
+                    f.flush()
+                    stopped.wait()
+                    f.writelines(self.lines[1:])
+
+            t = threading.Thread(target=writer)
+            t.start()
+            with open(fifo) as f:
+                lines = strace_helper.drain_fifo(f, record=path)
+                self.assertEqual(next(lines), self.lines[0])
+                stopped.set()
+                lines.close()  # still records until the writer is done
+            t.join()
+            self.assertEqual(
+                list(strace_helper.replay_trace(path)), self.events)
+
+    def test_replay_detects_timestamps(self):
+        lines = [
+            '10    1700000000.100000 execve("/bin/true", ["true"], []) = 0\n',
+            '10    1700000000.200000 +++ exited with 0 +++\n',
+        ]
+        events = [
+            (10, 'exec', ('/bin/true', ['true'], {}, 1700000000.1)),
+            (10, 'exit', (0, 1700000000.2)),
+        ]
+        with TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'trace.gz')
+            for header in ['', '#strace_helper {"timestamps": true}\n']:
+                with gzip.open(path, 'wt') as f:
+                    f.write(header)
+                    f.writelines(lines)
+                self.assertEqual(
+                    list(strace_helper.replay_trace(path)), events)
+
+    def test_replay_uncompressed(self):
+        with TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'trace.txt')
+            with open(path, 'w') as f:
+                f.writelines(self.lines)
+            self.assertEqual(strace_helper.recording_info(path), {})
+            self.assertEqual(
+                list(strace_helper.replay_trace(path)), self.events)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,105 @@
+import io
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+
+from process_trace import ProcessTrace
+import trace_cache
+
+
+class TestTraceCache(unittest.TestCase):
+
+    def run(self, *args, **kwargs):
+        with TemporaryDirectory() as tmpdir:
+            self.tmpdir = Path(tmpdir)
+            self.input = self.tmpdir / 'input'
+            self.output = self.tmpdir / 'output'
+            self.missing = self.tmpdir / 'missing'
+            with self.input.open('w') as f:
+                f.write('foo\n')
+            super().run(*args, **kwargs)
+
+    def make_trace(self):
+        p = ProcessTrace(
+            pid=1, cwd=self.tmpdir, executable='/bin/cp',
+            argv=['cp', 'input', 'output'], exit_code=0,
+            paths_read=['input', '/dev/null'], paths_written=['output'],
+            paths_checked=[('missing', False), ('input', True),
+                           ('output', False)])
+        p.children.append(ProcessTrace(
+            pid=2, ppid=1, cwd=self.tmpdir, executable='/bin/true',
+            argv=['true'], exit_code=0, paths_checked=[('.', True)]))
+        return p
+
+    def save_and_load(self):
+        f = io.StringIO()
+        trace_cache.save(f, self.make_trace())
+        f.seek(0)
+        return trace_cache.load(f)
+
+    def test_inputs(self):
+        read, checked = trace_cache.inputs(self.make_trace().collapsed())
+        self.assertEqual(
+            read, {self.input, Path('/bin/cp'), Path('/bin/true')})
+        self.assertEqual(checked, {self.missing: False, self.tmpdir: True})
+
+    def test_roundtrip(self):
+        p, stamps, checked, cwd, env = self.save_and_load()
+        self.assertEqual(p.json(), self.make_trace().json())
+        self.assertEqual(cwd, self.tmpdir)
+        self.assertEqual(env, trace_cache.env_digest({}))
+        self.assertEqual(
+            set(stamps.keys()), {str(self.input), '/bin/cp', '/bin/true'})
+        self.assertEqual(
+            checked, {str(self.missing): False, str(self.tmpdir): True})
+
+    def test_unchanged(self):
+        _, stamps, checked, _, _ = self.save_and_load()
+        self.assertTrue(trace_cache.is_up_to_date(stamps, checked))
+
+    def test_touched_but_unchanged(self):
+        _, stamps, checked, _, _ = self.save_and_load()
+        os.utime(str(self.input), ns=(0, 0))
+        self.assertTrue(trace_cache.is_up_to_date(stamps, checked))
+
+    def test_input_modified(self):
+        _, stamps, checked, _, _ = self.save_and_load()
+        with self.input.open('w') as f:
+            f.write('bar\n')
+        self.assertFalse(trace_cache.is_up_to_date(stamps, checked))
+
+    def test_missing_path_created(self):
+        _, stamps, checked, _, _ = self.save_and_load()
+        self.missing.mkdir()
+        self.assertFalse(trace_cache.is_up_to_date(stamps, checked))
+
+    def test_input_modified_during_trace(self):
+        p = self.make_trace()
+        stamper = trace_cache.InputStamper()
+        stamper(p, 'read', ('input',))  # stamped when first read...
+        stamper.futures[self.input].result()
+        with self.input.open('w') as f:  # ...so a later change is noticed
+            f.write('bar\n')
+        f = io.StringIO()
+        trace_cache.save(f, p, stamper=stamper, cwd='/elsewhere')
+        f.seek(0)
+        _, stamps, checked, cwd, _ = trace_cache.load(f)
+        self.assertEqual(cwd, Path('/elsewhere'))
+        self.assertFalse(trace_cache.is_up_to_date(stamps, checked))
+
+    def test_env_digest(self):
+        self.assertEqual(trace_cache.env_digest({'A': '1', 'B': '2'}),
+                         trace_cache.env_digest({'B': '2', 'A': '1'}))
+        self.assertNotEqual(trace_cache.env_digest({'A': '1'}),
+                            trace_cache.env_digest({'A': '2'}))
+
+    def test_output_removed(self):
+        self.output.touch()
+        _, stamps, checked, _, _ = self.save_and_load()
+        self.output.unlink()
+        self.assertTrue(trace_cache.is_up_to_date(stamps, checked))
+
+
+if __name__ == '__main__':
+    unittest.main()
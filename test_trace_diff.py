@@ -0,0 +1,68 @@
+import doctest
+import os
+from tempfile import TemporaryDirectory
+import unittest
+
+from process_trace import ProcessTrace
+import trace_diff
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(trace_diff))
+    return tests
+
+
+def build(cc_inputs, extra_steps=()):
+    events = [
+        (1, 'exec', ('/bin/make', ['make'], {})),
+        (1, 'read', ('Makefile',)),
+    ]
+    pid = 1
+    steps = [(['cc', '-c', 'a.c'], cc_inputs)] + list(extra_steps)
+    for argv, inputs in steps:
+        pid += 1
+        events.append((1, 'fork', (pid,)))
+        events.append((pid, 'exec', ('/bin/' + argv[0], argv, {})))
+        events.extend((pid, 'read', (path,)) for path in inputs)
+        events.append((pid, 'exit', (0,)))
+    events.append((1, 'exit', (0,)))
+    return ProcessTrace.from_events(iter(events), cwd='/src')
+
+
+class TestTraceDiff(unittest.TestCase):
+
+    def test_identical(self):
+        a = build(['a.c', 'a.h'])
+        b = build(['a.c', 'a.h'])
+        self.assertEqual(list(trace_diff.diff(a, b)), [])
+
+    def test_changed_inputs(self):
+        a = build(['a.c', 'a.h', '/usr/include/stdio.h'])
+        b = build(['a.c', '/usr/include/stdio.h', '/home/me/a.h'])
+        self.assertEqual(list(trace_diff.diff(a, b)), [
+            ('!', ('/bin/cc', ('cc', '-c', 'a.c'), 0), [
+                ('+', 'read', '/home/me/a.h'),
+                ('-', 'read', '/src/a.h'),
+            ]),
+        ])
+
+    def test_added_and_removed_processes(self):
+        a = build(['a.c'], [(['cc', '-c', 'a.c'], ['a.c'])])
+        b = build(['a.c'], [(['ld', 'a.o'], ['a.o'])])
+        self.assertEqual(list(trace_diff.diff(a, b)), [
+            ('-', ('/bin/cc', ('cc', '-c', 'a.c'), 1), []),
+            ('+', ('/bin/ld', ('ld', 'a.o'), 0), []),
+        ])
+
+    def test_main(self):
+        with TemporaryDirectory() as tmpdir:
+            paths = []
+            for name, inputs in [('a', ['a.c']), ('b', ['a.c'])]:
+                paths.append(os.path.join(tmpdir, name + '.json'))
+                with open(paths[-1], 'w') as f:
+                    f.write(build(inputs).json())
+            self.assertEqual(trace_diff.main(paths), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -33,6 +33,18 @@ def modified_env(env, mods=None, keep=None):
     return ret
 
 
+def make_rule(target, deps, recipe, is_target=True):
+    '''Return a makeparser.Makefile.Rule with the given attributes.'''
+    from makeparser import Makefile
+
+    rule = Makefile.Rule()
+    rule.target = target
+    rule.deps = deps
+    rule.recipe = recipe
+    rule.is_target = is_target
+    return rule
+
+
 def prepare_trace_environment():
     '''Prepare this process' environment for running a trace.
 
@@ -0,0 +1,215 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import stat
+
+from process_trace import ProcessTrace
+
+
+logger = logging.getLogger(__name__)
+
+# Paths under these directories are not files whose contents (or existence)
+# depend on anything the build controls. Never stamp or check them.
+VolatilePrefixes = ('/dev/', '/proc/', '/sys/')
+
+
+def _batches(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def stamp(path):
+    '''Return a (size, mtime_ns, digest) stamp of the given path.
+
+    The digest is a SHA-1 of the file contents, or of the list of names in
+    a directory. Return None for missing paths and paths that are neither
+    regular files nor directories.
+    '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    h = hashlib.sha1()
+    if stat.S_ISDIR(st.st_mode):
+        for name in sorted(os.listdir(path)):
+            h.update(os.fsencode(name) + b'\0')
+    elif stat.S_ISREG(st.st_mode):
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    else:
+        return None
+    return st.st_size, st.st_mtime_ns, h.hexdigest()
+
+
+def _stamp_changed(path, old):
+    '''Return True iff the current stamp of path differs from old.
+
+    Compare size and mtime first, and only hash the contents when those
+    differ, so that merely touched files do not count as changed.
+    '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return old is not None
+    if old is None:
+        return True
+    if (st.st_size, st.st_mtime_ns) == tuple(old[:2]):
+        return False
+    new = stamp(path)
+    return new is None or new[2] != old[2]
+
+
+def _existence_changed(checks):
+    '''Return True if any of the given (path, exists) pairs no longer holds.
+
+    The pairs must all refer to entries of the same directory, which is
+    scanned only once.
+    '''
+    parent = checks[0][0].parent
+    try:
+        entries = dict((e.name, e) for e in os.scandir(str(parent)))
+    except OSError:
+        entries = {}
+    for path, exists in checks:
+        entry = entries.get(path.name)
+        if entry is None or entry.is_symlink():
+            now = os.path.exists(str(path))  # follow symlinks like stat()
+        else:
+            now = True
+        if now != exists:
+            logger.debug('{} existence changed: {} -> {}'.format(
+                path, exists, now))
+            return True
+    return False
+
+
+def inputs(p):
+    '''Return the inputs of collapsed ProcessTrace p.
+
+    Return the set of paths read and a dict of path -> exists for checked
+    paths, skipping paths written by p itself and volatile paths.
+    '''
+    written = set(t[1] for t in p.paths_written)
+
+    def keep(path):
+        return path not in written and not str(path).startswith(
+            VolatilePrefixes)
+
+    read = set(t[1] for t in p.paths_read if keep(t[1]))
+    checked = dict((t[1], t[2]) for t in p.paths_checked
+                   if keep(t[1]) and t[1] not in read)
+    return read, checked
+
+
+class InputStamper:
+    '''Stamp the inputs of a trace as soon as they are first read.
+
+    Use as the on_event callback of ProcessTrace.from_events(), so that an
+    input modified while the traced command is still running does not get
+    the stamp of its modified contents (and go unnoticed next time). Stamps
+    are taken on a pool of 'jobs' threads; .stamps() collects them.
+    '''
+
+    def __init__(self, jobs=None):
+        self.pool = ThreadPoolExecutor(max_workers=jobs)
+        self.futures = {}  # absolute Path -> future stamp
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.pool.shutdown()
+
+    def __call__(self, p, event, args):
+        if event in ('read', 'exec'):
+            self.add(p.cwd / args[0])
+
+    def add(self, path):
+        if path not in self.futures and not str(path).startswith(
+                VolatilePrefixes):
+            self.futures[path] = self.pool.submit(stamp, path)
+
+    def stamps(self, paths):
+        '''Return a dict of str(path) -> stamp for the given Paths.
+
+        Paths never seen by .add() are stamped now.
+        '''
+        for path in paths:
+            self.add(path)
+        return dict((str(path), self.futures[path].result())
+                    for path in paths)
+
+
+def env_digest(env):
+    '''Return a digest of the environment dict env, to tell envs apart.'''
+    return hashlib.sha256(
+        json.dumps(sorted(env.items())).encode('utf-8')).hexdigest()
+
+
+def save(f, p, jobs=None, stamper=None, cwd=None, env=None):
+    '''Save ProcessTrace p to file f, with stamps of all its inputs.
+
+    The stamps are taken from the given InputStamper, if any, and 'cwd' and
+    'env' are the directory and environment the traced command was started
+    with (default: p.cwd and p.env). Only a digest of env is saved.
+    '''
+    read, checked = inputs(p.collapsed())
+    read = sorted(read)
+    if stamper is None:
+        stamper = InputStamper(jobs)
+    with stamper:
+        stamps = stamper.stamps(read)
+    if env is None:
+        env = p.env or {}
+    f.write('{{"cwd": {}, "env": {}, "stamps": {}, "checked": {}, '
+            '"trace": {}}}\n'.format(
+                json.dumps(str(p.cwd if cwd is None else cwd)),
+                json.dumps(env_digest(env)),
+                json.dumps(stamps, sort_keys=True),
+                json.dumps(dict((str(k), v) for k, v in checked.items()),
+                           sort_keys=True),
+                p.json()))
+
+
+def load(f):
+    '''Load a ProcessTrace and its input stamps from a file made by save().
+
+    Return a (ProcessTrace, stamps, checked, cwd, env digest) tuple.
+    '''
+    d = json.load(f)
+    p = ProcessTrace.from_json(json.dumps(d['trace']))
+    return p, d['stamps'], d['checked'], Path(d['cwd']), d['env']
+
+
+def is_up_to_date(stamps, checked, jobs=None, batch_size=256):
+    '''Return True iff none of the recorded inputs has changed.
+
+    Stamps of read paths are compared (in batches on a pool of 'jobs'
+    threads) by size and mtime, falling back to comparing content hashes.
+    Checked paths are grouped per directory, and each directory is scanned
+    only once to look up the (non-)existence of its entries.
+    '''
+    by_dir = {}  # parent directory -> [(path, exists), ...]
+    for path, exists in checked.items():
+        path = Path(path)
+        by_dir.setdefault(path.parent, []).append((path, exists))
+
+    def read_batch(batch):
+        return any(_stamp_changed(path, old) for path, old in batch)
+
+    def check_batch(batch):
+        return any(_existence_changed(checks) for checks in batch)
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [
+            pool.submit(read_batch, batch)
+            for batch in _batches(stamps.items(), batch_size)]
+        futures.extend(
+            pool.submit(check_batch, batch)
+            for batch in _batches(by_dir.values(), batch_size))
+        return not any(future.result() for future in futures)
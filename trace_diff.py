@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+'''Compare two traces of the same command, e.g. to catch non-hermetic steps.
+
+Usage: trace_diff.py TRACE_A TRACE_B
+
+Each trace is either the output of ProcessTrace.json() (a '.json' file), or
+strace output recorded with 'depfinder.py --record'. Processes are aligned
+by executable and argv (not by pid), and the files they accessed are
+compared. Exits with status 1 if the traces differ.
+'''
+
+import shlex
+import sys
+
+from process_trace import ProcessTrace
+from strace_helper import recording_info, replay_trace
+
+
+def sorted_merge(a, b):
+    '''Merge the sorted sequences a and b, each without duplicates.
+
+    Generate (item, in_a, in_b) tuples, in sorted order.
+
+    >>> list(sorted_merge([1, 2, 4], [2, 3]))
+    [(1, True, False), (2, True, True), (3, False, True), (4, True, False)]
+    '''
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if a[i] < b[j]:
+            yield a[i], True, False
+            i += 1
+        elif b[j] < a[i]:
+            yield b[j], False, True
+            j += 1
+        else:
+            yield a[i], True, True
+            i += 1
+            j += 1
+    for item in a[i:]:
+        yield item, True, False
+    for item in b[j:]:
+        yield item, False, True
+
+
+def index_processes(root):
+    '''Return a dict of all processes under root, keyed for alignment.
+
+    The key is (executable, argv, occurrence), where occurrence counts the
+    earlier processes (in depth-first order) with the same executable and
+    argv.
+    '''
+    ret = {}
+    counts = {}
+    stack = [root]
+    while stack:
+        p = stack.pop()
+        cmd = (str(p.executable), tuple(p.argv or ()))
+        n = counts[cmd] = counts.get(cmd, -1) + 1
+        ret[cmd + (n,)] = p
+        stack.extend(reversed(p.children))
+    return ret
+
+
+def accesses(p):
+    '''Return the sorted (kind, path) file accesses of ProcessTrace p.'''
+    ret = set(('read', str(t[1])) for t in p.paths_read)
+    ret.update(('write', str(t[1])) for t in p.paths_written)
+    ret.update(('exists' if t[2] else 'missing', str(t[1]))
+               for t in p.paths_checked)
+    return sorted(ret)
+
+
+def diff(a, b):
+    '''Compare the process trees rooted at a and b.
+
+    Generate (sign, key, changes) tuples in key order (see index_processes()
+    for the keys), where sign is '-' for a process only in a, '+' for one
+    only in b, and '!' for one whose file accesses differ. changes is a list
+    of (sign, kind, path) tuples, where sign is '-' for accesses only in a,
+    and '+' for accesses only in b.
+    '''
+    a_procs, b_procs = index_processes(a), index_processes(b)
+    for key, in_a, in_b in sorted_merge(sorted(a_procs), sorted(b_procs)):
+        if not in_b:
+            yield '-', key, []
+        elif not in_a:
+            yield '+', key, []
+        else:
+            changes = [
+                ('-' if old else '+',) + access
+                for access, old, new in sorted_merge(
+                    accesses(a_procs[key]), accesses(b_procs[key]))
+                if not (old and new)]
+            if changes:
+                yield '!', key, changes
+
+
+def load(path):
+    '''Load a ProcessTrace tree from a .json file or recorded strace output.
+    '''
+    if path.endswith('.json'):
+        with open(path) as f:
+            return ProcessTrace.from_json(f.read())
+    return ProcessTrace.from_events(
+        replay_trace(path), cwd=recording_info(path).get('cwd'))
+
+
+def main(args):
+    if len(args) != 2:
+        sys.exit(__doc__.strip().splitlines()[2])
+    differ = False
+    for sign, (executable, argv, n), changes in diff(*map(load, args)):
+        differ = True
+        cmd = ' '.join(shlex.quote(a) for a in argv) or executable
+        if n:
+            cmd += ' (#{})'.format(n + 1)
+        print('{} {}'.format(sign, cmd))
+        for sign, kind, path in changes:
+            print('    {} {} {}'.format(sign, kind, path))
+    return 1 if differ else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))